@@ -0,0 +1,61 @@
+import argparse
+import sys
+from benchmarks import suite
+from pipeline_simulator.core import profiling
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description="Measures the throughput and peak memory of the parser, the CPUs and the chronogram, "
+                    "and the footprint of decoded programs.")
+    parser.add_argument('--size', action='append', choices=suite.SIZES,
+                        help="Program size to run, can be repeated (default: all)")
+    parser.add_argument('--benchmark', action='append', choices=[b.name for b in suite.BENCHMARKS],
+                        help="Benchmark to run, can be repeated (default: all)")
+    parser.add_argument('--repeat', type=int, default=3, help="Timed repetitions of each benchmark")
+    parser.add_argument('--compare', metavar='REVISION',
+                        help="Revision to compare with (default: the latest saved results)")
+    parser.add_argument('--threshold', type=float, default=suite.REGRESSION_THRESHOLD,
+                        help="Relative slowdown reported as a regression")
+    parser.add_argument('--results-dir', default=suite.RESULTS_DIR, help="Directory of the saved results")
+    parser.add_argument('--no-save', action='store_true', help="Do not save the results")
+    parser.add_argument('--check', action='store_true', help="Exit with status 1 if any benchmark regressed")
+    parser.add_argument('--profile', metavar='PATH',
+                        help="Profile the simulator hot paths and write the folded stacks to PATH "
+                             "(timings include the profiler overhead and are not saved)")
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        with profiling.Profiler() as profiler:
+            suite.run(sizes=args.size or suite.SIZES, names=args.benchmark, repeat=1)
+        profiler.report()
+        profiler.write_folded(args.profile)
+        print("Folded stacks written to %s" % args.profile)
+        return 0
+
+    revision = suite.current_revision()
+    print("Revision %s" % revision)
+    results = suite.run(sizes=args.size or suite.SIZES, names=args.benchmark, repeat=args.repeat,
+                        report=suite.print_measure)
+
+    if not args.no_save:
+        print("Results saved to %s" % suite.save(results, revision, args.results_dir))
+
+    reference_revision = args.compare or suite.latest_revision(exclude=revision, results_dir=args.results_dir)
+    if reference_revision is None:
+        return 0
+
+    reference = suite.load(reference_revision, args.results_dir)['results']
+    changes, regressions = suite.compare(results, reference, args.threshold)
+    print("\nCompared with %s" % reference_revision)
+    for key, before, after, change in changes:
+        unit = "s" if key in results else " "  # Metrics are sizes
+        print("%-32s %10.4f%s -> %10.4f%s %+7.1f%%%s" % (
+            key, before, unit, after, unit, change * 100, "  REGRESSION" if key in regressions else ""))
+
+    return 1 if args.check and regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
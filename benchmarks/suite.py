@@ -0,0 +1,296 @@
+import contextlib
+import datetime
+import gc
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from pipeline_simulator.core import memories, architectures, compilers, workloads
+from pipeline_simulator.core.instructions import Opcode, AluInstruction, MemInstruction, HaltInstruction
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+REGRESSION_THRESHOLD = 0.10  # Relative slowdown of the median time reported as a regression
+
+# Work done by every benchmark at each size, in the unit given by the benchmark
+SIZES = ('small', 'medium', 'large')
+
+
+class Benchmark:
+    """
+    A timed operation over a generated program. `setup(size)` builds a fresh state for every repetition,
+    outside of the timing, and `run(state)` returns the number of items processed (cycles, instructions,
+    lines...), so the results are reported as items per second. `metrics(state, items, peak_bytes)`, if
+    given, returns sizes measured on the untimed repetition, which are compared between revisions too.
+    """
+
+    def __init__(self, name, unit, sizes, setup, run, metrics=None):
+        self.name = name
+        self.unit = unit
+        self.sizes = sizes
+        self.setup = setup
+        self.run = run
+        self.metrics = metrics
+
+    def measure(self, size, repeat=3):
+        times = []
+        items = 0
+        for _ in range(repeat):
+            state = self.setup(self.sizes[size])
+            gc.collect()
+            start = time.perf_counter()
+            items = self.run(state)
+            times.append(time.perf_counter() - start)
+
+        # A last, untimed, repetition to get the peak of the memory allocated by the operation
+        state = self.setup(self.sizes[size])
+        gc.collect()
+        tracemalloc.start()
+        start_memory = tracemalloc.get_traced_memory()[0]
+        self.run(state)
+        peak = tracemalloc.get_traced_memory()[1] - start_memory
+        tracemalloc.stop()
+
+        median = statistics.median(times)
+        measure = {
+            'unit': self.unit,
+            'items': items,
+            'repeat': repeat,
+            'median_seconds': median,
+            'min_seconds': min(times),
+            'items_per_second': items / median if median else None,
+            'peak_bytes': peak,
+        }
+        if self.metrics is not None:
+            measure['metrics'] = self.metrics(state, items, peak)
+        return measure
+
+
+def _straight_line(instructions, seed=0):
+    """ Workload without loops or branches, runnable by every CPU """
+    return workloads.WorkloadGenerator(seed=seed, branches=0, trip_counts=(), body_size=instructions).generate()
+
+
+def _looped(instructions, seed=0):
+    """ Workload of about `instructions` dynamic instructions, executed by a loop of 50 instructions """
+    body_size = 50
+    trip_count = max(1, instructions // (body_size + 2))
+    return workloads.WorkloadGenerator(seed=seed, body_size=body_size, trip_counts=(trip_count,)).generate()
+
+
+def _run_cpu(cpu):
+    cpu.start()
+    return cpu.run()
+
+
+def _setup_parser(lines):
+    workload = _straight_line(lines)
+    return workload.source, memories.RegisterSet(), memories.Memory(workload.memory_size)
+
+
+def _run_parser(state):
+    source, registers, memory = state
+    return len(compilers.Parser(registers=registers, memory=memory).parse_lines(source))
+
+
+def _setup_footprint(size):
+    registers = memories.RegisterSet()
+    return registers, memories.Memory(size + 2), size, []
+
+
+def _run_footprint(state):
+    """
+    Decodes a straight-line program mixing ALU and memory instructions, built directly because the
+    parser analyzes dependencies between every pair of instructions
+    """
+    registers, memory, size, program = state
+    r = registers.get
+    template = [
+        lambda: AluInstruction(Opcode.ADD, rs=r(1), rt=r(2), rd=r(3)),
+        lambda: AluInstruction(Opcode.MULT, rs=r(3), rt=r(2), rd=r(4)),
+        lambda: MemInstruction(Opcode.STORE, rs=r(4), rd=r(0), offset=size + 1, memory=memory),
+        lambda: MemInstruction(Opcode.LOAD, rs=r(0), rd=r(5), offset=size + 1, memory=memory),
+        lambda: AluInstruction(Opcode.SUB, rs=r(5), rt=r(1), rd=r(6)),
+    ]
+    program.extend(template[i % len(template)]() for i in range(size - 1))
+    program.append(HaltInstruction(Opcode.HALT))
+    return len(program)
+
+
+def _footprint_metrics(state, items, peak_bytes):
+    """ Bytes held by each decoded instruction and by a Register """
+    register = state[0].get(0)
+    return {
+        'bytes_per_instruction': peak_bytes / items,
+        'register_bytes': sys.getsizeof(register) + (sys.getsizeof(register.__dict__)
+                                                     if hasattr(register, '__dict__') else 0),
+    }
+
+
+def _setup_dependency_analyzer(instructions):
+    workload = _straight_line(instructions)
+    program = compilers.Parser(registers=memories.RegisterSet(), memory=None).parse_lines(workload.source)
+    analyzer = compilers.DependencyAnalyzer()
+    for instruction in program:
+        analyzer.add_instruction(instruction)
+    return analyzer
+
+
+def _run_dependency_analyzer(analyzer):
+    analyzer.analyze()
+    return len(analyzer._tmp)
+
+
+def _setup_pipelined_cpu(instructions):
+    registers, memory = _looped(instructions).build()
+    return architectures.PipelinedCpu(registers=registers, memory=memory)
+
+
+def _setup_centralized_rs_cpu(instructions):
+    registers, memory = _straight_line(instructions).build()
+    return architectures.CentralizedRSCpu(registers=registers, memory=memory)
+
+
+def _setup_scoreboard_cpu(instructions):
+    registers, memory = _looped(instructions).build()
+    return architectures.ScoreboardCpu(registers=registers, memory=memory)
+
+
+def _setup_functional_cpu(instructions):
+    registers, memory = _looped(instructions).build()
+    return architectures.FunctionalCpu(registers=registers, memory=memory)
+
+
+def _run_functional_cpu(cpu):
+    cpu.start()
+    cpu.run()
+    return cpu.get_executed_instructions()
+
+
+def _setup_chronogram(instructions):
+    registers, memory = _straight_line(instructions).build()
+    cpu = architectures.PipelinedCpu(registers=registers, memory=memory)
+    _run_cpu(cpu)
+    return cpu._pipeline_chronogram
+
+
+def _run_chronogram(chronogram):
+    with contextlib.redirect_stdout(io.StringIO()):
+        chronogram.print()
+    return len(chronogram._chronogram)
+
+
+BENCHMARKS = [
+    Benchmark('parser', 'lines', {'small': 100, 'medium': 1000, 'large': 10000},
+              _setup_parser, _run_parser),
+    Benchmark('footprint', 'instructions', {'small': 1000, 'medium': 10000, 'large': 100000},
+              _setup_footprint, _run_footprint, _footprint_metrics),
+    Benchmark('dependency_analyzer', 'instructions', {'small': 50, 'medium': 200, 'large': 800},
+              _setup_dependency_analyzer, _run_dependency_analyzer),
+    Benchmark('pipelined_cpu', 'cycles', {'small': 1000, 'medium': 10000, 'large': 100000},
+              _setup_pipelined_cpu, _run_cpu),
+    Benchmark('centralized_rs_cpu', 'cycles', {'small': 200, 'medium': 1000, 'large': 4000},
+              _setup_centralized_rs_cpu, _run_cpu),
+    Benchmark('scoreboard_cpu', 'cycles', {'small': 1000, 'medium': 10000, 'large': 100000},
+              _setup_scoreboard_cpu, _run_cpu),
+    Benchmark('functional_cpu', 'instructions', {'small': 10000, 'medium': 100000, 'large': 1000000},
+              _setup_functional_cpu, _run_functional_cpu),
+    Benchmark('chronogram', 'instructions', {'small': 100, 'medium': 500, 'large': 2000},
+              _setup_chronogram, _run_chronogram),
+]
+
+
+def run(sizes=SIZES, names=None, repeat=3, report=None):
+    """
+    Runs the benchmarks whose name is in names (all if None) at every size.
+    Returns {'benchmark.size': measure}. report, if given, is called with each key and measure.
+    """
+    results = {}
+    for benchmark in BENCHMARKS:
+        if names and benchmark.name not in names:
+            continue
+        for size in sizes:
+            key = "%s.%s" % (benchmark.name, size)
+            results[key] = benchmark.measure(size, repeat)
+            if report:
+                report(key, results[key])
+    return results
+
+
+def current_revision():
+    """ Short commit hash of the working tree, with a -dirty suffix if tracked files changed """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        revision = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=root, stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=root, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return revision + ('-dirty' if dirty else '')
+
+
+def save(results, revision, results_dir=RESULTS_DIR):
+    """ Writes the results to <results_dir>/<revision>.json and returns the path """
+    os.makedirs(results_dir, exist_ok=True)
+    path = os.path.join(results_dir, "%s.json" % revision)
+    with open(path, 'w') as f:
+        json.dump({
+            'revision': revision,
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+    return path
+
+
+def load(revision, results_dir=RESULTS_DIR):
+    with open(os.path.join(results_dir, "%s.json" % revision)) as f:
+        return json.load(f)
+
+
+def latest_revision(exclude=None, results_dir=RESULTS_DIR):
+    """ Revision of the most recently saved results other than exclude, None if there is none """
+    if not os.path.isdir(results_dir):
+        return None
+    paths = [os.path.join(results_dir, name) for name in os.listdir(results_dir) if name.endswith('.json')]
+    paths = [path for path in paths if os.path.basename(path)[:-len('.json')] != exclude]
+    if not paths:
+        return None
+    return os.path.basename(max(paths, key=os.path.getmtime))[:-len('.json')]
+
+
+def compare(results, reference, threshold=REGRESSION_THRESHOLD):
+    """
+    Compares the median times, and the metrics of the benchmarks that have them, of two result dicts.
+    Returns a list of (key, reference value, value, relative change) and the keys that regressed.
+    Metrics are keyed 'benchmark.size.metric'.
+    """
+    changes = []
+    regressions = []
+    for key, measure in sorted(results.items()):
+        if key not in reference:
+            continue
+        values = [(key, reference[key]['median_seconds'], measure['median_seconds'])]
+        reference_metrics = reference[key].get('metrics', {})
+        values.extend(("%s.%s" % (key, name), reference_metrics[name], value)
+                      for name, value in sorted(measure.get('metrics', {}).items()) if name in reference_metrics)
+        for name, before, after in values:
+            change = (after - before) / before if before else 0.0
+            changes.append((name, before, after, change))
+            if change > threshold:
+                regressions.append(name)
+    return changes, regressions
+
+
+def print_measure(key, measure, file=sys.stdout):
+    print("%-32s %12.4fs %14.0f %s/s %12d peak bytes" % (
+        key, measure['median_seconds'], measure['items_per_second'] or 0, measure['unit'], measure['peak_bytes']),
+        file=file)
+    for name, value in sorted(measure.get('metrics', {}).items()):
+        print("%-32s %12.1f" % ("%s.%s" % (key, name), value), file=file)
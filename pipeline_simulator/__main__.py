@@ -1,35 +1,318 @@
-from pipeline_simulator.core import memories, architectures, instructions, compilers
+"""
+Command line interface of the simulator.
+
+    python -m pipeline_simulator run PROGRAM        Runs a program and prints its counters and final state
+    python -m pipeline_simulator sweep PROGRAM      Runs a program for every combination of CPUs, latencies
+                                                    and scalabilities, one row per run
+    python -m pipeline_simulator analyze PROGRAM    Prints the instruction mix and the dependencies of a program
+    python -m pipeline_simulator fuzz               Runs random programs on every CPU model and reports the ones
+                                                    whose final state differs from the functional CPU
+
+Registers files hold `rN=value` lines and memory files `address=value` lines. Latencies are given as
+MNEMONIC=CYCLES, and in a sweep as MNEMONIC=CYCLES,CYCLES,...
+
+Modules are imported by the command that needs them, so the parser, NumPy or the trace reader are only
+loaded when they are used.
+"""
+import argparse
+import contextlib
+import itertools
 import logging
 import sys
 
 
-class Main:
+logger = logging.getLogger(__name__)
+
+CPUS = {
+    'pipelined': 'PipelinedCpu',
+    'centralized': 'CentralizedRSCpu',
+    'scoreboard': 'ScoreboardCpu',
+    'functional': 'FunctionalCpu',
+}
+FUZZ_MODELS = ('interpreter', 'pipelined', 'memoized', 'centralized', 'scoreboard')  # Names of fuzzing.MODELS
+
+
+def _load(args, cpu_name, **cpu_kwargs):
+    """ Parses the program, loads the registers and memory files and builds the CPU """
+    from pipeline_simulator.core import architectures, compilers, memories
+
+    registers = memories.RegisterSet(registers_file=args.registers, num_registers=args.num_registers)
+    memory = (memories.PagedMemory if args.paged else memories.Memory)(args.memory_size)
+    program = compilers.Parser(registers=registers, memory=memory).parse(args.program)
+    memory.write_program(program)
+    if args.memory:
+        memory.load_file(args.memory)
+    if args.phase_cycles:
+        cpu_kwargs['phase_cycles'] = args.phase_cycles
+    return getattr(architectures, CPUS[cpu_name])(registers=registers, memory=memory, pc=args.pc, **cpu_kwargs)
+
+
+@contextlib.contextmanager
+def _latencies(latencies):
+    """ Sets {mnemonic: cycles} functional unit latencies, which are class attributes, for the duration of a run """
+    from pipeline_simulator.core import instructions
+
+    tables = [instructions.AluInstruction.fu_cycles, instructions.MemInstruction.fu_cycles]
+    saved = [dict(table) for table in tables]
+    try:
+        for mnemonic, cycles in latencies.items():
+            opcode = instructions.Opcode.from_str(mnemonic)
+            table = next((table for table in tables if opcode in table), None)
+            if table is None:
+                raise ValueError("'%s' has no functional unit latency." % mnemonic)
+            table[opcode] = cycles
+        yield
+    finally:
+        for table, values in zip(tables, saved):
+            table.clear()
+            table.update(values)
+
+
+def _simulate(cpu, args, cached=True):
+    """
+    Runs cpu, through the result cache if one was given and cached is set, and returns the result dict.
+    A cache hit never steps the CPU, so runs with side effects such as a trace file must not be cached
+    """
+    from pipeline_simulator.core import results
+
+    if args.cache and cached:
+        return results.ResultCache(args.cache).run(cpu, args.max_cycles, args.watch)
+    cpu.start()
+    cpu.run(args.max_cycles)
+    return results.collect(cpu, args.watch)
+
+
+def _write(text, path):
+    if path is None:
+        print(text)
+    else:
+        with open(path, 'w') as f:
+            f.write(text + "\n")
+
+
+def run(args):
+    from pipeline_simulator.core import counters
+
+    with _latencies(dict(args.latency)):
+        cpu = _load(args, args.cpu, scalability=args.scalability, show_chronogram=args.chronogram,
+                    trace_file=args.trace_file)
+        if args.cache and (args.trace_file or args.chronogram):
+            logger.info("The result cache is not used, the trace file and chronogram need a full run.")
+        result = _simulate(cpu, args, cached=not (args.trace_file or args.chronogram))
+
+    if args.format == 'json':
+        import json
+        _write(json.dumps(result, indent=2), args.output)
+        return 0
+
+    lines = [counters.format_table({args.cpu: result['counters']}), ""]
+    if not result['halted']:
+        lines.append("Stopped before HALT.")
+    lines.append("Registers: " + " ".join(
+        "R%d=%d" % (register_id, value) for register_id, value in enumerate(result['registers']) if value))
+    if args.watch:
+        lines.append("Memory: " + " ".join("%s=%s" % item for item in result['memory'].items()))
+    _write("\n".join(lines), args.output)
+    return 0
+
+
+def sweep(args):
+    from pipeline_simulator.core import counters
 
-    def run(self):
+    latency_axes = [[(mnemonic, cycles) for cycles in values] for mnemonic, values in args.latency]
+    rows = []
+    for cpu_name, scalability, latencies in itertools.product(
+            args.cpu or ['pipelined'], args.scalability or [1], itertools.product(*latency_axes)):
+        with _latencies(dict(latencies)):
+            cpu = _load(args, cpu_name, scalability=scalability)
+            result = _simulate(cpu, args)
+        name = " ".join([cpu_name] + (["x%d" % scalability] if args.scalability else []) +
+                        ["%s=%d" % latency for latency in latencies])
+        rows.append({'name': name, 'cpu': cpu_name, 'scalability': scalability, 'latencies': dict(latencies),
+                     'result': result})
 
-        for opcode, latency in instructions.AluInstruction.fu_cycles.items():
-            instructions.AluInstruction.fu_cycles[opcode] = 4
+    if args.format == 'json':
+        import json
+        _write(json.dumps(rows, indent=2), args.output)
+    elif args.format == 'csv':
+        import csv
+        import io
+        f = io.StringIO()
+        writer = csv.writer(f, lineterminator="\n")
+        stalls = list(rows[0]['result']['counters']['stalls']) if rows else []
+        writer.writerow(['cpu', 'scalability'] + [mnemonic for mnemonic, _ in args.latency] +
+                        ['cycles', 'instructions', 'cpi', 'ipc'] + stalls)
+        for row in rows:
+            values = row['result']['counters']
+            writer.writerow([row['cpu'], row['scalability']] + [row['latencies'][m] for m, _ in args.latency] +
+                            [values['cycles'], values['instructions'], values['cpi'], values['ipc']] +
+                            [values['stalls'][stall] for stall in stalls])
+        _write(f.getvalue().rstrip("\n"), args.output)
+    else:
+        _write(counters.format_table({row['name']: row['result']['counters'] for row in rows}), args.output)
+    return 0
 
-        for opcode, latency in instructions.MemInstruction.fu_cycles.items():
-            if opcode == 'LOAD':
-                instructions.MemInstruction.fu_cycles[opcode] = 6
-            else:
-                instructions.MemInstruction.fu_cycles[opcode] = 4
 
-        logging.basicConfig(stream=sys.stdout, level='INFO')
-        source_file = 'tests/programs/code5.txt'
-        registers = memories.RegisterSet(registers_file='tests/programs/registers5.txt')
-        memory = memories.Memory(2048)
-        parser = compilers.Parser(registers=registers, memory=memory)
-        program = parser.parse(source_file)
+def analyze(args):
+    from pipeline_simulator.core import compilers, counters, memories, instructions
+
+    registers = memories.RegisterSet(num_registers=args.num_registers)
+    memory = (memories.PagedMemory if args.paged else memories.Memory)(args.memory_size)
+    program = compilers.Parser(registers=registers, memory=memory,
+                               print_dependencies=args.dependencies).parse(args.program)
+
+    static = {name: sum(1 for instruction in program if instruction.get_opcode() in opcodes)
+              for name, opcodes in counters.PerformanceCounters.instruction_classes}
+    print("%d instructions: %s" % (len(program), ", ".join("%s %d" % item for item in static.items() if item[1])))
+
+    if args.dynamic:
         memory.write_program(program)
-        memory.set(89, 99)
-        cpu_instance = architectures.CentralizedRSCpu(registers=registers, memory=memory, show_chronogram=True)
+        if args.registers:
+            registers.load_file(args.registers)
+        if args.memory:
+            memory.load_file(args.memory)
+        from pipeline_simulator.core import architectures
+        cpu = architectures.FunctionalCpu(registers=registers, memory=memory, pc=args.pc)
+        executed = counters.PerformanceCounters()  # The functional CPU only counts instructions
+        cpu.start()
+        while not cpu.is_halted() and executed.get_instructions() != args.max_cycles:
+            executed.retire(memory.get_data(cpu.get_pc()).get_opcode())
+            cpu.step()
+        print("%d instructions executed%s: %s" % (
+            executed.get_instructions(), "" if cpu.is_halted() else " before stopping",
+            ", ".join("%s %d" % item for item in executed.get_retired_by_class().items() if item[1])))
+        print("Opcodes: " + ", ".join("%s %d" % item for item in sorted(
+            executed.get_retired().items(), key=lambda item: instructions.Opcode.from_str(item[0]))))
+    return 0
+
+
+def fuzz(args):
+    from pipeline_simulator.core import fuzzing
+
+    models = {name: fuzzing.MODELS[name] for name in args.model} if args.model else None
+    failures = fuzzing.DifferentialFuzzer(seed=args.seed, models=models, workers=args.workers,
+                                          shrink_failures=not args.no_shrink).run(args.cases, args.first_case)
+    if args.format == 'json':
+        import json
+        _write(json.dumps([failure.as_dict() for failure in failures], indent=2), args.output)
+    else:
+        lines = ["%d cases, %d failures." % (args.cases, len(failures))]
+        for failure in failures:
+            lines.append("%r" % failure)
+            if failure.shrunk is not None:
+                lines.extend("    " + line.rstrip("\n") for line in failure.shrunk)
+        _write("\n".join(lines), args.output)
+    return 1 if failures else 0
+
+
+def _latency(text):
+    mnemonic, _, cycles = text.partition('=')
+    try:
+        return mnemonic.upper(), int(cycles)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected MNEMONIC=CYCLES, got '%s'" % text)
+
+
+def _latency_values(text):
+    mnemonic, _, values = text.partition('=')
+    try:
+        return mnemonic.upper(), [int(cycles) for cycles in values.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected MNEMONIC=CYCLES,CYCLES,..., got '%s'" % text)
+
+
+def _phase_cycles(text):
+    try:
+        phases = tuple(int(cycles) for cycles in text.split(','))
+    except ValueError:
+        phases = ()
+    if len(phases) != 5:
+        raise argparse.ArgumentTypeError("expected the cycles of the 5 phases, IF,ID,EX,MEM,WB")
+    return phases
+
+
+def _build_parser():
+    parser = argparse.ArgumentParser(prog='python -m pipeline_simulator', description="Pipelined CPU simulator.")
+    parser.add_argument('--log-level', default='WARNING', help="Logging level (default: WARNING)")
+    subparsers = parser.add_subparsers(dest='command', metavar='COMMAND')
+    subparsers.required = True
+
+    machine = argparse.ArgumentParser(add_help=False)
+    machine.add_argument('program', help="Program source file")
+    machine.add_argument('--registers', metavar='FILE', help="Initial registers, `rN=value` lines")
+    machine.add_argument('--memory', metavar='FILE', help="Initial memory words, `address=value` lines")
+    machine.add_argument('--memory-size', type=int, default=2048, help="Words of memory (default: 2048)")
+    machine.add_argument('--paged', action='store_true',
+                         help="Sparse memory that only allocates the pages written, for large memory sizes")
+    machine.add_argument('--num-registers', type=int, default=32, help="Registers (default: 32)")
+    machine.add_argument('--pc', type=int, default=0, help="Address of the first instruction")
+    machine.add_argument('--max-cycles', type=int, help="Stops every run after that many cycles")
+
+    timing = argparse.ArgumentParser(add_help=False)
+    timing.add_argument('--phase-cycles', type=_phase_cycles, metavar='IF,ID,EX,MEM,WB',
+                        help="Cycles of each pipeline phase")
+    timing.add_argument('--watch', type=int, action='append', default=[], metavar='ADDRESS',
+                        help="Memory address whose final value is reported, can be repeated")
+    timing.add_argument('--cache', metavar='DIR', help="Result cache directory, repeated runs are not simulated")
+    timing.add_argument('--output', metavar='PATH', help="Writes the report to PATH instead of stdout")
+
+    run_parser = subparsers.add_parser('run', parents=[machine, timing], help="Run a program")
+    run_parser.add_argument('--cpu', choices=CPUS, default='pipelined', help="CPU model (default: pipelined)")
+    run_parser.add_argument('--latency', type=_latency, action='append', default=[], metavar='MNEMONIC=CYCLES',
+                            help="Functional unit latency, can be repeated")
+    run_parser.add_argument('--scalability', type=int, default=1, help="Instructions issued per cycle")
+    run_parser.add_argument('--format', choices=('text', 'json'), default='text')
+    run_parser.add_argument('--chronogram', action='store_true', help="Print the chronogram when the CPU halts")
+    run_parser.add_argument('--trace-file', metavar='PATH', help="Record the instructions run to a trace file")
+    run_parser.set_defaults(command=run)
+
+    sweep_parser = subparsers.add_parser('sweep', parents=[machine, timing],
+                                         help="Run a program over a grid of CPUs and latencies")
+    sweep_parser.add_argument('--cpu', choices=CPUS, action='append', help="CPU model, can be repeated")
+    sweep_parser.add_argument('--latency', type=_latency_values, action='append', default=[],
+                              metavar='MNEMONIC=CYCLES,...', help="Latencies to sweep, can be repeated")
+    sweep_parser.add_argument('--scalability', type=lambda text: [int(value) for value in text.split(',')],
+                              metavar='N,...', help="Issue widths to sweep")
+    sweep_parser.add_argument('--format', choices=('text', 'json', 'csv'), default='text')
+    sweep_parser.set_defaults(command=sweep)
+
+    analyze_parser = subparsers.add_parser('analyze', parents=[machine],
+                                           help="Print the instruction mix and dependencies of a program")
+    analyze_parser.add_argument('--dependencies', action='store_true', help="Print the RAW, WAW and WAR dependencies")
+    analyze_parser.add_argument('--dynamic', action='store_true',
+                                help="Also run the program on the functional CPU and print the executed mix")
+    analyze_parser.set_defaults(command=analyze)
+
+    fuzz_parser = subparsers.add_parser('fuzz', help="Differential testing of the CPU models on random programs")
+    fuzz_parser.add_argument('--cases', type=int, default=100, help="Random programs to run (default: 100)")
+    fuzz_parser.add_argument('--seed', default='0', help="Seed of the programs, the same seed gives the same ones")
+    fuzz_parser.add_argument('--first-case', type=int, default=0, help="Index of the first case, to resume a run")
+    fuzz_parser.add_argument('--model', choices=FUZZ_MODELS, action='append',
+                             help="Model to test, can be repeated (default: every model)")
+    fuzz_parser.add_argument('--workers', type=int, help="Worker processes (default: one per CPU)")
+    fuzz_parser.add_argument('--no-shrink', action='store_true', help="Report failing programs as generated")
+    fuzz_parser.add_argument('--format', choices=('text', 'json'), default='text')
+    fuzz_parser.add_argument('--output', metavar='PATH', help="Writes the report to PATH instead of stdout")
+    fuzz_parser.set_defaults(command=fuzz)
+    return parser
+
+
+def main(argv=None):
+    args = _build_parser().parse_args(argv)
+    logging.basicConfig(stream=sys.stderr, level=args.log_level.upper())
 
-        cpu_instance.start()
-        while not cpu_instance.is_halted():
-            cpu_instance.step()
+    from pipeline_simulator.core.architectures import HaltedCpuError, InvalidInstructionError
+    from pipeline_simulator.core.compilers import InstructionSyntaxError
+    from pipeline_simulator.core.memories import InvalidAddressError, RegisterError
+    try:
+        return args.command(args)
+    except (OSError, ValueError, InstructionSyntaxError) as e:
+        print("error: %s" % e, file=sys.stderr)
+        return 1
+    except (ArithmeticError, InvalidAddressError, RegisterError, InvalidInstructionError, HaltedCpuError) as e:
+        print("error: the program faulted: %s" % (str(e) or e.__class__.__name__), file=sys.stderr)
+        return 1
 
 
 if __name__ == '__main__':
-    Main().run()
+    sys.exit(main())
@@ -1,44 +1,150 @@
 import logging
 import collections
-from .instructions import Instruction, HaltInstruction, Bubble, \
-    HaltSignal, RawDependencySignal, JumpSignal, FunctionalUnitNotFinishedSignal
-from .memories import Memory, RegisterSet
+from .instructions import Instruction, MicroOp, MicroOpPool, BUBBLE, Opcode, AluInstruction, MemInstruction, \
+    BranchInstruction, HaltSignal, RawDependencySignal, JumpSignal, FunctionalUnitNotFinishedSignal
+from .memories import Memory, RegisterSet, wrap_word
+from .counters import Counter, PerformanceCounters
 
 
 logger = logging.getLogger(__name__)
 
-_statistics = {
-    'cycles': 0,
-    'instructions': 0,
-}
-
 
 class Cpu:
 
     def __init__(self, registers: RegisterSet, memory: Memory, scalability=1, phase_cycles=(1, 1, 1, 1, 1),
-                 show_chronogram=False):
+                 show_chronogram=False, pc=0, counters_file=None, trace=None, trace_file=None):
+        """
+        trace, a TraceReplay, makes the CPU fetch the instructions of a trace instead of the ones in memory,
+        which can then be None. trace_file records the instructions run by the CPU to that file.
+        """
         self._PHASE_CYCLES = phase_cycles
         self._status = self.CpuStatus.HALTED
         self._registers = registers
         self._memory = memory
-        self._pc = 0
+        self._pc = pc
         self._scalability = scalability
         self._show_chronogram = show_chronogram
+        self._counters = PerformanceCounters(self._NUM_EXECUTION_UNITS)
+        self._counters_file = counters_file  # Counters are written to it as JSON when the CPU halts
+        self._breakpoints = set()
+        self._fetch_instruction = memory.fetch_instruction if trace is None else trace.fetch
+        self._tracer = None
+        if trace_file:
+            from .trace import TraceWriter
+            self._tracer = TraceWriter(trace_file, registers.get_num_registers())
+        self._halt_pc = None  # Address of the HALT being drained, the timing models halt before it retires
+
+    _NUM_EXECUTION_UNITS = 0
 
     class CpuStatus:
         RUNNING = 0
         STOPPING = 1
         HALTED = 2
 
+    class StopReason:
+        """ Why run_until() returned """
+        HALTED = 0
+        MAX_CYCLES = 1
+        CYCLE = 2
+        PC = 3
+        BREAKPOINT = 4
+        WATCHPOINT = 5
+        PREDICATE = 6
+
     def start(self):
         self.set_running()
 
     def step(self):
         pass
 
+    def run(self, max_cycles=None):
+        """
+        Runs until HALT, a breakpoint or a watchpoint, or until max_cycles cycles have been run.
+        Returns the number of cycles run.
+        """
+        cycles = self._counters.values[Counter.CYCLES]
+        self.run_until(max_cycles=max_cycles)
+        return self._counters.values[Counter.CYCLES] - cycles
+
+    def run_until(self, pc=None, cycle=None, predicate=None, max_cycles=None):
+        """
+        Runs cycles until the CPU halts or one of the stop conditions is met and returns its StopReason.
+        Conditions are checked after every cycle: the instruction at pc or at a breakpoint has been fetched,
+        the cycle counter has reached cycle, predicate(cpu) returns true, a watched memory word or register
+        has changed, or max_cycles cycles have been run.
+        """
+        if self.is_halted():
+            raise HaltedCpuError
+
+        reason = self.StopReason
+        step = self.step
+        values = self._counters.values
+        memory = self._memory
+        registers = self._registers
+        breakpoints = self._breakpoints
+        stops = breakpoints if pc is None else breakpoints | {pc}
+        watch_registers = registers.has_watchpoints()
+        watch_memory = memory is not None  # Replaying a trace
+        if watch_memory:
+            memory.clear_watch_hits()
+        registers.clear_watch_hits()
+        cycles = 0
+
+        while True:
+            if cycle is not None and values[Counter.CYCLES] >= cycle:
+                return reason.CYCLE
+            if cycles == max_cycles:
+                return reason.MAX_CYCLES
+
+            last_pc = self._pc
+            step()
+            cycles += 1
+
+            if self.is_halted():
+                return reason.HALTED
+            if stops:
+                fetched = self._get_stop_addresses(last_pc)
+                if pc is not None and pc in fetched:
+                    return reason.PC
+                if not breakpoints.isdisjoint(fetched):
+                    return reason.BREAKPOINT
+            if (watch_memory and memory.has_watch_hits()) or (watch_registers and registers.check_watchpoints()):
+                return reason.WATCHPOINT
+            if predicate is not None and predicate(self):
+                return reason.PREDICATE
+
+    def close_trace(self):
+        """ Completes the trace file of a run stopped before HALT, the CPU cannot go on running afterwards """
+        if self._tracer is not None:
+            self._tracer.close()
+
+    def add_breakpoint(self, addr):
+        self._breakpoints.add(addr)
+
+    def remove_breakpoint(self, addr):
+        self._breakpoints.discard(addr)
+
+    def get_breakpoints(self):
+        return sorted(self._breakpoints)
+
+    def _get_stop_addresses(self, last_pc):
+        """ Addresses of the instructions fetched in the last cycle, which stop run_until() at a breakpoint """
+        pc = self._pc
+        if pc == last_pc:
+            return ()
+        if last_pc < pc <= last_pc + self._scalability:
+            return range(last_pc, pc)
+        return pc - 1,  # Jumped, the target was fetched
+
     def is_halted(self):
         return self._status == self.CpuStatus.HALTED
 
+    def get_pc(self):
+        return self._pc
+
+    def get_counters(self):
+        return self._counters
+
     def is_running(self):
         return self._status == self.CpuStatus.RUNNING
 
@@ -48,6 +154,12 @@ class Cpu:
     def set_halted(self):
         logger.info("CPU status is now HALTED.")
         self._status = self.CpuStatus.HALTED
+        if self._counters_file:
+            self._counters.write_json(self._counters_file)
+        if self._tracer is not None:
+            if self._halt_pc is not None:
+                self._tracer.record(self._halt_pc, Opcode.HALT, 0, 0, 0)
+            self._tracer.close()
 
     def set_stopping(self):
         logger.info("CPU status is now STOPPING.")
@@ -82,7 +194,7 @@ class Chronogram:
     def print(self):
         # Header
         print("\t\t\t\t\t|\t", end='')
-        for i in range(1, _statistics['cycles']+1):
+        for i in range(1, self._current_cycle+1):
             print(str(i) + "\t", end='')
         print("")
 
@@ -138,13 +250,13 @@ class Pipeline:
                 " Programming error "
                 raise RuntimeError
 
-    def __init__(self, phase_cycles, pipeline_chronogram):
+    def __init__(self, phase_cycles, pipeline_chronogram, counters: PerformanceCounters, tracer=None):
         self._pipeline = {
-            self.PipelineStage.IF: Bubble(),
-            self.PipelineStage.ID: Bubble(),
-            self.PipelineStage.EX: Bubble(),
-            self.PipelineStage.MEM: Bubble(),
-            self.PipelineStage.WB: Bubble(),
+            self.PipelineStage.IF: BUBBLE,
+            self.PipelineStage.ID: BUBBLE,
+            self.PipelineStage.EX: BUBBLE,
+            self.PipelineStage.MEM: BUBBLE,
+            self.PipelineStage.WB: BUBBLE,
         }
         self._pipeline_ids = {
             self.PipelineStage.IF: -5,
@@ -162,10 +274,19 @@ class Pipeline:
             self.PipelineStage.WB: phase_cycles[4],
         }
         self._pipeline_chronogram = pipeline_chronogram
+        self._counters = counters
+        self._tracer = tracer
+        self._uops = MicroOpPool()
 
-    def fetch(self, next_instruction: Instruction):
+    def fetch(self, next_instruction: Instruction, pc=-1):
+        """
+        Loads a new dynamic instance of next_instruction, fetched from pc, into the IF stage.
+        BUBBLE is loaded as is
+        """
         self.__move(self.PipelineStage.IF, self.PipelineStage.ID)
         logger.info("Loading into IF stage instruction '%s'." % next_instruction)
+        if isinstance(next_instruction, Instruction):
+            next_instruction = self._uops.acquire(next_instruction, pc)
         self.__set(self.PipelineStage.IF, next_instruction)
         self._pipeline_ids[self.PipelineStage.IF] = self._id_counter
         Pipeline._id_counter += 1
@@ -177,7 +298,7 @@ class Pipeline:
         instruction = self.__get(self.PipelineStage.ID)
 
         # Only count cycles if is not a Bubble
-        if not isinstance(instruction, Bubble):
+        if instruction is not BUBBLE:
             if self.__get_remaining_cycles(self.PipelineStage.ID) > 1:
                 self.__decrease_remaining_cycles(self.PipelineStage.ID)
                 raise StageNotFinishedSignal
@@ -203,7 +324,7 @@ class Pipeline:
         instruction = self.__get(self.PipelineStage.EX)
 
         # Only count cycles if is not a Bubble
-        if not isinstance(instruction, Bubble):
+        if instruction is not BUBBLE:
             if self.__get_remaining_cycles(self.PipelineStage.EX) > 1:
                 self.__decrease_remaining_cycles(self.PipelineStage.EX)
                 raise StageNotFinishedSignal
@@ -217,7 +338,7 @@ class Pipeline:
         instruction = self.__get(self.PipelineStage.MEM)
 
         # Only count cycles if is not a Bubble
-        if not isinstance(instruction, Bubble):
+        if instruction is not BUBBLE:
             if self.__get_remaining_cycles(self.PipelineStage.MEM) > 1:
                 self.__decrease_remaining_cycles(self.PipelineStage.MEM)
                 raise StageNotFinishedSignal
@@ -232,15 +353,18 @@ class Pipeline:
         instruction.writeback()
 
         # Only count cycles if is not a Bubble
-        if not isinstance(instruction, Bubble):
+        if instruction is not BUBBLE:
             if self.__get_remaining_cycles(self.PipelineStage.WB) > 1:
                 self.__decrease_remaining_cycles(self.PipelineStage.WB)
                 raise StageNotFinishedSignal
             else:
                 self.__reset_remaining_cycles(self.PipelineStage.WB)
 
-        if not isinstance(instruction, Bubble):
-            _statistics['instructions'] += 1
+        if instruction is not BUBBLE:
+            self._counters.retire(instruction.get_opcode())
+            if self._tracer is not None:
+                self._tracer.record_uop(instruction)
+            self._uops.release(instruction)
 
     def is_empty(self):
         """ A pipe is empty if after the HALT instruction there's only BUBBLEs """
@@ -249,10 +373,10 @@ class Pipeline:
 
         for stage, instruction in self._pipeline.items():
             if halt_instruction_found:
-                if not isinstance(instruction, Bubble):  # Normal instruction detected after HALT
+                if instruction is not BUBBLE:  # Normal instruction detected after HALT
                     no_more_instructions = False
 
-            if isinstance(instruction, HaltInstruction):
+            if instruction.get_opcode() == Opcode.HALT:
                 halt_instruction_found = True
 
         return halt_instruction_found and no_more_instructions
@@ -261,7 +385,8 @@ class Pipeline:
         """
         Replaces the instruction in the IF stage with a Bubble
         """
-        self.__set(self.PipelineStage.IF, Bubble())
+        self._uops.release(self.__get(self.PipelineStage.IF))
+        self.__set(self.PipelineStage.IF, BUBBLE)
 
     def stall(self, stage):
         """
@@ -270,7 +395,7 @@ class Pipeline:
         of the previous stages are neither moved nor executed.
         """
         if stage != self.PipelineStage.WB:
-            self.__set(stage + 1, Bubble())
+            self.__set(stage + 1, BUBBLE)
 
     def increase_cycle(self):
         self._pipeline_chronogram.increase_cycle()
@@ -280,7 +405,7 @@ class Pipeline:
             instruction = self._pipeline[stage]
             instruction_id = self._pipeline_ids[stage]
 
-            if isinstance(instruction, Instruction) and not isinstance(instruction, Bubble):
+            if instruction is not BUBBLE:
                 self._pipeline_chronogram.set_instruction_stage(instruction_id, instruction.__str__(), stage)
 
     def __move(self, stage_src, stage_dst):
@@ -293,7 +418,7 @@ class Pipeline:
     def __get(self, stage):
         return self._pipeline[stage]
 
-    def __set(self, stage, instruction: Instruction):
+    def __set(self, stage, instruction: MicroOp):
         self._pipeline[stage] = instruction
 
     def __get_remaining_cycles(self, stage):
@@ -319,13 +444,14 @@ class PipelinedCpu(Cpu):
     def __init__(self, *args, **kwargs):
         super(PipelinedCpu, self).__init__(*args, **kwargs)
         self._pipeline_chronogram = Chronogram()
-        self._pipeline = Pipeline(self._PHASE_CYCLES, self._pipeline_chronogram)
+        self._pipeline = Pipeline(self._PHASE_CYCLES, self._pipeline_chronogram, self._counters, self._tracer)
 
     def step(self):
         if self.is_halted():
             raise HaltedCpuError
 
-        logger.info("Processing cycle %d." % _statistics['cycles'])
+        counters = self._counters.values
+        logger.info("Processing cycle %d." % counters[Counter.CYCLES])
         current_stage = None
 
         try:
@@ -341,51 +467,60 @@ class PipelinedCpu(Cpu):
             current_stage = Pipeline.PipelineStage.ID
             self._pipeline.decode()
 
+            fetch_pc = self._pc
             if self.is_running():
                 " If RUNNING, the next instruction is got from the memory "
-                next_instruction = self._memory.get_data(self._pc)
+                next_instruction = self._fetch_instruction(self._pc)
                 self._pc += 1
             elif self.is_stopping():
                 " If STOPPING, the next instruction is a Bubble "
-                next_instruction = Bubble()
+                next_instruction = BUBBLE
             else:
                 " Programming error "
                 raise RuntimeError
 
             current_stage = Pipeline.PipelineStage.IF
-            self._pipeline.fetch(next_instruction)
+            self._pipeline.fetch(next_instruction, fetch_pc)
 
-        except HaltSignal:
+        except HaltSignal as s:
             logger.info("Halt signal received.")
             if self.is_running():
+                self._halt_pc = s.addr
                 self.set_stopping()
                 self._pipeline.flush()  # Last fetched instruction is wrong, it must be a BUBBLE
 
-            self._pipeline.fetch(Bubble())
+            self._pipeline.fetch(BUBBLE)
 
         except RawDependencySignal:
             logger.info("RAW dependency signal received.")
+            counters[Counter.RAW_STALLS] += 1
             self._pipeline.stall(current_stage)
 
         except JumpSignal as s:
             logger.info("Jump signal received.")
+            counters[Counter.BRANCH_FLUSHES] += 1
             self._pipeline.flush()
             self._pc = s.addr
 
             if self.is_running():
                 " If RUNNING, the next instruction is got from the memory "
-                next_instruction = self._memory.get_data(self._pc)
+                next_instruction = self._fetch_instruction(self._pc)
                 self._pc += 1
             elif self.is_stopping():
                 " If STOPPING, the next instruction is a Bubble "
-                next_instruction = Bubble()
+                next_instruction = BUBBLE
             else:
                 " Programming error "
                 raise RuntimeError
 
-            self._pipeline.fetch(next_instruction)
+            self._pipeline.fetch(next_instruction, s.addr)
 
-        except (StageNotFinishedSignal, FunctionalUnitNotFinishedSignal):
+        except StageNotFinishedSignal:
+            counters[Counter.STAGE_LATENCY_STALLS] += 1
+            self._pipeline.stall(current_stage)
+
+        except FunctionalUnitNotFinishedSignal:
+            counters[Counter.FU_BUSY_STALLS] += 1
             self._pipeline.stall(current_stage)
 
         finally:
@@ -394,25 +529,33 @@ class PipelinedCpu(Cpu):
 
             self._pipeline.update_chronogram()
             self._pipeline_chronogram.increase_cycle()
+            counters[Counter.CYCLES] += 1
 
             if self.is_stopping() and self._pipeline.is_empty():
                 if self._show_chronogram:
                     self._pipeline_chronogram.print()
                 self.set_halted()
 
-            _statistics['cycles'] += 1
-
 
 class ExecutionUnit:
+    __slots__ = ('_id', '_instruction', '_instruction_id', '_stage', '_chronogram', '_uops', '_counters', '_tracer',
+                 '_thread_counters')
+    opcodes = (Opcode.HALT,)
 
-    def __init__(self, eu_id, chronogram):
+    def __init__(self, eu_id, chronogram, uops: MicroOpPool, counters: PerformanceCounters, tracer=None,
+                 thread_counters=None):
+        """ thread_counters, the PerformanceCounters of every hardware thread, also counts retirement by thread """
         self._id = eu_id
         self._instruction = None
         self._instruction_id = None
         self._stage = Pipeline.PipelineStage.ID
         self._chronogram = chronogram
+        self._uops = uops
+        self._counters = counters
+        self._tracer = tracer
+        self._thread_counters = thread_counters
 
-    def add(self, instruction: Instruction, instruction_id: int):
+    def add(self, instruction: MicroOp, instruction_id: int):
         self._instruction = instruction
         self._instruction_id = instruction_id
         self.__update_chronogram()
@@ -448,14 +591,24 @@ class ExecutionUnit:
         else:
             raise RuntimeError
 
-    def allows(self, instruction: Instruction):
-        return instruction.get_opcode() == 'HALT'
+    def allows(self, instruction: MicroOp):
+        return instruction.get_opcode() in self.opcodes
 
     def is_free(self):
         return self._instruction is None
 
     def has_halt(self):
-        return isinstance(self._instruction, HaltInstruction)
+        return self._instruction is not None and self._instruction.get_opcode() == Opcode.HALT
+
+    def get_thread(self):
+        return self._instruction.get_thread() if self._instruction is not None else None
+
+    def flush(self):
+        """ Drops the instruction, the HALT of a thread that has finished """
+        self._uops.release(self._instruction)
+        self._instruction = None
+        self._instruction_id = None
+        self._stage = Pipeline.PipelineStage.ID
 
     def get_id(self):
         return self._id
@@ -478,6 +631,12 @@ class ExecutionUnit:
     def __writeback(self):
         logger.info("Executing unit #%d: Writebacking" % self._id)
         self._instruction.writeback()
+        self._counters.retire(self._instruction.get_opcode())
+        if self._thread_counters is not None:
+            self._thread_counters[self._instruction.get_thread()].retire(self._instruction.get_opcode())
+        if self._tracer is not None:
+            self._tracer.record_uop(self._instruction, self._instruction_id)
+        self._uops.release(self._instruction)
         self._instruction = None
         self._instruction_id = None
 
@@ -500,78 +659,136 @@ class ExecutionUnit:
 
 
 class AddExecutionUnit(ExecutionUnit):
-
-    def allows(self, instruction: Instruction):
-        return super(AddExecutionUnit, self).allows(instruction) or \
-               instruction.get_opcode() == 'ADD' or \
-               instruction.get_opcode() == 'SUB'
+    __slots__ = ()
+    opcodes = ExecutionUnit.opcodes + (Opcode.ADD, Opcode.SUB)
 
 
 class MultExecutionUnit(ExecutionUnit):
-
-    def allows(self, instruction: Instruction):
-        return super(MultExecutionUnit, self).allows(instruction) or \
-               instruction.get_opcode() == 'MULT' or \
-               instruction.get_opcode() == 'DIV'
+    __slots__ = ()
+    opcodes = ExecutionUnit.opcodes + (Opcode.MULT, Opcode.DIV)
 
 
 class MemoryExecutionUnit(ExecutionUnit):
-
-    def allows(self, instruction: Instruction):
-        return super(MemoryExecutionUnit, self).allows(instruction) or \
-               instruction.get_opcode() == 'LOAD' or \
-               instruction.get_opcode() == 'STORE'
+    __slots__ = ()
+    opcodes = ExecutionUnit.opcodes + (Opcode.LOAD, Opcode.STORE)
 
 
 class ShelvingBuffer:
     _id_counter = 0
 
-    def __init__(self, execution_units, chronogram):
+    def __init__(self, execution_units, chronogram, uops: MicroOpPool, num_threads=1):
         self._buffer = []
         self._buffer_ids = []
         self._execution_units = execution_units
         self._chronogram = chronogram
+        self._uops = uops
+        self._num_threads = num_threads
+        self._thread_occupancy = [0] * num_threads
 
-    def add(self, instruction: Instruction):
+    def add(self, instruction: Instruction, pc=-1, thread=0):
         instruction_id = ShelvingBuffer._id_counter
         ShelvingBuffer._id_counter += 1
 
-        self._buffer.append(instruction)
+        self._buffer.append(self._uops.acquire(instruction, pc, thread))
         self._buffer_ids.append(instruction_id)
+        self._thread_occupancy[thread] += 1
 
         logger.info("Loading new instruction. Shelving buffer content:\n" + "\n".join(map(str, self._buffer)))
 
         return instruction_id
 
     def dispatch_next_instruction_to_eu(self):
+        """
+        Dispatches the oldest instruction that is the next one of its thread and has a free unit, so every
+        thread dispatches in order. Returns False if no instruction could be dispatched because its units are busy.
+        """
         if len(self._buffer) == 0:
             logger.info("Shelving buffer empty. No instruction loaded into execution unit.")
-            return
+            return True
+
+        heads = set()  # Threads whose next instruction has been tried
+        for index, next_instruction in enumerate(self._buffer):
+            thread = next_instruction.get_thread()
+            if thread in heads:
+                continue
+            heads.add(thread)
 
-        next_instruction = self._buffer[0]
-        next_instruction_id = self._buffer_ids[0]
+            for execution_unit in self._execution_units:
+                if execution_unit.is_free() and execution_unit.allows(next_instruction):
+                    next_instruction_id = self._buffer_ids[index]
+                    del self._buffer[index]
+                    del self._buffer_ids[index]
+                    self._thread_occupancy[thread] -= 1
 
-        for execution_unit in self._execution_units:
-            if execution_unit.is_free() and execution_unit.allows(next_instruction):
-                del self._buffer[0]
-                del self._buffer_ids[0]
+                    logger.info("Loading instruction %s into execution unit #%d" %
+                                (next_instruction, execution_unit.get_id()))
+                    execution_unit.add(next_instruction, next_instruction_id)
+                    return True
 
-                logger.info("Loading instruction %s into execution unit #%d" %
-                            (next_instruction, execution_unit.get_id()))
-                execution_unit.add(next_instruction, next_instruction_id)
+            if len(heads) == self._num_threads:
                 break
-        else:
-            logger.info("All execution units are busy. No instruction caught from shelving buffer.")
+
+        logger.info("All execution units are busy. No instruction caught from shelving buffer.")
+        return False
 
     def is_empty(self):
         return len(self._buffer) == 0
 
+    def get_occupancy(self, thread=None):
+        """ Instructions waiting in the buffer, only the ones of thread if given """
+        return len(self._buffer) if thread is None else self._thread_occupancy[thread]
+
     def update_chronogram(self):
         for i, instruction in enumerate(self._buffer):
             self._chronogram.set_instruction_stage(
                 self._buffer_ids[i], instruction.__str__(), Pipeline.PipelineStage.IF)
 
 
+class HardwareThread:
+    """
+    Architectural state of one hardware thread of a simultaneously multithreaded CPU: its own PC,
+    registers and memory, whose program has been parsed against those registers.
+    fetch_instruction, memory.fetch_instruction by default, fetches its instructions, like the fetch of a
+    trace replay, in which case memory can be None.
+    """
+
+    def __init__(self, registers: RegisterSet, memory: Memory, pc=0, fetch_instruction=None):
+        self._id = 0
+        self._registers = registers
+        self._memory = memory
+        self._pc = pc
+        self._status = Cpu.CpuStatus.HALTED
+        self._fetching = False  # Cleared once the HALT has been fetched
+        self._halt_pc = None
+        self._counters = PerformanceCounters()
+        self._fetch_instruction = fetch_instruction if fetch_instruction is not None else memory.fetch_instruction
+
+    def get_id(self):
+        return self._id
+
+    def get_pc(self):
+        return self._pc
+
+    def get_registers(self):
+        return self._registers
+
+    def get_memory(self):
+        return self._memory
+
+    def get_counters(self):
+        """ Cycles until the thread halted, its retired instructions and the cycles it was stalled by a dependency """
+        return self._counters
+
+    def is_running(self):
+        return self._status == Cpu.CpuStatus.RUNNING
+
+    def is_halted(self):
+        return self._status == Cpu.CpuStatus.HALTED
+
+    def __repr__(self):
+        return "Thread #%d: PC %d, %r" % (self._id, self._pc, self._counters)
+
+
 class ReservationStationsCpu(Cpu):
 
     def __init__(self, *args, **kwargs):
@@ -579,84 +796,186 @@ class ReservationStationsCpu(Cpu):
 
 
 class CentralizedRSCpu(ReservationStationsCpu):
-
-    def __init__(self, *args, **kwargs):
+    """
+    Issues from one shelving buffer shared by four execution units.
+
+    Given `threads`, a list of HardwareThreads, the CPU is simultaneously multithreaded: the registers, memory
+    and PC of the CPU are thread 0, and the other threads share the shelving buffer and the units with it.
+    Each cycle the fetch policy picks the one thread that fetches. Threads dispatch in order, but a thread
+    waiting for a unit or an operand does not hold back the others. The counters of the CPU add up every
+    thread, and each thread has its own (`thread.get_counters()`). Breakpoints and run_until() stop
+    addresses refer to thread 0.
+    """
+
+    _NUM_EXECUTION_UNITS = 4
+
+    class FetchPolicy:
+        ROUND_ROBIN = 'round_robin'
+        ICOUNT = 'icount'  # The thread with the fewest instructions waiting in the shelving buffer
+
+    def __init__(self, *args, threads=(), fetch_policy=FetchPolicy.ROUND_ROBIN, **kwargs):
+        if threads and (kwargs.get('trace') is not None or kwargs.get('trace_file')):
+            raise ValueError("Traces hold a single thread.")
+        if fetch_policy not in (self.FetchPolicy.ROUND_ROBIN, self.FetchPolicy.ICOUNT):
+            raise ValueError("Unknown fetch policy '%s'." % fetch_policy)
         super(CentralizedRSCpu, self).__init__(*args, **kwargs)
+        if self._tracer is not None:  # Units finish out of order, records are written in issue order
+            from .trace import ReorderingTracer
+            self._tracer = ReorderingTracer(self._tracer)
+
+        main_thread = HardwareThread(self._registers, self._memory, self._pc, self._fetch_instruction)
+        self._threads = [main_thread] + list(threads)
+        for thread_id, thread in enumerate(self._threads):
+            thread._id = thread_id
+        self._fetch_policy = fetch_policy
+        self._next_thread = 0  # First candidate of the next fetch
+        thread_counters = None
+        if len(self._threads) > 1:
+            thread_counters = self._counters.threads = [thread.get_counters() for thread in self._threads]
+
         self._chronogram = Chronogram()
+        self._uops = MicroOpPool()
         self._execution_units = [
-            AddExecutionUnit(0, self._chronogram),
-            MultExecutionUnit(1, self._chronogram),
-            MultExecutionUnit(2, self._chronogram),
-            MemoryExecutionUnit(3, self._chronogram),
+            AddExecutionUnit(0, self._chronogram, self._uops, self._counters, self._tracer, thread_counters),
+            MultExecutionUnit(1, self._chronogram, self._uops, self._counters, self._tracer, thread_counters),
+            MultExecutionUnit(2, self._chronogram, self._uops, self._counters, self._tracer, thread_counters),
+            MemoryExecutionUnit(3, self._chronogram, self._uops, self._counters, self._tracer, thread_counters),
         ]
-        self._shelving_buffer = ShelvingBuffer(self._execution_units, self._chronogram)
+        self._shelving_buffer = ShelvingBuffer(self._execution_units, self._chronogram, self._uops,
+                                               len(self._threads))
+
+    def start(self):
+        super(CentralizedRSCpu, self).start()
+        for thread in self._threads:
+            thread._status = self.CpuStatus.RUNNING
+            thread._fetching = True
+
+    def get_threads(self):
+        return list(self._threads)
 
     def step(self):
         if self.is_halted():
             raise HaltedCpuError
 
         try:
-            logger.info("Processing cycle %d." % _statistics['cycles'])
+            logger.info("Processing cycle %d." % self._counters.values[Counter.CYCLES])
 
             self.__execute()
             self.__issue()
 
-        except HaltSignal:
-            logger.info("Halt signal received.")
-            if self.is_running():
-                self.set_stopping()
-
         finally:
             logger.info("Cycle done.\n\n")
 
             self._chronogram.increase_cycle()
-            _statistics['cycles'] += 1
-
-            if self.is_stopping() and self._shelving_buffer.is_empty() and self.__all_eu_empty():
+            self._counters.values[Counter.CYCLES] += 1
+            self._counters.record_occupancy(self._shelving_buffer.get_occupancy())
+            for thread in self._threads:
+                if not thread.is_halted():
+                    thread._counters.values[Counter.CYCLES] += 1
+
+            self.__halt_finished_threads()
+            if self.is_stopping() and all(thread.is_halted() for thread in self._threads):
                 if self._show_chronogram:
                     self._chronogram.print()
                 self.set_halted()
 
     def __issue(self):
-        for _ in range(0, self._scalability):
-            if self.is_running():
-                " If RUNNING, the next instruction is got from the memory "
-                next_instruction = self._memory.get_data(self._pc)
+        thread = self.__select_thread()
+        if thread is not None:
+            for _ in range(0, self._scalability):
+                " The next instruction is got from the memory of the thread "
+                next_instruction = thread._fetch_instruction(thread._pc)
 
                 if not isinstance(next_instruction, Instruction):
                     break  # Ugly fix
 
-                self._pc += 1
-                self._shelving_buffer.add(next_instruction)
-
-        self._shelving_buffer.dispatch_next_instruction_to_eu()
+                instruction_id = self._shelving_buffer.add(next_instruction, thread._pc, thread._id)
+                if self._tracer is not None:
+                    self._tracer.issue(instruction_id)
+                thread._pc += 1
+                if next_instruction.get_opcode() == Opcode.HALT:
+                    thread._fetching = False
+                    break
+            self._pc = self._threads[0]._pc
+
+        if not self._shelving_buffer.dispatch_next_instruction_to_eu():
+            self._counters.values[Counter.STRUCTURAL_STALLS] += 1
         self._shelving_buffer.update_chronogram()
 
+    def __select_thread(self):
+        """ Thread that fetches this cycle, None if every thread has fetched its HALT """
+        threads = self._threads
+        candidates = [thread for thread in threads[self._next_thread:] + threads[:self._next_thread]
+                      if thread._fetching]
+        if not candidates:
+            return None
+        if self._fetch_policy == self.FetchPolicy.ICOUNT and len(candidates) > 1:
+            get_occupancy = self._shelving_buffer.get_occupancy
+            thread = min(candidates, key=lambda candidate: get_occupancy(candidate._id))  # Ties in round-robin order
+        else:
+            thread = candidates[0]
+        self._next_thread = (thread._id + 1) % len(threads)
+        return thread
+
     def __execute(self):
         logger.info("Execution units status:\n" + "\n".join(map(str, self._execution_units)))
-        only_update_chronogram = False
+        counters = self._counters
+        blocked = set()  # Threads whose older instructions wait for their operands
+        fu_busy = False
         for execution_unit in sorted(self._execution_units, key=lambda x: x.get_instruction_id()):
+            thread = execution_unit.get_thread()
+            if not execution_unit.is_free():
+                counters.execution_unit_cycles[execution_unit.get_id()] += 1
             try:
-                execution_unit.execute(only_update_chronogram)
+                execution_unit.execute(thread in blocked)
 
             except RawDependencySignal:
                 logger.info("RawDependencySignal received")
-                only_update_chronogram = True
+                blocked.add(thread)
                 continue
 
             except FunctionalUnitNotFinishedSignal:
                 logger.info("FunctionalUnitNotFinishedSignal received")
+                fu_busy = True
                 continue
 
-    def __all_eu_empty(self):
-        all_eu_empty = True
-        for eu in self._execution_units:
-            if eu.has_halt():
+            except HaltSignal as s:
+                logger.info("Halt signal received.")
+                self.__stop_thread(self._threads[thread], s.addr)
                 continue
-            elif not eu.is_free():
-                all_eu_empty = False
 
-        return all_eu_empty
+        if not self.is_running():
+            return  # Every thread has reached its HALT, the cycles left only drain the units
+
+        if blocked:
+            counters.values[Counter.RAW_STALLS] += 1
+            for thread in blocked:
+                self._threads[thread]._counters.values[Counter.RAW_STALLS] += 1
+        if fu_busy:
+            counters.values[Counter.FU_BUSY_STALLS] += 1
+
+    def __stop_thread(self, thread: HardwareThread, halt_pc):
+        if not thread.is_running():
+            return
+        thread._status = self.CpuStatus.STOPPING
+        thread._fetching = False
+        thread._halt_pc = halt_pc
+        if thread._id == 0:
+            self._halt_pc = halt_pc
+        if all(not thread.is_running() for thread in self._threads):
+            self.set_stopping()
+
+    def __halt_finished_threads(self):
+        """ A stopping thread halts when its HALT is the only instruction it has left, which frees the unit """
+        for thread in self._threads:
+            if thread._status != self.CpuStatus.STOPPING or self._shelving_buffer.get_occupancy(thread._id):
+                continue
+            units = [eu for eu in self._execution_units if eu.get_thread() == thread._id]
+            if all(eu.has_halt() for eu in units):
+                for eu in units:
+                    eu.flush()
+                thread._status = self.CpuStatus.HALTED
+                logger.info("Thread #%d status is now HALTED." % thread._id)
 
 
 class DecentralizedByInstructionsRSCpu(ReservationStationsCpu):
@@ -667,9 +986,525 @@ class DecentralizedByInstructionsRSCpu(ReservationStationsCpu):
         self._execution_units = []
 
 
+class FunctionalUnitStatus:
+    """
+    Scoreboard entry of one execution unit: the instruction it holds, its destination register (Fi), its
+    source registers (Fj, Fk) and the entries of the units that will write them (Qj, Qk), which are None
+    once the source is ready (Rj, Rk)
+    """
+    __slots__ = ('unit', 'uop', 'instruction_id', 'stage', 'destination', 'sources', 'producers',
+                 'remaining_cycles')
+
+    def __init__(self, unit: ExecutionUnit):
+        self.unit = unit
+        self.clear()
+
+    def clear(self):
+        self.uop = None
+        self.instruction_id = -1
+        self.stage = None  # ID while waiting for its operands, EX while executing, WB while waiting to write
+        self.destination = None
+        self.sources = ()
+        self.producers = ()
+        self.remaining_cycles = 0
+
+    def is_busy(self):
+        return self.uop is not None
+
+    def reads(self, register_id):
+        """ Whether the instruction has yet to read register_id, whose value is ready """
+        return self.stage == Pipeline.PipelineStage.ID and any(
+            source == register_id and producer is None for source, producer in zip(self.sources, self.producers))
+
+    def __repr__(self):
+        return "#%d [%s]: Instruction: %s" % (self.unit.get_id(), self.unit.__class__.__name__, self.uop)
+
+
+class ScoreboardCpu(Cpu):
+    """
+    CDC 6600 style scoreboard: instructions issue in order, one per cycle, to the execution units of
+    CentralizedRSCpu, and read their operands, execute and write their results out of order.
+
+    Every instruction goes through four stages, each of them one cycle at least:
+        issue           Takes a free unit that runs its opcode, unless another instruction still has to
+                        write its destination register (WAW). Instructions after it wait meanwhile.
+        read operands   Waits until the units producing its sources have written them (RAW), then reads
+                        them and computes its result.
+        execute         Keeps the unit busy for the functional unit latency of the instruction (fu_cycles).
+        write result    Waits until no unit still has to read the old value of its destination (WAR),
+                        writes it and frees the unit.
+
+    The scoreboard is the FunctionalUnitStatus of every unit plus the register result status, the entry
+    of the unit that will write each register. Branches and jumps have no unit: they are resolved at
+    issue once their sources have been written, and the next cycle issues from their target. Loads and
+    stores share the only memory unit, so memory is accessed in program order. Results are written out
+    of order, so the CPU cannot record traces, but it can replay them.
+    """
+
+    _NUM_EXECUTION_UNITS = 4
+
+    def __init__(self, *args, **kwargs):
+        if kwargs.get('trace_file'):
+            raise ValueError("Results are written out of order, traces are recorded by the other models.")
+        super(ScoreboardCpu, self).__init__(*args, **kwargs)
+        self._chronogram = Chronogram()
+        self._uops = MicroOpPool()
+        self._unit_status = [FunctionalUnitStatus(unit) for unit in (
+            AddExecutionUnit(0, self._chronogram, self._uops, self._counters),
+            MultExecutionUnit(1, self._chronogram, self._uops, self._counters),
+            MultExecutionUnit(2, self._chronogram, self._uops, self._counters),
+            MemoryExecutionUnit(3, self._chronogram, self._uops, self._counters),
+        )]
+        self._register_status = [None] * self._registers.get_num_registers()
+        self._next_uop = None  # Fetched instruction waiting to issue
+        self._next_id = 0
+        self._fetched_pc = None  # Address fetched in the last cycle
+
+    def step(self):
+        if self.is_halted():
+            raise HaltedCpuError
+
+        counters = self._counters
+        logger.info("Processing cycle %d." % counters.values[Counter.CYCLES])
+        self._fetched_pc = None
+        try:
+            busy = sorted((status for status in self._unit_status if status.is_busy()),
+                          key=lambda status: status.instruction_id)
+            for status in busy:
+                counters.execution_unit_cycles[status.unit.get_id()] += 1
+
+            self.__write_results(busy)
+            self.__execute(busy)
+            self.__read_operands(busy)
+            if self.is_running():
+                self.__issue()
+
+        finally:
+            logger.info("Cycle done.\n\n")
+
+            self._chronogram.increase_cycle()
+            counters.values[Counter.CYCLES] += 1
+
+            if self.is_stopping() and not any(status.is_busy() for status in self._unit_status):
+                if self._show_chronogram:
+                    self._chronogram.print()
+                self.set_halted()
+
+    def get_scoreboard(self):
+        """ FunctionalUnitStatus of every unit and the register result status """
+        return list(self._unit_status), list(self._register_status)
+
+    def _get_stop_addresses(self, last_pc):
+        return () if self._fetched_pc is None else (self._fetched_pc,)
+
+    def __write_results(self, busy):
+        war = False
+        for status in busy:
+            if status.stage != Pipeline.PipelineStage.WB:
+                continue
+            self.__update_chronogram(status, Pipeline.PipelineStage.WB)
+            destination = status.destination
+            if destination is not None and any(other.reads(destination) for other in busy if other is not status):
+                war = True
+                continue
+
+            uop = status.uop
+            uop.writeback()
+            self._counters.retire(uop.get_opcode())
+            if destination is not None:
+                self._register_status[destination] = None
+                for other in busy:
+                    if status in other.producers:
+                        other.producers = tuple(None if producer is status else producer
+                                                for producer in other.producers)
+            self._uops.release(uop)
+            status.clear()
+
+        if war:
+            logger.info("WAR dependency, results not written.")
+            self._counters.values[Counter.WAR_STALLS] += 1
+
+    def __execute(self, busy):
+        for status in busy:
+            if status.stage == Pipeline.PipelineStage.EX:
+                self.__update_chronogram(status, Pipeline.PipelineStage.EX)
+                status.remaining_cycles -= 1
+                if status.remaining_cycles == 0:
+                    status.stage = Pipeline.PipelineStage.WB
+
+    def __read_operands(self, busy):
+        raw = False
+        for status in busy:
+            if status.stage != Pipeline.PipelineStage.ID:
+                continue
+            self.__update_chronogram(status, Pipeline.PipelineStage.ID)
+            if any(producer is not None for producer in status.producers):
+                raw = True
+                continue
+
+            # The result is computed while the operands are read, the scoreboard counts the latency
+            uop = status.uop
+            uop._remaining_cycles = 0
+            uop.execute()
+            uop.memory()
+            status.remaining_cycles = uop.get_instruction().get_fu_cycles()
+            status.stage = Pipeline.PipelineStage.EX
+
+        if raw:
+            logger.info("RAW dependency, operands not read.")
+            self._counters.values[Counter.RAW_STALLS] += 1
+
+    def __issue(self):
+        values = self._counters.values
+        uop = self._next_uop
+        if uop is None:
+            instruction = self._fetch_instruction(self._pc)
+            if not isinstance(instruction, Instruction):
+                raise InvalidInstructionError(self._pc)
+            uop = self._next_uop = self._uops.acquire(instruction, self._pc)
+            self._fetched_pc = self._pc
+            self._pc += 1
+
+        register_status = self._register_status
+        sources = tuple(register.get_id() for register in uop.get_read_registers())
+        opcode = uop.get_opcode()
+        if opcode in AluInstruction.opcodes or opcode in MemInstruction.opcodes:
+            status = next((status for status in self._unit_status
+                           if not status.is_busy() and status.unit.allows(uop)), None)
+            if status is None:
+                logger.info("All execution units are busy, instruction not issued.")
+                values[Counter.STRUCTURAL_STALLS] += 1
+                return
+            written = uop.get_written_registers()
+            destination = written[0].get_id() if written else None
+            if destination is not None and register_status[destination] is not None:
+                logger.info("WAW dependency, instruction not issued.")
+                values[Counter.WAW_STALLS] += 1
+                return
+
+            status.uop = uop
+            status.instruction_id = self._next_id
+            status.stage = Pipeline.PipelineStage.ID
+            status.destination = destination
+            status.sources = sources
+            status.producers = tuple(register_status[source] for source in sources)
+            if destination is not None:
+                register_status[destination] = status
+            self._next_id += 1
+            self.__update_chronogram(status, Pipeline.PipelineStage.IF)
+
+        else:  # Branches, jumps and HALT
+            if any(register_status[source] is not None for source in sources):
+                logger.info("RAW dependency, branch not issued.")
+                values[Counter.RAW_STALLS] += 1
+                return
+            try:
+                uop.decode()
+                self._counters.retire(opcode)
+            except JumpSignal as s:
+                self._pc = s.addr
+                self._counters.retire(opcode)
+            except HaltSignal as s:
+                logger.info("Halt signal received.")
+                self._halt_pc = s.addr
+                self.set_stopping()
+            self._uops.release(uop)
+
+        self._next_uop = None
+
+    def __update_chronogram(self, status, stage):
+        if self._show_chronogram:  # Only printed at the end of the run
+            self._chronogram.set_instruction_stage(status.instruction_id, str(status.uop), stage)
+
+
+class FunctionalCpu(Cpu):
+    """
+    ISA-only simulator: every step executes one whole instruction, with no pipeline or timing.
+    It is the golden reference for the timing models, and fast-forwards programs whose state can
+    then be handed to a timing model (through its `pc` argument) or to a checkpoint.
+
+    Runs of more than one instruction execute whole basic blocks translated into Python functions
+    (see translation.BlockCache), unless block_translation is False, a trace is being recorded or memory
+    watchpoints are set, which go through the per-instruction interpreter.
+    """
+
+    _ALU, _LOAD, _STORE, _BRANCH, _JUMP, _HALT, _BREAKPOINT = range(7)
+
+    def __init__(self, *args, block_translation=True, **kwargs):
+        if kwargs.get('trace') is not None:
+            raise ValueError("Traces are replayed by the timing models.")
+        super(FunctionalCpu, self).__init__(*args, **kwargs)
+        self._decoded = {}
+        self._blocks = None
+        if block_translation:
+            from .translation import BlockCache
+            self._blocks = BlockCache(self._memory, self._decoded)
+
+    def step(self):
+        if self.is_halted():
+            raise HaltedCpuError
+
+        self.__execute(1)
+
+    def run_until(self, pc=None, cycle=None, predicate=None, max_cycles=None):
+        """
+        Every instruction takes one cycle, and an instruction at pc or at a breakpoint stops the CPU
+        before it is executed. Breakpoints and memory watchpoints are checked inside the interpreter loop;
+        a predicate or a register watchpoint has to be checked after every instruction, which falls back
+        to the generic loop of Cpu.
+        """
+        if predicate is not None or self._registers.has_watchpoints():
+            return super(FunctionalCpu, self).run_until(pc, cycle, predicate, max_cycles)
+        if self.is_halted():
+            raise HaltedCpuError
+
+        values = self._counters.values
+        limit = max_cycles
+        if cycle is not None:
+            remaining = max(cycle - values[Counter.CYCLES], 0)
+            limit = remaining if limit is None else min(limit, remaining)
+
+        self._memory.clear_watch_hits()
+        temporary = pc is not None and pc not in self._breakpoints
+        if temporary:
+            self.add_breakpoint(pc)
+        try:
+            reason = self.__execute(limit)
+        finally:
+            if temporary:
+                self.remove_breakpoint(pc)
+
+        if reason == self.StopReason.BREAKPOINT and self._pc == pc:
+            return self.StopReason.PC
+        if reason is None:
+            if cycle is not None and values[Counter.CYCLES] >= cycle:
+                return self.StopReason.CYCLE
+            return self.StopReason.MAX_CYCLES
+        return reason
+
+    def add_breakpoint(self, addr):
+        super(FunctionalCpu, self).add_breakpoint(addr)
+        self._decoded.pop(addr, None)  # Decoded again as a breakpoint
+        if self._blocks is not None:
+            self._blocks.invalidate(addr)  # Blocks end before breakpoints
+
+    def remove_breakpoint(self, addr):
+        super(FunctionalCpu, self).remove_breakpoint(addr)
+        self._decoded.pop(addr, None)
+
+    def _get_stop_addresses(self, last_pc):
+        return self._pc,
+
+    def __execute(self, limit):
+        """
+        Executes instructions until HALT, a breakpoint, a watched memory word changing or until limit
+        instructions have been executed. Returns the StopReason, or None if the limit was reached.
+        The instruction at the current PC is executed even if it has a breakpoint, so a CPU stopped
+        at a breakpoint can go on.
+        """
+        pc = self._pc
+        if limit != 0 and pc in self._breakpoints:
+            self._decoded[pc] = self.__decode_instruction(pc)
+            try:
+                reason = self.__loop(1)
+            finally:
+                self._decoded.pop(pc, None)
+            if reason is not None or limit == 1:
+                return reason
+            limit = None if limit is None else limit - 1
+        return self.__loop(limit)
+
+    def __loop(self, limit):
+        if self._tracer is not None:
+            return self.__traced_loop(limit)
+        if self._blocks is None or limit == 1 or self._memory._watchpoints:
+            return self.__fast_loop(limit)
+        return self.__block_loop(limit)
+
+    def __block_loop(self, limit):
+        """
+        Executes translated blocks while the whole block fits in limit. Breakpoints, words that are not
+        instructions and the instructions left before limit go through the interpreter.
+        """
+        blocks = self._blocks
+        breakpoints = self._breakpoints
+        values = self._registers._values
+        counters = self._counters.values
+        first = counters[Counter.INSTRUCTIONS]
+
+        while True:
+            executed = counters[Counter.INSTRUCTIONS] - first
+            if executed == limit:
+                return None
+            block = blocks.get(self._pc, breakpoints)
+            if block is None or (limit is not None and block.length > limit - executed):
+                reason = self.__fast_loop(1 if block is None else limit - executed)
+                if reason is not None:
+                    return reason
+                continue
+
+            pc, count, halted, error = block.run(values, 0 if limit is None else (limit - executed) // block.length)
+            self._pc = pc
+            counters[Counter.CYCLES] += count
+            counters[Counter.INSTRUCTIONS] += count
+            if error is not None:
+                self.__fast_loop(1)  # Executes the faulting instruction again, which raises the same error
+                raise error
+            if halted:
+                self.set_halted()
+                return self.StopReason.HALTED
+
+    def __traced_loop(self, limit):
+        """
+        Executes one instruction at a time to record it, along with its effective address and branch outcome
+        """
+        values = self._registers._values
+        executed = 0
+        while executed != limit:
+            pc = self._pc
+            entry = self._decoded.get(pc)
+            at_breakpoint = entry[0] == self._BREAKPOINT if entry is not None else pc in self._breakpoints
+            instruction = self._memory.get_data(pc)
+            if not at_breakpoint and isinstance(instruction, Instruction):
+                opcode, a, b, c = instruction.encode()
+                addr = values[b] + c if opcode in MemInstruction.opcodes else -1
+                taken = opcode in BranchInstruction.opcodes and \
+                    BranchInstruction.conditions[opcode](values[a], values[b])
+                self._tracer.record(pc, opcode, a, b, c, addr, taken)  # Before HALT closes the trace
+
+            reason = self.__fast_loop(1)
+            executed += 1
+            if reason is not None:
+                return reason
+        return None
+
+    def __fast_loop(self, limit):
+        """
+        Only the cycle and instruction counters are updated, per opcode counts would slow the loop down.
+        """
+        alu, load, store, branch, jump, halt = self._ALU, self._LOAD, self._STORE, self._BRANCH, self._JUMP, \
+            self._HALT
+        values = self._registers._values
+        memory = self._memory
+        watch_hits = memory._watch_hits
+        decoded = self._decoded
+        blocks = self._blocks
+        code = blocks._owners if blocks is not None else ()
+        pc = self._pc
+        executed = 0
+        reason = None
+        if limit is None:
+            limit = -1
+
+        try:
+            while executed != limit:
+                try:
+                    kind, function, a, b, c = decoded[pc]
+                except KeyError:
+                    kind, function, a, b, c = decoded[pc] = self.__decode(pc)
+                executed += 1
+
+                if kind == alu:
+                    result = function(values[b], values[c])
+                    try:
+                        values[a] = result
+                    except OverflowError:
+                        values[a] = wrap_word(result)
+                    pc += 1
+
+                elif kind == load:
+                    result = memory.get_data(values[b] + c)
+                    try:
+                        values[a] = result
+                    except OverflowError:
+                        values[a] = wrap_word(result)
+                    pc += 1
+
+                elif kind == store:
+                    addr = values[b] + c
+                    memory.set(addr, values[a])
+                    if addr in decoded or addr in code:  # Self-modifying code
+                        decoded.pop(addr, None)
+                        if blocks is not None:
+                            blocks.invalidate(addr)
+                    pc += 1
+                    if watch_hits:
+                        reason = self.StopReason.WATCHPOINT
+                        break
+
+                elif kind == branch:
+                    pc = c if function(values[a], values[b]) else pc + 1
+
+                elif kind == jump:
+                    pc = c
+
+                elif kind == halt:
+                    reason = self.StopReason.HALTED
+                    break
+
+                else:  # kind == breakpoint, the instruction is not executed
+                    executed -= 1
+                    reason = self.StopReason.BREAKPOINT
+                    break
+        finally:
+            self._pc = pc
+            counters = self._counters.values
+            counters[Counter.CYCLES] += executed
+            counters[Counter.INSTRUCTIONS] += executed
+
+        if reason == self.StopReason.HALTED:
+            self.set_halted()
+        return reason
+
+    def reset(self, pc=0):
+        """
+        Halts the CPU and clears its counters so it can run again from pc. Decoded instructions and blocks are kept,
+        so a program run many times with different inputs is only decoded once.
+        """
+        self._status = self.CpuStatus.HALTED
+        self._pc = pc
+        self._counters = PerformanceCounters(self._NUM_EXECUTION_UNITS)
+
+    def get_executed_instructions(self):
+        return self._counters.values[Counter.INSTRUCTIONS]
+
+    def __decode(self, pc):
+        if pc in self._breakpoints:
+            return self._BREAKPOINT, None, 0, 0, 0
+        return self.__decode_instruction(pc)
+
+    def __decode_instruction(self, pc):
+        instruction = self._memory.get_data(pc)
+        if not isinstance(instruction, Instruction):
+            raise InvalidInstructionError(pc)
+
+        opcode, a, b, c = instruction.encode()
+        if opcode in AluInstruction.opcodes:
+            return self._ALU, AluInstruction.operations[opcode], a, b, c
+        elif opcode == Opcode.LOAD:
+            return self._LOAD, None, a, b, c
+        elif opcode == Opcode.STORE:
+            return self._STORE, None, a, b, c
+        elif opcode in BranchInstruction.opcodes:
+            return self._BRANCH, BranchInstruction.conditions[opcode], a, b, c
+        elif opcode == Opcode.JMP:
+            return self._JUMP, None, a, b, c
+        else:
+            return self._HALT, None, a, b, c
+
+
 class HaltedCpuError(Exception):
     pass
 
 
+class InvalidInstructionError(Exception):
+
+    def __init__(self, addr):
+        self._addr = addr
+
+    def __str__(self):
+        return "Word at address %d is not an instruction." % self._addr
+
+
 class StageNotFinishedSignal(Exception):
     pass
@@ -0,0 +1,201 @@
+import array
+import logging
+from . import architectures
+from .compilers import Parser
+from .instructions import Instruction
+from .memories import Memory, RegisterSet, InvalidAddressError, WORD_TYPECODE, wrap_word
+
+
+logger = logging.getLogger(__name__)
+
+
+class BatchRunner:
+    """
+    Runs one program against many initial register and memory images.
+
+    The program is parsed once into a RegisterSet and a Memory that are reused by every run: before each
+    run the registers are reset to the image and the memory to its state right after loading the program,
+    plus the data of the memory image. A FunctionalCpu is also reused, so it only decodes the program once.
+    """
+
+    def __init__(self, source, memory_size=2048, cpu_class=architectures.FunctionalCpu, num_registers=32,
+                 pc=0, memory_class=Memory, **cpu_kwargs):
+        """
+        source is the path of a program file or a list of source lines. With memory_class PagedMemory
+        resetting the memory before a run only copies the pages written by the previous run.
+        """
+        self._registers = RegisterSet(num_registers=num_registers)
+        self._memory = memory_class(memory_size)
+        parser = Parser(registers=self._registers, memory=self._memory)
+        if isinstance(source, str):
+            self._program = parser.parse(source)
+        else:
+            self._program = parser.parse_lines(source)
+        self._memory.write_program(self._program)
+
+        self._memory_snapshot = self._memory.snapshot()
+        self._empty_registers = self._registers.snapshot()
+        self._cpu_class = cpu_class
+        self._pc = pc
+        self._cpu_kwargs = cpu_kwargs
+        self._cpu = None
+
+    def get_registers(self):
+        return self._registers
+
+    def get_memory(self):
+        return self._memory
+
+    def run(self, registers_images, memory_images=None, watch=(), max_cycles=None):
+        """
+        Runs the program once per registers image, which can be the path of a registers file, a dict
+        {register id: value} or a sequence with the value of every register. memory_images, if given,
+        holds a dict {address: value} per run. watch lists the memory addresses whose final value is kept.
+        max_cycles bounds every run, the runs cut short are flagged in the result.
+        """
+        registers_images = list(registers_images)
+        if memory_images is not None:
+            memory_images = list(memory_images)
+            if len(memory_images) != len(registers_images):
+                raise ValueError("There must be one memory image per registers image.")
+
+        result = BatchResult(len(registers_images), self._registers.get_num_registers(), watch)
+        for run, registers_image in enumerate(registers_images):
+            self.__load(registers_image, memory_images[run] if memory_images is not None else None)
+            cpu = self.__run_cpu(max_cycles)
+            result._record(run, self._registers, self._memory, cpu)
+
+        logger.info("Batch of %d runs done." % len(registers_images))
+        return result
+
+    def run_lockstep(self, registers_images, memory_images=None, watch=(), max_steps=None):
+        """
+        Same as run(), but every run is executed at once by a vectorized LockstepCpu (needs NumPy).
+        Timing is not simulated, so the cycles of each run are its executed instructions.
+        """
+        import numpy
+        from .vectorized import LockstepCpu
+
+        registers_images = list(registers_images)
+        num_runs = len(registers_images)
+        registers = numpy.empty((num_runs, self._registers.get_num_registers()), dtype=numpy.int64)
+        for run, registers_image in enumerate(registers_images):
+            self.__load_registers(registers_image)
+            registers[run] = self._registers.snapshot()[0]
+
+        data = [word if isinstance(word, int) else 0 for word in self._memory_snapshot]
+        memory = numpy.tile(numpy.array(data, dtype=numpy.int64), (num_runs, 1))
+        if memory_images is not None:
+            memory_images = list(memory_images)
+            if len(memory_images) != num_runs:
+                raise ValueError("There must be one memory image per registers image.")
+            for run, memory_image in enumerate(memory_images):
+                for addr, value in (memory_image or {}).items():
+                    if not 0 <= addr < len(data):
+                        raise InvalidAddressError(addr)
+                    if addr < len(self._program) and isinstance(self._program[addr], Instruction):
+                        raise ValueError("Memory images cannot overwrite the program in lock-step runs.")
+                    memory[run, addr] = value
+
+        cpu = LockstepCpu(self._program, registers, memory, pc=self._pc)
+        cpu.run(max_steps)
+
+        result = BatchResult(num_runs, self._registers.get_num_registers(), watch)
+        arrays = result.as_numpy()
+        arrays['registers'][:] = cpu.get_registers()
+        if result.watch:
+            arrays['memory'][:] = cpu.get_memory()[:, list(result.watch)]
+        arrays['cycles'][:] = cpu.get_executed_instructions()
+        arrays['instructions'][:] = cpu.get_executed_instructions()
+        numpy.frombuffer(result.halted, dtype=numpy.int8)[:] = cpu.get_halted()
+        return result
+
+    def __load(self, registers_image, memory_image):
+        self._memory.restore(self._memory_snapshot)
+        self.__load_registers(registers_image)
+
+        if memory_image:
+            for addr, value in memory_image.items():
+                self._memory.set(addr, value)
+
+    def __load_registers(self, registers_image):
+        self._registers.restore(self._empty_registers)
+
+        if isinstance(registers_image, str):
+            self._registers.load_file(registers_image)
+        elif isinstance(registers_image, dict):
+            for register_id, value in registers_image.items():
+                self._registers.get(register_id).set(value)
+        else:
+            if len(registers_image) != self._registers.get_num_registers():
+                raise ValueError("Registers image of %d values for %d registers."
+                                 % (len(registers_image), self._registers.get_num_registers()))
+            self._registers.restore((array.array(WORD_TYPECODE, map(wrap_word, registers_image)),
+                                     self._empty_registers[1]))
+
+    def __run_cpu(self, max_cycles):
+        if self._cpu_class is architectures.FunctionalCpu:
+            if self._cpu is None:
+                self._cpu = architectures.FunctionalCpu(
+                    registers=self._registers, memory=self._memory, pc=self._pc, **self._cpu_kwargs)
+            else:
+                self._cpu.reset(self._pc)
+            cpu = self._cpu
+            cpu.start()
+            cpu.run(max_cycles)
+            return cpu
+
+        cpu = self._cpu_class(registers=self._registers, memory=self._memory, pc=self._pc, **self._cpu_kwargs)
+        cpu.start()
+        cpu.run(max_cycles)
+        return cpu
+
+
+class BatchResult:
+    """
+    Final state of every run of a batch, stored in flat arrays: `registers` holds num_registers values
+    per run, `memory` the value of every watched address per run, and `cycles`, `instructions` and
+    `halted` one entry per run.
+    """
+
+    def __init__(self, num_runs, num_registers, watch):
+        self.num_runs = num_runs
+        self.num_registers = num_registers
+        self.watch = tuple(watch)
+        self.registers = array.array(WORD_TYPECODE, [0]) * (num_runs * num_registers)
+        self.memory = array.array(WORD_TYPECODE, [0]) * (num_runs * len(self.watch))
+        self.cycles = array.array(WORD_TYPECODE, [0]) * num_runs
+        self.instructions = array.array(WORD_TYPECODE, [0]) * num_runs
+        self.halted = array.array('b', [0]) * num_runs
+
+    def _record(self, run, registers: RegisterSet, memory: Memory, cpu: architectures.Cpu):
+        num_registers = self.num_registers
+        self.registers[run * num_registers:(run + 1) * num_registers] = registers.snapshot()[0]
+        for i, addr in enumerate(self.watch):
+            self.memory[run * len(self.watch) + i] = memory.get_data(addr)
+        counters = cpu.get_counters()
+        self.cycles[run] = counters.get_cycles()
+        self.instructions[run] = counters.get_instructions()
+        self.halted[run] = cpu.is_halted()
+
+    def get_registers(self, run):
+        return self.registers[run * self.num_registers:(run + 1) * self.num_registers]
+
+    def get_memory(self, run):
+        """ {watched address: final value} of a run """
+        width = len(self.watch)
+        return dict(zip(self.watch, self.memory[run * width:(run + 1) * width]))
+
+    def as_numpy(self):
+        """
+        Dict of NumPy arrays: 'registers' (runs x registers), 'memory' (runs x watched addresses),
+        'cycles', 'instructions' and 'halted'
+        """
+        import numpy
+        return {
+            'registers': numpy.frombuffer(self.registers, dtype=numpy.int64).reshape(self.num_runs, -1),
+            'memory': numpy.frombuffer(self.memory, dtype=numpy.int64).reshape(self.num_runs, len(self.watch)),
+            'cycles': numpy.frombuffer(self.cycles, dtype=numpy.int64),
+            'instructions': numpy.frombuffer(self.instructions, dtype=numpy.int64),
+            'halted': numpy.frombuffer(self.halted, dtype=numpy.int8).astype(bool),
+        }
@@ -0,0 +1,249 @@
+import hashlib
+import io
+import logging
+import os
+import pickle
+import zlib
+from . import architectures
+from .instructions import Instruction, BUBBLE
+from .memories import Memory, PagedMemory, Register, RegisterSet
+
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 4
+DEFAULT_PAGE_SIZE = 1024
+
+
+class Checkpoint:
+    """
+    Snapshot of a whole Cpu: pipeline or shelving buffer contents, execution units, registers,
+    memory, PC, status and performance counters.
+
+    Memory is stored in pages. Pages full of zeros are omitted, and a checkpoint taken with a `base`
+    only stores the pages whose content changed since that base, so restoring it needs the base too.
+    Registers, the Memory and the program words are pickled by reference, which keeps the CPU state
+    small and makes every restored object point to the restored register file and memory.
+    """
+
+    def __init__(self, cpu_state, registers, memory_size, page_size, pages, digests, global_state, base=None):
+        self._cpu_state = cpu_state
+        self._registers = registers
+        self._memory_size = memory_size
+        self._page_size = page_size
+        self._pages = pages
+        self._digests = digests
+        self._global_state = global_state
+        self._base = base
+        self._path = None
+
+    @classmethod
+    def capture(cls, cpu: architectures.Cpu, base=None, page_size=None):
+        """
+        Takes a checkpoint of cpu. If base is given only the memory pages that differ from it are kept.
+        """
+        if base is not None:
+            if page_size is not None and page_size != base._page_size:
+                raise CheckpointError("Page size must match the one of the base checkpoint.")
+            page_size = base._page_size
+        elif page_size is None:
+            page_size = DEFAULT_PAGE_SIZE
+
+        registers = cpu._registers
+        memory = cpu._memory
+        if isinstance(memory, PagedMemory):
+            raise CheckpointError("Checkpoints of a PagedMemory are not supported.")
+        memory_size = memory.get_size()
+
+        # Memory pages
+        pages = {}
+        digests = []
+        program = {}  # Program words are pickled by address in the CPU state
+        base_digests = base._digests if base is not None else None
+        zero_digest = None
+        for page_number, addr in enumerate(range(0, memory_size, page_size)):
+            words = memory.get_block(addr, min(page_size, memory_size - addr))
+            for offset, word in enumerate(words):
+                if isinstance(word, Instruction):
+                    program[id(word)] = addr + offset
+
+            data = _dumps(words, registers, memory, program=None)
+            digest = hashlib.sha1(data).digest()
+            digests.append(digest)
+
+            if base_digests is not None:
+                if page_number < len(base_digests) and base_digests[page_number] == digest:
+                    continue
+            else:
+                if zero_digest is None or len(words) != page_size:
+                    zero_digest = hashlib.sha1(_dumps([0] * len(words), registers, memory, None)).digest()
+                if digest == zero_digest:
+                    continue
+            pages[page_number] = data
+
+        logger.info("Checkpoint keeps %d of %d memory pages." % (len(pages), len(digests)))
+
+        values, locks = registers.snapshot()
+        return cls(
+            cpu_state=_dumps(cpu, registers, memory, program),
+            registers=(values.tobytes(), locks.tobytes(), values.typecode),
+            memory_size=memory_size,
+            page_size=page_size,
+            pages=pages,
+            digests=digests,
+            global_state=_capture_global_state(),
+            base=base)
+
+    def restore(self, restore_globals=True):
+        """
+        Builds a new Cpu, with its own RegisterSet and Memory, from the checkpoint.
+        Can be called many times to fork several simulations from the same point.
+        """
+        import array
+        values_bytes, locks_bytes, typecode = self._registers
+        values = array.array(typecode)
+        values.frombytes(values_bytes)
+        locks = array.array(typecode)
+        locks.frombytes(locks_bytes)
+        registers = RegisterSet(num_registers=len(values))
+        registers.restore((values, locks))
+
+        memory = Memory(self._memory_size)
+        for page_number, data in sorted(self._collect_pages().items()):
+            words = _loads(data, registers, memory)
+            memory.set_block(page_number * self._page_size, words)
+
+        cpu = _loads(self._cpu_state, registers, memory)
+        if restore_globals:
+            _restore_global_state(self._global_state)
+        return cpu
+
+    def get_base(self):
+        return self._base
+
+    def get_num_pages(self):
+        return len(self._pages)
+
+    def save(self, path):
+        base_path = None
+        if self._base is not None:
+            if self._base._path is None:
+                raise CheckpointError("The base checkpoint must be saved before its incremental checkpoints.")
+            base_path = os.path.relpath(os.path.abspath(self._base._path), os.path.dirname(os.path.abspath(path)))
+
+        payload = {
+            'version': FORMAT_VERSION,
+            'cpu': self._cpu_state,
+            'registers': self._registers,
+            'memory_size': self._memory_size,
+            'page_size': self._page_size,
+            'pages': self._pages,
+            'digests': self._digests,
+            'globals': self._global_state,
+            'base': base_path,
+        }
+        with open(path, 'wb') as f:
+            f.write(zlib.compress(pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL)))
+        self._path = path
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            try:
+                payload = pickle.loads(zlib.decompress(f.read()))
+            except (zlib.error, pickle.UnpicklingError, EOFError):
+                raise CheckpointError("'%s' is not a checkpoint file." % path)
+
+        if payload.get('version') != FORMAT_VERSION:
+            raise CheckpointError("Unsupported checkpoint version in '%s'." % path)
+
+        base = None
+        if payload['base'] is not None:
+            base = cls.load(os.path.join(os.path.dirname(os.path.abspath(path)), payload['base']))
+
+        checkpoint = cls(
+            cpu_state=payload['cpu'],
+            registers=payload['registers'],
+            memory_size=payload['memory_size'],
+            page_size=payload['page_size'],
+            pages=payload['pages'],
+            digests=payload['digests'],
+            global_state=payload['globals'],
+            base=base)
+        checkpoint._path = path
+        return checkpoint
+
+    def _collect_pages(self):
+        pages = self._base._collect_pages() if self._base is not None else {}
+        pages.update(self._pages)
+        return pages
+
+
+class _Pickler(pickle.Pickler):
+
+    def __init__(self, file, registers, memory, program):
+        super(_Pickler, self).__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._registers = registers
+        self._memory = memory
+        self._program = program
+
+    def persistent_id(self, obj):
+        if obj is BUBBLE:
+            return 'bubble',
+        elif obj is self._registers:
+            return 'registers',
+        elif obj is self._memory:
+            return 'memory',
+        elif isinstance(obj, Register):
+            return 'register', obj.get_id()
+        elif self._program and isinstance(obj, Instruction) and id(obj) in self._program:
+            return 'word', self._program[id(obj)]
+        return None
+
+
+class _Unpickler(pickle.Unpickler):
+
+    def __init__(self, file, registers, memory):
+        super(_Unpickler, self).__init__(file)
+        self._registers = registers
+        self._memory = memory
+
+    def persistent_load(self, pid):
+        kind = pid[0]
+        if kind == 'bubble':
+            return BUBBLE
+        elif kind == 'registers':
+            return self._registers
+        elif kind == 'memory':
+            return self._memory
+        elif kind == 'register':
+            return self._registers.get(pid[1])
+        elif kind == 'word':
+            return self._memory.get_data(pid[1])
+        raise pickle.UnpicklingError("Unknown persistent id %r." % (pid,))
+
+
+def _dumps(obj, registers, memory, program):
+    f = io.BytesIO()
+    _Pickler(f, registers, memory, program).dump(obj)
+    return f.getvalue()
+
+
+def _loads(data, registers, memory):
+    return _Unpickler(io.BytesIO(data), registers, memory).load()
+
+
+def _capture_global_state():
+    return {
+        'pipeline_id_counter': architectures.Pipeline._id_counter,
+        'shelving_buffer_id_counter': architectures.ShelvingBuffer._id_counter,
+    }
+
+
+def _restore_global_state(state):
+    architectures.Pipeline._id_counter = state['pipeline_id_counter']
+    architectures.ShelvingBuffer._id_counter = state['shelving_buffer_id_counter']
+
+
+class CheckpointError(Exception):
+    pass
@@ -7,11 +7,11 @@ logger = logging.getLogger(__name__)
 
 class DependencyAnalyzer:
 
-    _tmp = []
-    _count = 0
-    _raw = []
-    _waw = []
-    _war = []
+    def __init__(self):
+        self._tmp = []
+        self._raw = []
+        self._waw = []
+        self._war = []
 
     def add_instruction(self, inst: instructions.Instruction):
         self._tmp.append(inst)
@@ -62,8 +62,6 @@ class Parser:
     _instruction_regex = r"^((?P<label>\w*):\s)?(?P<opcode>\w*)\s*(?P<op1>[a-zA-Z0-9|(|)]*)?(,\s" \
             r"*(?P<op2>[a-zA-Z0-9|(|)]*))?(,\s*(?P<op3>\w*))?([\s|\t]*#.*)?$"
 
-    _dependency_analyzer = DependencyAnalyzer()
-
     def __init__(self, registers: memories.RegisterSet, memory: memories.Memory, print_dependencies=False):
         self._registers = registers
         self._memory = memory
@@ -74,38 +72,46 @@ class Parser:
 
     def parse(self, filepath: str):
         logger.info("Parsing file '%s'." % filepath)
+        with open(filepath, 'r') as f:
+            return self.parse_lines(f.readlines())
+
+    def parse_lines(self, lines):
+        """
+        Parses a program given as a list of source lines
+        """
         program = []
 
         # Analyze labels
         labels = {}
         nline = 0
-        with open(filepath, 'r') as f:
-            for line in f:
-                if line.startswith('#'):  # Skip comments
-                    continue
+        for line in lines:
+            if line.startswith('#'):  # Skip comments
+                continue
 
-                label = self.__check_label(line, nline)
-                if label:
-                    labels[label] = nline
-                nline += 1
+            label = self.__check_label(line, nline)
+            if label:
+                labels[label] = nline
+            nline += 1
 
         # Load program
         nline = 0
-        with open(filepath, 'r') as f:
-            for line in f:
-                if line.startswith('#'):  # Skip comments
-                    continue
+        for line in lines:
+            if line.startswith('#'):  # Skip comments
+                continue
 
-                instruction = self.__parse_line(line, nline, labels)
-                self._dependency_analyzer.add_instruction(instruction)
-                program.append(instruction)
-                nline += 1
+            instruction = self.__parse_line(line, nline, labels)
+            program.append(instruction)
+            nline += 1
 
         logger.info("Parsed %d instructions successfully." % nline)
 
-        self._dependency_analyzer.analyze()
+        # The analysis compares every pair of instructions, so it only runs when it is going to be printed
         if self._print_dependencies:
-            self._dependency_analyzer.print()
+            dependency_analyzer = DependencyAnalyzer()
+            for instruction in program:
+                dependency_analyzer.add_instruction(instruction)
+            dependency_analyzer.analyze()
+            dependency_analyzer.print()
 
         return program
 
@@ -118,7 +124,8 @@ class Parser:
         else:
             raise MalformedInstructionError(nline)
 
-        opcode = instruction_dict['opcode']
+        mnemonic = instruction_dict['opcode']
+        opcode = instructions.Opcode.from_str(mnemonic)
         op1 = instruction_dict['op1']
         op2 = instruction_dict['op2']
         op3 = instruction_dict['op3']
@@ -140,7 +147,7 @@ class Parser:
 
                 offset = self.__get_offset(op2)
 
-                if opcode == 'LOAD':
+                if opcode == instructions.Opcode.LOAD:
                     instruction = instructions.MemInstruction(
                         opcode=opcode,
                         rd=self.__get_register(op1),
@@ -177,7 +184,7 @@ class Parser:
                 instruction = instructions.HaltInstruction(opcode)
 
             else:
-                raise InvalidOpcodeError(opcode=opcode, nline=nline)
+                raise InvalidOpcodeError(opcode=mnemonic, nline=nline)
 
         except InvalidOperandError as e:
             raise InvalidOperandError(nline=nline, operand=e.operand)
@@ -0,0 +1,155 @@
+import array
+import logging
+from .instructions import Opcode, AluInstruction, MemInstruction, BranchInstruction, JumpInstruction, \
+    HaltInstruction
+
+
+logger = logging.getLogger(__name__)
+
+
+class Counter:
+    """ Index of every event in PerformanceCounters.values """
+    CYCLES = 0
+    INSTRUCTIONS = 1
+    RAW_STALLS = 2
+    STRUCTURAL_STALLS = 3
+    FU_BUSY_STALLS = 4
+    STAGE_LATENCY_STALLS = 5
+    BRANCH_FLUSHES = 6
+    MEMORY_STALLS = 7
+    WAR_STALLS = 8
+    WAW_STALLS = 9
+    RETIRED = 10  # RETIRED + opcode counts the retired instructions of each opcode
+
+    NUM_COUNTERS = RETIRED + len(Opcode._names)
+
+    stalls = {
+        'raw': RAW_STALLS,
+        'structural': STRUCTURAL_STALLS,
+        'fu_busy': FU_BUSY_STALLS,
+        'stage_latency': STAGE_LATENCY_STALLS,
+        'branch_flush': BRANCH_FLUSHES,
+        'memory': MEMORY_STALLS,
+        'war': WAR_STALLS,
+        'waw': WAW_STALLS,
+    }
+
+
+class PerformanceCounters:
+    """
+    Per-CPU event counters, like the PMU of a real processor.
+
+    Every counter is a slot of the `values` array indexed by Counter, so the CPUs update them with a
+    single indexed increment. Stall counters count cycles: a cycle stalled by several units for the same
+    cause counts once. Execution unit utilization and shelving buffer occupancy are only recorded by
+    the CPUs that have them, and so are the counters of each hardware thread.
+    """
+
+    instruction_classes = (
+        ('alu', AluInstruction.opcodes),
+        ('memory', MemInstruction.opcodes),
+        ('branch', BranchInstruction.opcodes),
+        ('jump', JumpInstruction.opcodes),
+        ('halt', HaltInstruction.opcodes),
+    )
+
+    def __init__(self, num_execution_units=0):
+        self.values = array.array('q', [0]) * Counter.NUM_COUNTERS
+        self.execution_unit_cycles = array.array('q', [0]) * num_execution_units  # Busy cycles of each unit
+        self.occupancy = array.array('q')  # Cycles the shelving buffer held each number of instructions
+        self.threads = []  # PerformanceCounters of every hardware thread of an SMT CPU
+
+    def retire(self, opcode):
+        values = self.values
+        values[Counter.INSTRUCTIONS] += 1
+        values[Counter.RETIRED + opcode] += 1
+
+    def record_occupancy(self, occupancy):
+        histogram = self.occupancy
+        if occupancy >= len(histogram):
+            histogram.extend([0] * (occupancy + 1 - len(histogram)))
+        histogram[occupancy] += 1
+
+    def get(self, counter):
+        return self.values[counter]
+
+    def get_cycles(self):
+        return self.values[Counter.CYCLES]
+
+    def get_instructions(self):
+        return self.values[Counter.INSTRUCTIONS]
+
+    def get_cpi(self):
+        instructions = self.values[Counter.INSTRUCTIONS]
+        return self.values[Counter.CYCLES] / instructions if instructions else None
+
+    def get_ipc(self):
+        cycles = self.values[Counter.CYCLES]
+        return self.values[Counter.INSTRUCTIONS] / cycles if cycles else None
+
+    def get_retired(self):
+        """ {mnemonic: retired instructions} of the opcodes retired at least once """
+        return {Opcode.to_str(opcode): self.values[Counter.RETIRED + opcode]
+                for opcode in range(len(Opcode._names)) if self.values[Counter.RETIRED + opcode]}
+
+    def get_retired_by_class(self):
+        return {name: sum(self.values[Counter.RETIRED + opcode] for opcode in opcodes)
+                for name, opcodes in self.instruction_classes}
+
+    def get_stalls(self):
+        return {name: self.values[counter] for name, counter in Counter.stalls.items()}
+
+    def get_utilization(self):
+        """ Fraction of the cycles each execution unit held an instruction """
+        cycles = self.values[Counter.CYCLES]
+        return [busy / cycles if cycles else 0.0 for busy in self.execution_unit_cycles]
+
+    def as_dict(self):
+        result = {
+            'cycles': self.get_cycles(),
+            'instructions': self.get_instructions(),
+            'cpi': self.get_cpi(),
+            'ipc': self.get_ipc(),
+            'retired': self.get_retired(),
+            'retired_by_class': self.get_retired_by_class(),
+            'stalls': self.get_stalls(),
+        }
+        if len(self.execution_unit_cycles):
+            result['execution_units'] = [
+                {'id': eu_id, 'busy_cycles': busy, 'utilization': utilization}
+                for eu_id, (busy, utilization) in enumerate(zip(self.execution_unit_cycles,
+                                                                self.get_utilization()))]
+        if len(self.occupancy):
+            result['shelving_buffer_occupancy'] = list(self.occupancy)
+        if self.threads:
+            result['threads'] = [thread.as_dict() for thread in self.threads]
+        return result
+
+    def write_json(self, path):
+        import json
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+        logger.info("Performance counters written to '%s'." % path)
+
+    def __repr__(self):
+        cpi = self.get_cpi()
+        return "%d cycles, %d instructions, CPI %s" % (
+            self.get_cycles(), self.get_instructions(), "%.3f" % cpi if cpi is not None else "-")
+
+
+def format_table(results):
+    """
+    Comparison table, one row per run, from {name: PerformanceCounters or the dict of as_dict()}
+    """
+    columns = ('cycles', 'instructions', 'cpi') + tuple(Counter.stalls)
+    lines = ["%-24s" % 'run' + "".join("%14s" % column for column in columns)]
+    for name, counters in results.items():
+        if isinstance(counters, PerformanceCounters):
+            counters = counters.as_dict()
+        row = dict(counters, **counters['stalls'])
+        cells = []
+        for column in columns:
+            value = row[column]
+            cells.append("%14s" % ('-' if value is None else "%.3f" % value if isinstance(value, float) else value))
+        lines.append("%-24s" % name + "".join(cells))
+    return "\n".join(lines)
@@ -0,0 +1,274 @@
+import contextlib
+import functools
+import logging
+import os
+import random
+import re
+from . import architectures, memoization
+from .instructions import Instruction, Opcode, AluInstruction, MemInstruction
+from .workloads import WorkloadGenerator, Workload, FIRST_TRIP_REGISTER
+
+
+logger = logging.getLogger(__name__)
+
+# {name: (CPU class or factory called with registers and memory, whether it runs branches)}
+MODELS = {
+    'interpreter': (functools.partial(architectures.FunctionalCpu, block_translation=False), True),
+    'pipelined': (architectures.PipelinedCpu, True),
+    'memoized': (memoization.MemoizedPipelinedCpu, True),
+    'centralized': (architectures.CentralizedRSCpu, False),  # Its execution units do not run branches
+    'scoreboard': (architectures.ScoreboardCpu, True),
+}
+CYCLES_PER_INSTRUCTION = 50  # Timing models that need more cycles than that are reported as not halting
+DEFAULT_PHASE_CYCLES = (1, 1, 1, 1, 1)
+
+_LABEL = re.compile(r'^(\w+):\s*')
+
+
+def generate_case(seed, index, control_flow=True):
+    """
+    Random program and initial state of case index of a run. Straight-line cases, without control_flow,
+    have no loops nor branches. Some data registers start with values of the whole word range.
+    """
+    rng = random.Random("%s-%d" % (seed, index))
+    loops = rng.randint(0, 2) if control_flow else 0
+    workload = WorkloadGenerator(
+        seed=rng.getrandbits(32),
+        cpu=rng.random() + 0.1,
+        mem=rng.random(),
+        branches=rng.random() * 0.3 if control_flow else 0,
+        body_size=rng.randint(1, 24),
+        trip_counts=tuple(rng.randint(1, 4) for _ in range(loops)),
+        footprint=rng.randint(1, 32)).generate()
+    for register in workload.registers:
+        if register >= FIRST_TRIP_REGISTER + loops and rng.random() < 0.2:
+            workload.registers[register] = rng.randint(-(1 << 63), (1 << 63) - 1)
+    return workload
+
+
+def generate_timing(seed, index):
+    """
+    Random functional unit latencies, {mnemonic: cycles}, and phase cycles of case index of a run. Most
+    units and stages keep one cycle, the others take longer so the hazards that depend on timing are reached.
+    """
+    rng = random.Random("%s-%d-timing" % (seed, index))
+    latencies = {Opcode.to_str(opcode): rng.randint(2, 6)
+                 for opcode in sorted(list(AluInstruction.fu_cycles) + list(MemInstruction.fu_cycles))
+                 if rng.random() < 0.3}
+    phase_cycles = tuple(rng.randint(2, 3) if rng.random() < 0.2 else 1 for _ in DEFAULT_PHASE_CYCLES)
+    return latencies, phase_cycles
+
+
+@contextlib.contextmanager
+def _latencies(latencies):
+    """ Sets {mnemonic: cycles} functional unit latencies, which are class attributes, for the duration of a case """
+    tables = [AluInstruction.fu_cycles, MemInstruction.fu_cycles]
+    saved = [dict(table) for table in tables]
+    try:
+        for mnemonic, cycles in latencies.items():
+            opcode = Opcode.from_str(mnemonic)
+            next(table for table in tables if opcode in table)[opcode] = cycles
+        yield
+    finally:
+        for table, values in zip(tables, saved):
+            table.clear()
+            table.update(values)
+
+
+def run_model(model, workload, max_cycles, phase_cycles=DEFAULT_PHASE_CYCLES):
+    """ Runs workload on a new CPU of model, returns whether it halted, its registers and its data words """
+    registers, memory = workload.build()
+    cpu = model(registers=registers, memory=memory, phase_cycles=phase_cycles)
+    cpu.start()
+    cpu.run(max_cycles)
+    words = memory.get_block(0, memory.get_size())
+    return cpu.is_halted(), list(registers.get_values()), [0 if isinstance(word, Instruction) else word
+                                                          for word in words]
+
+
+def compare(model, workload, expected, max_instructions, phase_cycles=DEFAULT_PHASE_CYCLES):
+    """ Description of how model differs from the expected run_model() result, None if it does not """
+    max_cycles = max_instructions * CYCLES_PER_INSTRUCTION * max(phase_cycles) + 100
+    try:
+        halted, registers, words = run_model(model, workload, max_cycles, phase_cycles)
+    except Exception as e:
+        return "%s: %s" % (e.__class__.__name__, e)
+    if not halted:
+        return "Did not halt."
+    differences = ["R%d=%d, expected %d" % (register, value, expected[1][register])
+                   for register, value in enumerate(registers) if value != expected[1][register]]
+    differences.extend("MEM[%d]=%d, expected %d" % (addr, value, expected[2][addr])
+                       for addr, value in enumerate(words) if value != expected[2][addr])
+    if differences:
+        return ", ".join(differences[:4]) + (", ..." if len(differences) > 4 else "")
+    return None
+
+
+def check_case(seed, index, models):
+    """
+    Runs case index on the functional CPU and on every model that can run it, with the latencies and
+    phase cycles of generate_timing(). Returns the [(model name, description)] of the models whose final
+    state differs.
+    """
+    control_flow = index % 2 == 1  # Every other case is straight-line, for the models without branches
+    workload = generate_case(seed, index, control_flow)
+    latencies, phase_cycles = generate_timing(seed, index)
+    with _latencies(latencies):
+        expected = run_model(architectures.FunctionalCpu, workload, workload.dynamic_instructions)
+        if not expected[0]:
+            raise FuzzingError("Case %d of seed %s does not halt." % (index, seed))
+
+        failures = []
+        for name, (model, runs_branches) in models.items():
+            if control_flow and not runs_branches:
+                continue
+            difference = compare(model, workload, expected, workload.dynamic_instructions, phase_cycles)
+            if difference is not None:
+                failures.append((name, difference))
+    return failures
+
+
+def shrink(workload, model, latencies=None, phase_cycles=DEFAULT_PHASE_CYCLES):
+    """
+    Removes chunks of instructions from a program that model runs wrong with the given latencies and
+    phase cycles, as long as it still halts on the functional CPU and model still differs. Labels of
+    removed lines move to the next line. Returns the smallest failing source found.
+    """
+    source = list(workload.source)
+
+    def fails(candidate):
+        shrunk = Workload(candidate, workload.registers, workload.memory, workload.memory_size,
+                          workload.dynamic_instructions)
+        try:
+            expected = run_model(architectures.FunctionalCpu, shrunk, workload.dynamic_instructions)
+        except Exception:
+            return False
+        return expected[0] and compare(model, shrunk, expected, workload.dynamic_instructions,
+                                       phase_cycles) is not None
+
+    chunk = max(len(source) // 2, 1)
+    with _latencies(latencies or {}):
+        while True:
+            removed = False
+            start = 0
+            while start < len(source) - 1:  # HALT is kept
+                candidate = _remove_lines(source, start, min(start + chunk, len(source) - 1))
+                if fails(candidate):
+                    source = candidate
+                    removed = True
+                else:
+                    start += chunk
+            if not removed:
+                if chunk == 1:
+                    break
+                chunk //= 2
+    logger.info("Failing program shrunk from %d to %d lines." % (len(workload.source), len(source)))
+    return _drop_unused_labels(source)
+
+
+def _remove_lines(source, start, end):
+    """ source without the lines in [start, end), branches to their labels go to the next line """
+    labels = [match.group(1) for match in map(_LABEL.match, source[start:end]) if match]
+    kept = source[:start] + source[end:]
+    if not labels:
+        return kept
+
+    following = kept[start]
+    match = _LABEL.match(following)
+    target = match.group(1) if match else labels[0]
+    if not match:
+        kept[start] = "%s: %s" % (target, following)
+    pattern = re.compile(r'\b(%s)$' % "|".join(labels))
+    return [pattern.sub(target, line.rstrip("\n")) + "\n" for line in kept]
+
+
+def _drop_unused_labels(source):
+    text = "".join(source)
+    result = []
+    for line in source:
+        match = _LABEL.match(line)
+        if match and not re.search(r'\b%s$' % match.group(1), text, re.MULTILINE):
+            line = line[match.end():]
+        result.append(line)
+    return result
+
+
+class FuzzFailure:
+    def __init__(self, seed, index, model, description, source, shrunk=None, latencies=None,
+                 phase_cycles=DEFAULT_PHASE_CYCLES):
+        self.seed = seed
+        self.index = index
+        self.model = model
+        self.description = description
+        self.source = source
+        self.shrunk = shrunk
+        self.latencies = latencies or {}  # {mnemonic: cycles} that differ from the defaults
+        self.phase_cycles = phase_cycles
+
+    def as_dict(self):
+        return {'seed': self.seed, 'case': self.index, 'model': self.model, 'description': self.description,
+                'latencies': self.latencies, 'phase_cycles': list(self.phase_cycles),
+                'source': "".join(self.source), 'shrunk': "".join(self.shrunk) if self.shrunk is not None else None}
+
+    def __repr__(self):
+        timing = ["%s=%d" % item for item in sorted(self.latencies.items())]
+        if tuple(self.phase_cycles) != DEFAULT_PHASE_CYCLES:
+            timing.append("phase cycles %s" % ",".join(map(str, self.phase_cycles)))
+        return "Case %d of seed %s on %s%s: %s" % (self.index, self.seed, self.model,
+                                                   " (%s)" % ", ".join(timing) if timing else "", self.description)
+
+
+class DifferentialFuzzer:
+    """
+    Differential testing of the CPU models against the functional CPU.
+
+    Every case is a random program from the workload generator, with random initial registers and data,
+    functional unit latencies and phase cycles, that is run on the functional CPU and on every model in
+    `models` ({name: (model, runs branches)}, MODELS by default). A model whose final registers or data
+    words differ, that raises or that does not halt fails the case, and the program is shrunk, with the
+    same timing, to the fewest instructions that still fail.
+
+    Cases are checked in `workers` processes; with one worker they run in this process, which also lets
+    models be classes that cannot be pickled. The same seed always generates the same cases.
+    """
+
+    def __init__(self, seed=0, models=None, workers=None, shrink_failures=True):
+        self._seed = seed
+        self._models = dict(models if models is not None else MODELS)
+        self._workers = workers or os.cpu_count() or 1
+        self._shrink_failures = shrink_failures
+
+    def run(self, num_cases, first_case=0):
+        """ Checks num_cases cases and returns the list of FuzzFailures """
+        indexes = range(first_case, first_case + num_cases)
+        check = functools.partial(check_case, self._seed, models=self._models)
+        if self._workers == 1:
+            results = map(check, indexes)
+        else:
+            import concurrent.futures
+            import multiprocessing
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self._workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+                results = list(pool.map(check, indexes, chunksize=max(num_cases // (self._workers * 4), 1)))
+
+        failures = []
+        for index, case_failures in zip(indexes, results):
+            for name, description in case_failures:
+                source = generate_case(self._seed, index, index % 2 == 1).source
+                latencies, phase_cycles = generate_timing(self._seed, index)
+                failure = FuzzFailure(self._seed, index, name, description, source, latencies=latencies,
+                                      phase_cycles=phase_cycles)
+                logger.info("%r" % failure)
+                failures.append(failure)
+
+        if self._shrink_failures:
+            for failure in failures:
+                workload = generate_case(self._seed, failure.index, failure.index % 2 == 1)
+                failure.shrunk = shrink(workload, self._models[failure.model][0], failure.latencies,
+                                        failure.phase_cycles)
+        logger.info("%d cases checked, %d failures." % (num_cases, len(failures)))
+        return failures
+
+
+class FuzzingError(Exception):
+    pass
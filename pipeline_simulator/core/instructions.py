@@ -1,26 +1,57 @@
 import logging
+import operator
 from pipeline_simulator.core import memories
 
 
 logger = logging.getLogger(__name__)
 
 
+class Opcode:
+    ADD = 0
+    MULT = 1
+    SUB = 2
+    DIV = 3
+    LOAD = 4
+    STORE = 5
+    BEQ = 6
+    BNE = 7
+    JMP = 8
+    HALT = 9
+
+    _names = ('ADD', 'MULT', 'SUB', 'DIV', 'LOAD', 'STORE', 'BEQ', 'BNE', 'JMP', 'HALT')
+    _values = {name: value for value, name in enumerate(_names)}
+
+    @classmethod
+    def to_str(cls, opcode):
+        return cls._names[opcode]
+
+    @classmethod
+    def from_str(cls, name):
+        """ Returns None if the mnemonic is unknown """
+        return cls._values.get(name)
+
+
 class Instruction:
+    """
+    Static, decoded instruction. The same object is shared by every dynamic instance fetched
+    from its address, so the per-instance state is kept in the MicroOp passed to each phase.
+    """
+    __slots__ = ('_opcode', '_read_registers', '_written_registers')
 
-    def fetch(self):
-        logger.info("Executing fetch phase of instruction " + self.__repr__())
+    def fetch(self, uop):
+        logger.info("Executing fetch phase of instruction %s", self)
 
-    def decode(self):
-        logger.info("Executing decode phase of instruction " + self.__repr__())
+    def decode(self, uop):
+        logger.info("Executing decode phase of instruction %s", self)
 
-    def execute(self):
-        logger.info("Executing execute phase of instruction " + self.__repr__())
+    def execute(self, uop):
+        logger.info("Executing execute phase of instruction %s", self)
 
-    def memory(self):
-        logger.info("Executing memory phase of instruction " + self.__repr__())
+    def memory(self, uop):
+        logger.info("Executing memory phase of instruction %s", self)
 
-    def writeback(self):
-        logger.info("Executing writeback phase of instruction " + self.__repr__())
+    def writeback(self, uop):
+        logger.info("Executing writeback phase of instruction %s", self)
 
     def get_read_registers(self):
         pass
@@ -34,237 +65,383 @@ class Instruction:
     def get_opcode(self):
         return self._opcode
 
+    def get_fu_cycles(self):
+        return 1
+
+    def encode(self):
+        """
+        Flat (opcode, a, b, c) form of the instruction, with register ids instead of Registers.
+        ALU: (op, rd, rs, rt). Memory: (op, data register, base register, offset).
+        Branch: (op, rs, rt, target). Jump: (op, 0, 0, target). Halt: (op, 0, 0, 0).
+        """
+        return self._opcode, 0, 0, 0
+
+    def _reserve_registers(self):
+        """
+        Raises a RawDependencySignal if any source register is waiting for a result,
+        otherwise locks the destination registers until writeback.
+        """
+        for register in self._read_registers:
+            if register.is_locked():
+                raise RawDependencySignal
+
+        for register in self._written_registers:
+            register.lock()
+
+
+class MicroOp:
+    """
+    Dynamic instance of an Instruction flowing through the CPU.
+    """
+    __slots__ = ('_instruction', '_pc', '_thread', '_tmp', '_computed_mem_addr', '_remaining_cycles')
+
+    def bind(self, instruction: Instruction, pc=-1, thread=0):
+        self._instruction = instruction
+        self._pc = pc  # Address it was fetched from
+        self._thread = thread  # Hardware thread that fetched it
+        self._tmp = None  # Used for store results before writing them to rd on WB phase
+        self._computed_mem_addr = None
+        self._remaining_cycles = instruction.get_fu_cycles() - 1
+
+    def fetch(self):
+        self._instruction.fetch(self)
+
+    def decode(self):
+        self._instruction.decode(self)
+
+    def execute(self):
+        self._instruction.execute(self)
+
+    def memory(self):
+        self._instruction.memory(self)
+
+    def writeback(self):
+        self._instruction.writeback(self)
+
+    def get_instruction(self):
+        return self._instruction
+
+    def get_pc(self):
+        return self._pc
+
+    def get_thread(self):
+        return self._thread
+
+    def get_opcode(self):
+        return self._instruction.get_opcode()
+
+    def get_read_registers(self):
+        return self._instruction.get_read_registers()
+
+    def get_written_registers(self):
+        return self._instruction.get_written_registers()
+
+    def __repr__(self):
+        return repr(self._instruction)
+
+
+class Bubble(MicroOp):
+    """ Stateless, so every empty pipeline slot shares the BUBBLE instance """
+    __slots__ = ()
+
+    def fetch(self):
+        pass
+
+    def decode(self):
+        pass
+
+    def execute(self):
+        pass
+
+    def memory(self):
+        pass
+
+    def writeback(self):
+        pass
+
+    def get_instruction(self):
+        return None
+
+    def get_opcode(self):
+        return None
+
+    def get_read_registers(self):
+        return ()
+
+    def get_written_registers(self):
+        return ()
 
-class Bubble(Instruction):
     def __repr__(self):
         return "( )"
 
 
+BUBBLE = Bubble()
+
+
+class MicroOpPool:
+    """
+    Free list of MicroOps, so the CPUs recycle retired or flushed instances instead of allocating new ones.
+    """
+
+    def __init__(self):
+        self._free = []
+
+    def acquire(self, instruction: Instruction, pc=-1, thread=0):
+        uop = self._free.pop() if self._free else MicroOp()
+        uop.bind(instruction, pc, thread)
+        return uop
+
+    def release(self, uop: MicroOp):
+        if uop.__class__ is not MicroOp:  # BUBBLE or a data word fetched past the end of the program
+            return
+        uop._instruction = None
+        self._free.append(uop)
+
+
+def _divide(a, b):
+    return int(a / b)  # integer division
+
+
 class AluInstruction(Instruction):
+    __slots__ = ('_operation', '_rs', '_rt', '_rd')
+
     opcodes = [
-        'ADD',
-        'MULT',
-        'SUB',
-        'DIV',
+        Opcode.ADD,
+        Opcode.MULT,
+        Opcode.SUB,
+        Opcode.DIV,
     ]
 
     fu_cycles = {
-        'ADD': 1,
-        'MULT': 1,
-        'SUB': 1,
-        'DIV': 1
+        Opcode.ADD: 1,
+        Opcode.MULT: 1,
+        Opcode.SUB: 1,
+        Opcode.DIV: 1
+    }
+
+    operations = {
+        Opcode.ADD: operator.add,
+        Opcode.MULT: operator.mul,
+        Opcode.SUB: operator.sub,
+        Opcode.DIV: _divide,
     }
 
     def __init__(self, opcode, rs: memories.Register, rt: memories.Register, rd: memories.Register):
         self._opcode = opcode
+        self._operation = self.operations[opcode]
         self._rs = rs
         self._rt = rt
         self._rd = rd
-        self._tmp = None  # Used for store results before writing them to rd on WB phase
-        self._remaining_cycles = self.fu_cycles[self._opcode] - 1
+        self._read_registers = (rs, rt)
+        self._written_registers = (rd,)
 
-    def decode(self):
-        super(AluInstruction, self).decode()
-        if self._rs.is_locked() or self._rt.is_locked():
-            raise RawDependencySignal
-        self._rd.lock()
+    def decode(self, uop):
+        super(AluInstruction, self).decode(uop)
+        self._reserve_registers()
 
-    def execute(self):
-        if self._remaining_cycles > 0:
-            self._remaining_cycles -= 1
+    def execute(self, uop):
+        if uop._remaining_cycles > 0:
+            uop._remaining_cycles -= 1
             raise FunctionalUnitNotFinishedSignal
 
-        super(AluInstruction, self).execute()
-        if self._opcode == 'ADD':
-            self._tmp = self._rs.get_data() + self._rt.get_data()
-        elif self._opcode == 'MULT':
-            self._tmp = self._rs.get_data() * self._rt.get_data()
-        elif self._opcode == 'SUB':
-            self._tmp = self._rs.get_data() - self._rt.get_data()
-        elif self._opcode == 'DIV':
-            self._tmp = self._rs.get_data() / self._rt.get_data()
-            self._tmp = int(self._tmp)  # integer division
+        super(AluInstruction, self).execute(uop)
+        uop._tmp = self._operation(self._rs.get_data(), self._rt.get_data())
 
-    def writeback(self):
-        super(AluInstruction, self).writeback()
+    def writeback(self, uop):
+        super(AluInstruction, self).writeback(uop)
         self._rd.unlock()
-        self._rd.set(self._tmp)
+        self._rd.set(uop._tmp)
 
     def get_read_registers(self):
-        return [self._rs, self._rt]
+        return self._read_registers
 
     def get_written_registers(self):
-        return [self._rd]
+        return self._written_registers
+
+    def get_fu_cycles(self):
+        return self.fu_cycles[self._opcode]
+
+    def encode(self):
+        return self._opcode, self._rd.get_id(), self._rs.get_id(), self._rt.get_id()
 
     def __repr__(self):
-        return "%s %s, %s, %s" % (self._opcode, self._rd, self._rs, self._rt)
+        return "%s %s, %s, %s" % (Opcode.to_str(self._opcode), self._rd, self._rs, self._rt)
 
 
 class MemInstruction(Instruction):
+    __slots__ = ('_access', '_rs', '_rd', '_offset', '_base', '_memory')
+
     opcodes = [
-        'LOAD',
-        'STORE',
+        Opcode.LOAD,
+        Opcode.STORE,
     ]
 
     fu_cycles = {
-        'LOAD': 1,
-        'STORE': 1,
+        Opcode.LOAD: 1,
+        Opcode.STORE: 1,
     }
 
     def __init__(self, opcode, rs: memories.Register, rd: memories.Register, offset: int, memory: memories.Memory):
         self._opcode = opcode
+        self._access = self.accesses[opcode]
         self._rs = rs
         self._rd = rd
         self._offset = offset
-        self._computed_mem_addr = None
-        self._tmp = None
+        if opcode == Opcode.LOAD:
+            self._base = rs
+            self._read_registers = (rs,)
+            self._written_registers = (rd,)
+        else:  # opcode == STORE
+            self._base = rd
+            self._read_registers = (rs, rd)
+            self._written_registers = ()
         self._memory = memory
-        self._remaining_cycles = MemInstruction.fu_cycles[self._opcode] - 1
 
-    def decode(self):
-        super(MemInstruction, self).decode()
-        if self._opcode == 'LOAD':
-            if self._rs.is_locked():
-                raise RawDependencySignal
-            self._rd.lock()
+    def decode(self, uop):
+        super(MemInstruction, self).decode(uop)
+        self._reserve_registers()
 
-        else:  # self._opcode == STORE
-            if self._rs.is_locked() or self._rd.is_locked():
-                raise RawDependencySignal
-
-    def execute(self):
-        if self._remaining_cycles > 0:
-            self._remaining_cycles -= 1
+    def execute(self, uop):
+        if uop._remaining_cycles > 0:
+            uop._remaining_cycles -= 1
             raise FunctionalUnitNotFinishedSignal
 
-        super(MemInstruction, self).execute()
-        if self._opcode == 'LOAD':
-            self._computed_mem_addr = self._rs.get_data() + self._offset
-
-        else:  # self._opcode == STORE
-            self._computed_mem_addr = self._rd.get_data() + self._offset
+        super(MemInstruction, self).execute(uop)
+        uop._computed_mem_addr = self._base.get_data() + self._offset
 
-    def memory(self):
-        super(MemInstruction, self).memory()
-        if self._opcode == 'LOAD':
-            self._tmp = self._memory.get_data(self._computed_mem_addr)
-
-        else:  # self._opcode == STORE
-            register_data = self._rs.get_data()
-            self._memory.set(self._computed_mem_addr, register_data)
-
-    def writeback(self):
-        super(MemInstruction, self).writeback()
-        if self._opcode == 'LOAD':
-            self._rd.unlock()
-            self._rd.set(self._tmp)
+    def memory(self, uop):
+        super(MemInstruction, self).memory(uop)
+        self._access(self, uop)
 
-        else:
-            pass
+    def writeback(self, uop):
+        super(MemInstruction, self).writeback(uop)
+        for register in self._written_registers:
+            register.unlock()
+            register.set(uop._tmp)
 
     def get_read_registers(self):
-        if self._opcode == 'LOAD':
-            return [self._rs]
+        return self._read_registers
 
-        elif self._opcode == 'STORE':
-            return [self._rs, self._rd]
+    def get_written_registers(self):
+        return self._written_registers
 
-        else:
-            raise RuntimeError
+    def get_fu_cycles(self):
+        return self.fu_cycles[self._opcode]
 
-    def get_written_registers(self):
-        if self._opcode == 'LOAD':
-            return [self._rd]
+    def encode(self):
+        data = self._rd if self._opcode == Opcode.LOAD else self._rs
+        return self._opcode, data.get_id(), self._base.get_id(), self._offset
 
-        elif self._opcode == 'STORE':
-            return []
+    def _load(self, uop):
+        uop._tmp = self._memory.get_data(uop._computed_mem_addr)
 
-        else:
-            raise RuntimeError
+    def _store(self, uop):
+        self._memory.set(uop._computed_mem_addr, self._rs.get_data())
+
+    accesses = {
+        Opcode.LOAD: _load,
+        Opcode.STORE: _store,
+    }
 
     def __repr__(self):
-        return "%s %s, %d(%s)" % (self._opcode, self._rd, self._offset, self._rs)
+        return "%s %s, %d(%s)" % (Opcode.to_str(self._opcode), self._rd, self._offset, self._rs)
 
 
 class BranchInstruction(Instruction):
+    __slots__ = ('_condition', '_rs', '_rt', '_imm')
+
     opcodes = [
-        'BEQ',
-        'BNE'
+        Opcode.BEQ,
+        Opcode.BNE,
     ]
 
+    conditions = {
+        Opcode.BEQ: operator.eq,
+        Opcode.BNE: operator.ne,
+    }
+
     def __init__(self, opcode, rs: memories.Register, rt: memories.Register, imm: int):
         self._opcode = opcode
+        self._condition = self.conditions[opcode]
         self._rs = rs
         self._rt = rt
         self._imm = imm
+        self._read_registers = (rs, rt)
+        self._written_registers = ()
 
-    def decode(self):
-        if self._rs.is_locked() or self._rt.is_locked():
-            raise RawDependencySignal
-
-        if self._opcode == 'BEQ':
-            if self._rs.get_data() == self._rt.get_data():
-                raise JumpSignal(self._imm)
+    def decode(self, uop):
+        self._reserve_registers()
 
-        elif self._opcode == 'BNE':
-            if self._rs.get_data() != self._rt.get_data():
-                raise JumpSignal(self._imm)
+        uop._tmp = self._condition(self._rs.get_data(), self._rt.get_data())  # Branch outcome, traced on retire
+        if uop._tmp:
+            raise JumpSignal(self._imm)
 
     def get_read_registers(self):
-        return [self._rs, self._rt]
+        return self._read_registers
 
     def get_written_registers(self):
-        return []
+        return self._written_registers
+
+    def encode(self):
+        return self._opcode, self._rs.get_id(), self._rt.get_id(), self._imm
 
     def __repr__(self):
-        return "%s %s, %s, 0x%x" % (self._opcode, self._rs, self._rt, self._imm)
+        return "%s %s, %s, 0x%x" % (Opcode.to_str(self._opcode), self._rs, self._rt, self._imm)
 
 
 class JumpInstruction(Instruction):
+    __slots__ = ('_imm',)
+
     opcodes = [
-        'JMP',
+        Opcode.JMP,
     ]
 
     def __init__(self, opcode, imm: int):
         self._opcode = opcode
         self._imm = imm
 
-    def decode(self):
+    def decode(self, uop):
         raise JumpSignal(self._imm)
 
     def get_read_registers(self):
-        return []
+        return ()
 
     def get_written_registers(self):
-        return []
+        return ()
+
+    def encode(self):
+        return self._opcode, 0, 0, self._imm
 
     def __repr__(self):
-        return "%s 0x%x" % (self._opcode, self._imm)
+        return "%s 0x%x" % (Opcode.to_str(self._opcode), self._imm)
 
 
 class HaltInstruction(Instruction):
+    __slots__ = ()
+
     opcodes = [
-        'HALT',
+        Opcode.HALT,
     ]
 
     def __init__(self, opcode):
         self._opcode = opcode
 
     def __repr__(self):
-        return "%s" % self._opcode
+        return "%s" % Opcode.to_str(self._opcode)
 
-    def decode(self):
-        raise HaltSignal
+    def decode(self, uop):
+        raise HaltSignal(uop.get_pc())
 
     def get_read_registers(self):
-        return []
+        return ()
 
     def get_written_registers(self):
-        return []
+        return ()
 
 
 class HaltSignal(Exception):
-    pass
+    def __init__(self, addr=-1):
+        self.addr = addr  # Address of the HALT
 
 
 class RawDependencySignal(Exception):
@@ -0,0 +1,261 @@
+import collections
+import logging
+from .architectures import FunctionalCpu, PipelinedCpu, Pipeline, HaltedCpuError
+from .counters import Counter
+from .instructions import BUBBLE, Opcode, BranchInstruction
+from .trace import TraceReplay, TAKEN
+
+
+logger = logging.getLogger(__name__)
+
+_STAGES = (Pipeline.PipelineStage.IF, Pipeline.PipelineStage.ID, Pipeline.PipelineStage.EX,
+           Pipeline.PipelineStage.MEM, Pipeline.PipelineStage.WB)
+_CONTROL = frozenset(BranchInstruction.opcodes + [Opcode.JMP, Opcode.HALT])
+
+
+class TimingMemo:
+    """
+    Timing of the blocks run by MemoizedPipelinedCpu: cycles, counter increments and pipeline state at the
+    end of each block, keyed on how the block was entered and left. A memo can be shared by CPUs that run
+    the same program with the same latencies, like the runs of a batch.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._hits = 0
+        self._misses = 0
+        self._verified = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self._misses += 1
+        else:
+            self._hits += 1
+        return entry
+
+    def put(self, key, entry):
+        self._entries[key] = entry
+
+    def clear(self):
+        self._entries.clear()
+
+    def get_stats(self):
+        """ Lookups that hit and missed, blocks checked against a full simulation and entries """
+        return {'hits': self._hits, 'misses': self._misses, 'verified': self._verified, 'entries': len(self._entries)}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class MemoEntry:
+    __slots__ = ('cycles', 'increments', 'fetched', 'state', 'addresses')
+
+    def __init__(self, cycles, increments, fetched, state, addresses):
+        self.cycles = cycles
+        self.increments = increments  # (counter, increment) of every counter the block changed
+        self.fetched = fetched  # Trace records fetched
+        self.state = state  # Pipeline state at the end of the block
+        self.addresses = addresses  # Memory addresses fetched but not executed yet at the end of the block
+
+    def __eq__(self, other):
+        return (self.cycles, self.increments, self.fetched, self.state, self.addresses) == \
+            (other.cycles, other.increments, other.fetched, other.state, other.addresses)
+
+    def __repr__(self):
+        return "MemoEntry(%d cycles, %d fetched, %r)" % (self.cycles, self.fetched, self.increments)
+
+
+class MemoizedPipelinedCpu(PipelinedCpu):
+    """
+    PipelinedCpu that simulates each block once for every pipeline state it is entered with, and replays
+    the cached timing of the block afterwards.
+
+    Runs are functional-first: a FunctionalCpu executes the program one block ahead of the pipeline and
+    feeds it trace records, and the pipeline runs the timing-only instructions of a trace replay. The
+    timing of a block (from the cycle its first instruction is fetched to the cycle the next block's is)
+    then only depends on the pipeline stages, the stage and functional unit countdowns, the register
+    locks, the pending branch outcomes and the way the block exits, which are the memo key. Counters are
+    those of a PipelinedCpu; registers and memory run up to one block ahead of the pipeline until it halts.
+
+    With verify, every block found in the memo is simulated anyway and a MemoizationError is raised if its
+    timing differs from the cached one. Programs must not write their own code, and runs only stop at HALT
+    or after max_cycles.
+    """
+
+    def __init__(self, registers, memory, *args, memo=None, verify=False, pc=0, **kwargs):
+        if kwargs.pop('trace', None) is not None or kwargs.get('trace_file') or kwargs.get('show_chronogram'):
+            raise ValueError("Memoized runs skip cycles, they cannot replay or record traces or print chronograms.")
+        self._functional = FunctionalCpu(registers=registers, memory=memory, pc=pc, block_translation=False)
+        self._functional._tracer = _RecordQueue()
+        self._pending = self._functional._tracer.records
+        self._functional.start()
+        self._trace = TraceReplay(self.__records(), registers)
+        super(MemoizedPipelinedCpu, self).__init__(registers, memory, *args, pc=pc, trace=self._trace, **kwargs)
+        self._memo = memo if memo is not None else TimingMemo()
+        self._verify = verify
+        self._at_block = False  # The last cycle fetched the first instruction of a block
+
+    def step(self):
+        """ Simulates one cycle """
+        trace = self._trace
+        fetched = trace._fetched
+        after_control = fetched == 0 or trace._last_opcode in _CONTROL
+        super(MemoizedPipelinedCpu, self).step()
+        self._at_block = trace._fetched != fetched and after_control
+
+    def run_until(self, pc=None, cycle=None, predicate=None, max_cycles=None):
+        if pc is not None or cycle is not None or predicate is not None or self._breakpoints or \
+                self._registers.has_watchpoints() or self._memory.get_watchpoints():
+            raise ValueError("Memoized runs only stop at HALT or after max_cycles.")
+        if self.is_halted():
+            raise HaltedCpuError
+
+        values = self._counters.values
+        first = values[Counter.CYCLES]
+        while not self.is_halted():
+            cycles = values[Counter.CYCLES] - first
+            if cycles == max_cycles:
+                return self.StopReason.MAX_CYCLES
+            self.__advance(None if max_cycles is None else max_cycles - cycles)
+        return self.StopReason.HALTED
+
+    def get_memo(self):
+        return self._memo
+
+    def __advance(self, limit):
+        """ Runs the block being entered, from the memo if it fits in limit cycles, or one cycle elsewhere """
+        if not self._at_block:
+            self.step()
+            return
+        block_exit = self.__get_block_exit()
+        if block_exit is None:  # The last block, up to HALT, runs once
+            self.step()
+            return
+
+        state = self.__capture()
+        key = (block_exit, state)
+        entry = self._memo.get(key)
+        if entry is not None and not self._verify and (limit is None or entry.cycles <= limit):
+            self.__replay(entry)
+            return
+
+        values = self._counters.values
+        before = values[:]
+        fetched = self._trace._fetched
+        cycles = 0
+        while True:
+            self.step()
+            cycles += 1
+            if self._at_block or self.is_halted():
+                break
+            if cycles == limit:
+                return
+        if self.is_halted():
+            return
+
+        simulated = MemoEntry(cycles, tuple((counter, value - before[counter]) for counter, value in enumerate(values)
+                                            if value != before[counter]),
+                              self._trace._fetched - fetched, self.__capture(), len(self._trace._addresses))
+        if entry is not None:
+            self._memo._verified += 1
+            if entry != simulated:
+                raise MemoizationError("Block at 0x%x: memoized %r, simulated %r." % (state[0][0][0], entry, simulated))
+        self._memo.put(key, simulated)
+
+    def __capture(self):
+        """ Pipeline state the timing of the next cycles depends on """
+        pipeline = self._pipeline
+        stages = pipeline._pipeline
+        return (tuple(None if stages[stage] is BUBBLE else (stages[stage]._pc, stages[stage]._remaining_cycles)
+                      for stage in _STAGES),
+                tuple(pipeline._remaining_cycles[stage] for stage in _STAGES),
+                self._status, self._pc, self._registers._locks.tobytes(), tuple(self._trace._branches))
+
+    def __replay(self, entry):
+        trace = self._trace
+        for _ in range(entry.fetched):
+            trace.fetch(trace._next[0])
+        stages, remaining, self._status, self._pc, locks, branches = entry.state
+        while len(trace._branches) > len(branches):
+            trace._branches.popleft()
+        while len(trace._addresses) > entry.addresses:
+            trace._addresses.popleft()
+
+        pipeline = self._pipeline
+        uops = pipeline._uops
+        for stage, state in zip(_STAGES, stages):
+            uops.release(pipeline._pipeline[stage])
+            if state is None:
+                pipeline._pipeline[stage] = BUBBLE
+            else:
+                pc, remaining_cycles = state
+                uop = pipeline._pipeline[stage] = uops.acquire(trace._instructions[pc], pc)
+                uop._remaining_cycles = remaining_cycles
+        pipeline._remaining_cycles.update(zip(_STAGES, remaining))
+        memoryview(self._registers._locks).cast('B')[:] = locks
+
+        values = self._counters.values
+        for counter, increment in entry.increments:
+            values[counter] += increment
+
+    def __get_block_exit(self):
+        """
+        (whether the block being entered leaves through a taken branch, address of the next block),
+        or None if the block ends with HALT
+        """
+        opcode = self._trace._last_opcode
+        index = 0
+        if opcode in _CONTROL:
+            taken = opcode in BranchInstruction.opcodes and self._trace._branches[-1]
+        else:
+            record = self.__get_record(0)
+            while record is not None and record[1] not in _CONTROL:
+                index += 1
+                record = self.__get_record(index)
+            if record is None:
+                return None
+            opcode = record[1]
+            taken = bool(record[4] & TAKEN)
+            index += 1
+        if opcode == Opcode.HALT:
+            return None
+        record = self.__get_record(index)
+        return None if record is None else (taken, record[0])
+
+    def __get_record(self, index):
+        """ index-th record not fetched yet, running the functional CPU as far as needed """
+        if index == 0:
+            return self._trace._next
+        pending = self._pending
+        while len(pending) < index and self.__produce():
+            pass
+        return pending[index - 1] if len(pending) >= index else None
+
+    def __produce(self):
+        if self._functional.is_halted():
+            return False
+        self._functional.step()
+        return True
+
+    def __records(self):
+        pending = self._pending
+        while pending or self.__produce():
+            yield pending.popleft()
+
+
+class _RecordQueue:
+    """ Tracer of the functional CPU, keeps its records for the pipeline """
+
+    def __init__(self):
+        self.records = collections.deque()
+
+    def record(self, pc, opcode, a, b, c, addr=-1, taken=False):
+        self.records.append((pc, opcode, a, b, TAKEN if taken else 0, c, addr))
+
+    def close(self):
+        pass
+
+
+class MemoizationError(Exception):
+    pass
@@ -1,35 +1,58 @@
+import array
 import logging
 
 
 logger = logging.getLogger(__name__)
 
+WORD_TYPECODE = 'q'
+WORD_BITS = 64
+DEFAULT_PAGE_BITS = 12  # 4096 words per page of PagedMemory
+
+
+def wrap_word(value):
+    """ Wraps an integer to a signed 64-bit machine word (two's complement) """
+    value &= (1 << WORD_BITS) - 1
+    if value >= 1 << (WORD_BITS - 1):
+        value -= 1 << WORD_BITS
+    return value
+
 
 class Register(object):
+    """
+    Handle to one entry of a RegisterSet, the value and the lock counter live in the set's arrays.
+    """
+    __slots__ = ('_register_id', '_values', '_locks')
 
-    def __init__(self, reg_id: int):
+    def __init__(self, reg_id: int, values: array.array, locks: array.array):
         self._register_id = reg_id
-        self._data = 0
-        self._semaphore = 0
+        self._values = values
+        self._locks = locks
 
     def set(self, data):
-        logger.info("Storing data %d in register %d." % (data, self._register_id))
-        self._data = data
+        logger.info("Storing data %d in register %d.", data, self._register_id)
+        try:
+            self._values[self._register_id] = data
+        except OverflowError:
+            self._values[self._register_id] = wrap_word(data)
 
     def get_data(self):
-        logger.debug("Returning element from register %d." % self._register_id)
-        return self._data
+        logger.debug("Returning element from register %d.", self._register_id)
+        return self._values[self._register_id]
+
+    def get_id(self):
+        return self._register_id
 
     def lock(self):
-        logger.debug("Locking register %d." % self._register_id)
-        self._semaphore += 1
+        logger.debug("Locking register %d.", self._register_id)
+        self._locks[self._register_id] += 1
 
     def unlock(self):
-        logger.debug("Unlocking register %d." % self._register_id)
-        if self._semaphore > 0:
-            self._semaphore -= 1
+        logger.debug("Unlocking register %d.", self._register_id)
+        if self._locks[self._register_id] > 0:
+            self._locks[self._register_id] -= 1
 
     def is_locked(self):
-        return self._semaphore > 0
+        return self._locks[self._register_id] > 0
 
     def __str__(self):
         # return "R%d[%d][Locked: %s]" % (self._register_id, self._data, self.is_locked())
@@ -41,23 +64,34 @@ class Register(object):
 
 
 class RegisterSet(object):
-    _registers = []
+    """
+    Struct-of-arrays register file: values and lock counters are stored in two contiguous
+    64-bit arrays, which can be exposed without copying through get_values()/as_numpy().
+    """
 
     def __init__(self, registers_file=None, num_registers=32):
-        for i in range(num_registers):
-            self._registers.append(Register(i))
+        self._values = array.array(WORD_TYPECODE, [0]) * num_registers
+        self._locks = array.array(WORD_TYPECODE, [0]) * num_registers
+        self._registers = [Register(i, self._values, self._locks) for i in range(num_registers)]
+        self._watchpoints = {}  # {register id: value at the last check}
+        self._watch_hits = []
 
-        from .compilers import Parser, InstructionSyntaxError
-        p = Parser(self, None)
         if registers_file:
-            with open(registers_file, 'r') as f:
-                for line in f:
-                    try:
-                        (register_alias, value) = line.split("=")
-                        register = p.parse_register(register_alias)
-                        register.set(int(value))
-                    except ValueError:
-                        raise ValueError("Linea mal formada en archivo de registros.")
+            self.load_file(registers_file)
+
+    def load_file(self, registers_file):
+        """ Sets the registers listed in a file of `rN=value` lines, the others are left untouched """
+        with open(registers_file, 'r') as f:
+            for line in f:
+                try:
+                    (register_alias, value) = line.split("=")
+                    register_alias = register_alias.strip()
+                    if register_alias[:1] not in ('r', 'R') or not register_alias[1:].isdigit():
+                        raise ValueError
+                    register = self.get(int(register_alias[1:]))
+                    register.set(int(value))
+                except ValueError:
+                    raise ValueError("Linea mal formada en archivo de registros.")
 
     def get(self, register_id):
         try:
@@ -65,6 +99,92 @@ class RegisterSet(object):
         except IndexError:
             raise InvalidRegisterError(register_id)
 
+    def get_num_registers(self):
+        return len(self._registers)
+
+    def get_values(self):
+        """ Zero-copy view of the register values """
+        return memoryview(self._values)
+
+    def get_locks(self):
+        """ Zero-copy view of the register lock counters """
+        return memoryview(self._locks)
+
+    def as_numpy(self):
+        """ Zero-copy int64 NumPy view of the register values, writes through to the registers """
+        import numpy
+        return numpy.frombuffer(self._values, dtype=numpy.int64)
+
+    def snapshot(self):
+        """ Copies of the values and lock arrays, the register file has a fixed size so this is constant time """
+        return self._values[:], self._locks[:]
+
+    def restore(self, snapshot):
+        values, locks = snapshot
+        self._values[:] = values
+        self._locks[:] = locks
+
+    def diff(self, other):
+        """
+        Returns the ids of the registers whose value differs from other, which can be another
+        RegisterSet, a snapshot or any sequence of values
+        """
+        if isinstance(other, RegisterSet):
+            other = other._values
+        elif isinstance(other, tuple):
+            other = other[0]
+
+        if len(other) != len(self._values):
+            raise ValueError("Register files of different size.")
+
+        if self._values == other:
+            return []
+
+        try:
+            import numpy
+        except ImportError:
+            return [i for i, (a, b) in enumerate(zip(self._values, other)) if a != b]
+
+        mine = numpy.frombuffer(self._values, dtype=numpy.int64)
+        return numpy.flatnonzero(mine != numpy.asarray(other, dtype=numpy.int64)).tolist()
+
+    def add_watchpoint(self, register_id):
+        """
+        Registers are written straight into the values array by the CPUs, so watched registers are not
+        trapped on write: check_watchpoints() compares them with their value at the previous check.
+        """
+        self._watchpoints[register_id] = self.get(register_id).get_data()
+
+    def remove_watchpoint(self, register_id):
+        self._watchpoints.pop(register_id, None)
+
+    def get_watchpoints(self):
+        return sorted(self._watchpoints)
+
+    def has_watchpoints(self):
+        return bool(self._watchpoints)
+
+    def check_watchpoints(self):
+        """ Records a (register id, old value, new value) hit per watched register changed since the last check """
+        values = self._values
+        hit = False
+        for register_id, old in self._watchpoints.items():
+            new = values[register_id]
+            if new != old:
+                self._watchpoints[register_id] = new
+                self._watch_hits.append((register_id, old, new))
+                hit = True
+        return hit
+
+    def get_watch_hits(self):
+        return list(self._watch_hits)
+
+    def clear_watch_hits(self):
+        """ Forgets the hits and takes the current values of the watched registers as the reference """
+        del self._watch_hits[:]
+        for register_id in self._watchpoints:
+            self._watchpoints[register_id] = self._values[register_id]
+
 
 class Memory:
 
@@ -73,27 +193,92 @@ class Memory:
         self._size_in_words = size_in_words
         for i in range(size_in_words):
             self._memory.append(0)
+        self._watchpoints = set()
+        self._watch_hits = []  # (address, old word, new word) of the stores that changed a watched word
 
     def get_data(self, addr):
-        logger.debug("Returning from memory element in %d." % addr)
+        logger.debug("Returning from memory element in %d.", addr)
         try:
             return self._memory[addr]
         except IndexError:
             raise InvalidAddressError(addr)
 
+    fetch_instruction = get_data  # Instruction fetches of the CPUs, which caches keep apart from data accesses
+
     def set(self, addr, data):
-        logger.info("Storing in memory data %s in address %d." % (data, addr))
+        logger.info("Storing in memory data %s in address %d.", data, addr)
         try:
+            if self._watchpoints and addr in self._watchpoints and self._memory[addr] != data:
+                self._watch_hits.append((addr, self._memory[addr], data))
             self._memory[addr] = data
         except IndexError:
             raise InvalidAddressError(addr)
 
+    def get_size(self):
+        return self._size_in_words
+
+    def get_block(self, addr, size):
+        """ Returns a list with the `size` words starting at addr """
+        if addr < 0 or addr + size > self._size_in_words:
+            raise InvalidAddressError(addr + size - 1 if addr >= 0 else addr)
+        return self._memory[addr:addr + size]
+
+    def set_block(self, addr, words):
+        if addr < 0 or addr + len(words) > self._size_in_words:
+            raise InvalidAddressError(addr + len(words) - 1 if addr >= 0 else addr)
+        self._memory[addr:addr + len(words)] = words
+
+    def snapshot(self):
+        """ Copy of every word in memory """
+        return self._memory[:]
+
+    def restore(self, snapshot):
+        self._memory[:] = snapshot
+
+    def add_watchpoint(self, addr):
+        """ Stores through set() that change the word at addr are recorded as hits and stop Cpu.run_until() """
+        if not 0 <= addr < self._size_in_words:
+            raise InvalidAddressError(addr)
+        self._watchpoints.add(addr)
+
+    def remove_watchpoint(self, addr):
+        self._watchpoints.discard(addr)
+
+    def get_watchpoints(self):
+        return sorted(self._watchpoints)
+
+    def has_watch_hits(self):
+        return bool(self._watch_hits)
+
+    def get_watch_hits(self):
+        return list(self._watch_hits)
+
+    def clear_watch_hits(self):
+        del self._watch_hits[:]
+
+    def load_file(self, memory_file):
+        """ Sets the words listed in a file of `address=value` lines, like the registers files """
+        with open(memory_file, 'r') as f:
+            for nline, line in enumerate(f, 1):
+                if not line.strip() or line.startswith('#'):
+                    continue
+                try:
+                    (addr, value) = line.split("=")
+                    addr, value = int(addr), int(value)
+                except ValueError:
+                    raise ValueError("Malformed line %d in memory file '%s'." % (nline, memory_file))
+                self.set(addr, value)
+
     def write_program(self, program: list, offset=0):
         logger.info("Writing program in memory from addr %d." % offset)
         for index, instruction in enumerate(program):
             self.set(index + offset, instruction)
         logger.info("Program loaded.")
 
+    def get_pages(self):
+        """ (first address, words) of the regions that hold data, to be read and not modified """
+        return [(0, self._memory)]
+
     def __repr__(self):
         dump = ""
         for i in range(self._size_in_words):
@@ -101,6 +286,134 @@ class Memory:
         return dump
 
 
+class PagedMemory(Memory):
+    """
+    Sparse Memory for large address spaces, 2^32 words by default.
+
+    Words are stored in pages of 2^page_bits words, allocated zero-filled on their first write; reading
+    a page that was never written returns 0 without allocating it. An address is translated with a shift
+    and a dict lookup. Every page written since the last snapshot() or restore() is marked dirty, so
+    restoring that snapshot, as BatchRunner and the sampler do before every run, and diff() only visit
+    the pages the run touched.
+    """
+
+    def __init__(self, size_in_words=1 << 32, page_bits=DEFAULT_PAGE_BITS):
+        self._size_in_words = size_in_words
+        self._page_bits = page_bits
+        self._page_size = 1 << page_bits
+        self._offset_mask = self._page_size - 1
+        self._pages = {}  # {page number: list of words}
+        self._dirty = set()  # Page numbers written since the baseline
+        self._baseline = None  # Last snapshot taken or restored
+        self._watchpoints = set()
+        self._watch_hits = []
+
+    def get_data(self, addr):
+        logger.debug("Returning from memory element in %d.", addr)
+        page = self._pages.get(addr >> self._page_bits)
+        if page is None or addr >= self._size_in_words:
+            if 0 <= addr < self._size_in_words:
+                return 0
+            raise InvalidAddressError(addr)
+        return page[addr & self._offset_mask]
+
+    fetch_instruction = get_data
+
+    def set(self, addr, data):
+        logger.info("Storing in memory data %s in address %d.", data, addr)
+        page_number = addr >> self._page_bits
+        page = self._pages.get(page_number)
+        if page is None:
+            if not 0 <= addr < self._size_in_words:
+                raise InvalidAddressError(addr)
+            if data == 0:  # Already 0, the page is not needed
+                return
+            page = self._pages[page_number] = [0] * self._page_size
+        elif addr >= self._size_in_words:  # Past the end of the last page
+            raise InvalidAddressError(addr)
+        self._dirty.add(page_number)
+        offset = addr & self._offset_mask
+        if self._watchpoints and addr in self._watchpoints and page[offset] != data:
+            self._watch_hits.append((addr, page[offset], data))
+        page[offset] = data
+
+    def get_block(self, addr, size):
+        if addr < 0 or addr + size > self._size_in_words:
+            raise InvalidAddressError(addr + size - 1 if addr >= 0 else addr)
+        return [self.get_data(i) for i in range(addr, addr + size)]
+
+    def set_block(self, addr, words):
+        if addr < 0 or addr + len(words) > self._size_in_words:
+            raise InvalidAddressError(addr + len(words) - 1 if addr >= 0 else addr)
+        for i, word in enumerate(words):
+            self.set(addr + i, word)
+
+    def snapshot(self):
+        """ Copy of the allocated pages, which becomes the baseline of the dirty pages """
+        snapshot = PageSnapshot({number: page[:] for number, page in self._pages.items()})
+        self._baseline = snapshot
+        self._dirty.clear()
+        return snapshot
+
+    def restore(self, snapshot):
+        """ Restoring the baseline only copies back the dirty pages, any other snapshot copies every page """
+        if snapshot is self._baseline:
+            numbers = self._dirty
+        else:
+            numbers = set(self._pages) | set(snapshot.pages)
+            self._baseline = snapshot
+        for number in numbers:
+            page = snapshot.pages.get(number)
+            if page is None:
+                self._pages.pop(number, None)
+            else:
+                self._pages[number] = page[:]
+        self._dirty.clear()
+
+    def diff(self, snapshot):
+        """ Addresses whose word differs from snapshot, in order """
+        numbers = self._dirty if snapshot is self._baseline else set(self._pages) | set(snapshot.pages)
+        zeros = [0] * self._page_size
+        changed = []
+        for number in sorted(numbers):
+            mine = self._pages.get(number, zeros)
+            other = snapshot.pages.get(number, zeros)
+            if mine != other:
+                base = number << self._page_bits
+                changed.extend(base + offset for offset, (a, b) in enumerate(zip(mine, other)) if a != b)
+        return changed
+
+    def get_dirty_pages(self):
+        """ Numbers of the pages written since the last snapshot() or restore() """
+        return sorted(self._dirty)
+
+    def get_num_pages(self):
+        """ Allocated pages """
+        return len(self._pages)
+
+    def get_page_size(self):
+        return self._page_size
+
+    def get_pages(self):
+        return [(number << self._page_bits, self._pages[number]) for number in sorted(self._pages)]
+
+    def __repr__(self):
+        dump = ""
+        for base, words in self.get_pages():
+            for offset, word in enumerate(words):
+                if word != 0:
+                    dump += "%d:\t%s\n" % (base + offset, word)
+        return dump
+
+
+class PageSnapshot:
+    """ Pages of a PagedMemory, by page number """
+    __slots__ = ('pages',)
+
+    def __init__(self, pages):
+        self.pages = pages
+
+
 class InvalidAddressError(Exception):
 
     def __init__(self, addr):
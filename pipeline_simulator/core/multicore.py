@@ -0,0 +1,405 @@
+import array
+import json
+import logging
+from . import architectures
+from .compilers import Parser
+from .counters import Counter
+from .memories import Memory, RegisterSet
+
+
+logger = logging.getLogger(__name__)
+
+
+class CoherenceState:
+    INVALID = 0
+    SHARED = 1
+    EXCLUSIVE = 2
+    MODIFIED = 3
+
+    _names = ('I', 'S', 'E', 'M')
+
+    @classmethod
+    def to_str(cls, state):
+        return cls._names[state]
+
+
+class Protocol:
+    MSI = 'MSI'
+    MESI = 'MESI'
+
+
+class CacheEvent:
+    """ Index of every event in CacheCounters.values """
+    READ_HITS = 0
+    READ_MISSES = 1
+    WRITE_HITS = 2
+    WRITE_MISSES = 3
+    UPGRADES = 4  # Writes to SHARED lines, which invalidate the other copies
+    INVALIDATIONS = 5  # Lines invalidated by the writes of other cores
+    EVICTIONS = 6
+    WRITEBACKS = 7  # MODIFIED lines evicted or flushed to another core
+    STALL_CYCLES = 8  # Cycles the core waited for the bus
+
+    _names = ('read_hits', 'read_misses', 'write_hits', 'write_misses', 'upgrades', 'invalidations',
+              'evictions', 'writebacks', 'stall_cycles')
+
+
+class BusEvent:
+    """ Index of every event in BusCounters.values """
+    READS = 0  # BusRd, read misses
+    READ_EXCLUSIVES = 1  # BusRdX, write misses
+    UPGRADES = 2  # BusUpgr, writes to SHARED lines
+    WRITEBACKS = 3  # MODIFIED lines written back to memory on eviction
+    CACHE_TRANSFERS = 4  # Misses served by the MODIFIED copy of another cache
+    MEMORY_ACCESSES = 5
+    BUSY_CYCLES = 6
+    WAIT_CYCLES = 7  # Cycles the transactions waited for the bus to be free
+
+    _names = ('reads', 'read_exclusives', 'upgrades', 'writebacks', 'cache_transfers', 'memory_accesses',
+              'busy_cycles', 'wait_cycles')
+
+
+class _EventCounters:
+
+    events = None
+
+    def __init__(self):
+        self.values = array.array('q', [0]) * len(self.events._names)
+
+    def get(self, event):
+        return self.values[event]
+
+    def as_dict(self):
+        return dict(zip(self.events._names, self.values))
+
+
+class CacheCounters(_EventCounters):
+    events = CacheEvent
+
+    def get_miss_rate(self):
+        accesses = sum(self.values[event] for event in (CacheEvent.READ_HITS, CacheEvent.READ_MISSES,
+                                                        CacheEvent.WRITE_HITS, CacheEvent.WRITE_MISSES))
+        misses = self.values[CacheEvent.READ_MISSES] + self.values[CacheEvent.WRITE_MISSES]
+        return misses / accesses if accesses else None
+
+    def as_dict(self):
+        return dict(super(CacheCounters, self).as_dict(), miss_rate=self.get_miss_rate())
+
+
+class BusCounters(_EventCounters):
+    events = BusEvent
+
+
+class Cache:
+    """
+    Private cache of a core, set associative with LRU replacement and write-back.
+
+    The cache only models timing: it keeps the tag and coherence state of every line, while the data
+    always lives in the shared Memory. Accesses are performed on the memory at once, and a miss makes
+    the core wait for the bus transaction that brings the line. It is passed as the `memory` of the core,
+    so loads and stores go through it; instructions are fetched from the private copy of the program.
+    """
+
+    def __init__(self, core_id, bus, num_sets=64, ways=2, line_size=4):
+        self._core_id = core_id
+        self._bus = bus
+        self._memory = bus.get_memory()
+        self._num_sets = num_sets
+        self._ways = ways
+        self._line_size = line_size
+        self._sets = [{} for _ in range(num_sets)]  # {line: state}, least recently used first
+        self._program = []
+        self._stall_until = 0  # Cycle the pending miss is served
+        self.counters = CacheCounters()
+        bus.attach(self)
+
+    def get_id(self):
+        return self._core_id
+
+    def get_state(self, addr):
+        line = addr // self._line_size
+        return self._sets[line % self._num_sets].get(line, CoherenceState.INVALID)
+
+    def is_stalled(self, cycle):
+        return self._stall_until > cycle
+
+    # Memory interface of the core
+
+    def get_data(self, addr):
+        data = self._memory.get_data(addr)
+        self.__access(addr // self._line_size, write=False)
+        return data
+
+    def set(self, addr, data):
+        self._memory.set(addr, data)
+        self.__access(addr // self._line_size, write=True)
+
+    def fetch_instruction(self, addr):
+        if 0 <= addr < len(self._program):
+            return self._program[addr]
+        return self._memory.get_data(addr)
+
+    def write_program(self, program: list, offset=0):
+        if offset:
+            raise ValueError("Programs of a multicore system are loaded at address 0.")
+        self._program = list(program)
+
+    def get_size(self):
+        return self._memory.get_size()
+
+    def has_watch_hits(self):
+        return self._memory.has_watch_hits()
+
+    def clear_watch_hits(self):
+        self._memory.clear_watch_hits()
+
+    # Coherence
+
+    def snoop(self, line, exclusive):
+        """
+        Reacts to a transaction of another cache on line and returns the state the line had.
+        Exclusive transactions invalidate it, reads demote it to SHARED.
+        """
+        lines = self._sets[line % self._num_sets]
+        state = lines.get(line, CoherenceState.INVALID)
+        if state == CoherenceState.INVALID:
+            return state
+
+        if state == CoherenceState.MODIFIED:
+            self.counters.values[CacheEvent.WRITEBACKS] += 1
+        if exclusive:
+            del lines[line]
+            self.counters.values[CacheEvent.INVALIDATIONS] += 1
+        elif state != CoherenceState.SHARED:
+            lines[line] = CoherenceState.SHARED
+        return state
+
+    def __access(self, line, write):
+        values = self.counters.values
+        lines = self._sets[line % self._num_sets]
+        state = lines.pop(line, CoherenceState.INVALID)  # Reinserted as the most recently used
+
+        if not write:
+            if state != CoherenceState.INVALID:
+                values[CacheEvent.READ_HITS] += 1
+            else:
+                values[CacheEvent.READ_MISSES] += 1
+                self.__make_room(lines)
+                shared = self.__wait(self._bus.read(self, line))
+                state = CoherenceState.SHARED if shared or self._bus.get_protocol() == Protocol.MSI \
+                    else CoherenceState.EXCLUSIVE
+
+        else:
+            if state == CoherenceState.MODIFIED or state == CoherenceState.EXCLUSIVE:  # E -> M is silent
+                values[CacheEvent.WRITE_HITS] += 1
+            elif state == CoherenceState.SHARED:
+                values[CacheEvent.WRITE_HITS] += 1
+                values[CacheEvent.UPGRADES] += 1
+                self.__wait(self._bus.upgrade(self, line))
+            else:
+                values[CacheEvent.WRITE_MISSES] += 1
+                self.__make_room(lines)
+                self.__wait(self._bus.read_exclusive(self, line))
+            state = CoherenceState.MODIFIED
+
+        lines[line] = state
+
+    def __make_room(self, lines):
+        if len(lines) < self._ways:
+            return
+        victim = next(iter(lines))
+        self.counters.values[CacheEvent.EVICTIONS] += 1
+        if lines.pop(victim) == CoherenceState.MODIFIED:
+            self.counters.values[CacheEvent.WRITEBACKS] += 1
+            self._bus.writeback(self, victim)
+
+    def __wait(self, result):
+        completion, shared = result
+        self._stall_until = max(self._stall_until, completion)
+        return shared
+
+    def __repr__(self):
+        return "Cache #%d: %s" % (self._core_id, " ".join(
+            "%d:%s" % (line, CoherenceState.to_str(state))
+            for lines in self._sets for line, state in sorted(lines.items())))
+
+
+class Bus:
+    """
+    Snooping bus between the caches and the shared memory. It serves one transaction at a time: a
+    transaction waits until the bus is free and then holds it for its latency. Every transaction
+    returns the cycle it completes and whether another cache kept a copy of the line.
+    """
+
+    def __init__(self, memory: Memory, protocol=Protocol.MESI, bus_cycles=1, memory_latency=10, cache_latency=3):
+        if protocol not in (Protocol.MSI, Protocol.MESI):
+            raise ValueError("Unknown coherence protocol '%s'." % protocol)
+        self._memory = memory
+        self._protocol = protocol
+        self._bus_cycles = bus_cycles  # Arbitration and address
+        self._memory_latency = memory_latency  # Line transfer from or to memory
+        self._cache_latency = cache_latency  # Line transfer from another cache
+        self._caches = []
+        self._busy_until = 0
+        self.cycle = 0  # Set by the system every cycle
+        self.counters = BusCounters()
+
+    def attach(self, cache: Cache):
+        self._caches.append(cache)
+
+    def get_memory(self):
+        return self._memory
+
+    def get_protocol(self):
+        return self._protocol
+
+    def read(self, requester, line):
+        """ BusRd: a MODIFIED copy is flushed to the requester, the other copies become SHARED """
+        self.counters.values[BusEvent.READS] += 1
+        states = self.__snoop(requester, line, exclusive=False)
+        return self.__transfer(CoherenceState.MODIFIED in states), any(states)
+
+    def read_exclusive(self, requester, line):
+        """ BusRdX: every other copy is invalidated """
+        self.counters.values[BusEvent.READ_EXCLUSIVES] += 1
+        states = self.__snoop(requester, line, exclusive=True)
+        return self.__transfer(CoherenceState.MODIFIED in states), False
+
+    def upgrade(self, requester, line):
+        """ BusUpgr: the requester already has the data, the other SHARED copies are invalidated """
+        self.counters.values[BusEvent.UPGRADES] += 1
+        self.__snoop(requester, line, exclusive=True)
+        return self.__hold(self._bus_cycles), False
+
+    def writeback(self, requester, line):
+        self.counters.values[BusEvent.WRITEBACKS] += 1
+        self.counters.values[BusEvent.MEMORY_ACCESSES] += 1
+        return self.__hold(self._bus_cycles + self._memory_latency), False
+
+    def __snoop(self, requester, line, exclusive):
+        return [cache.snoop(line, exclusive) for cache in self._caches if cache is not requester]
+
+    def __transfer(self, from_cache):
+        if from_cache:
+            self.counters.values[BusEvent.CACHE_TRANSFERS] += 1
+            return self.__hold(self._bus_cycles + self._cache_latency)
+        self.counters.values[BusEvent.MEMORY_ACCESSES] += 1
+        return self.__hold(self._bus_cycles + self._memory_latency)
+
+    def __hold(self, latency):
+        values = self.counters.values
+        start = max(self.cycle, self._busy_until)
+        values[BusEvent.WAIT_CYCLES] += start - self.cycle
+        values[BusEvent.BUSY_CYCLES] += latency
+        self._busy_until = start + latency
+        return self._busy_until
+
+
+class MulticoreSystem:
+    """
+    N cores running the same program over one shared Memory, each one with its own registers and a private
+    Cache kept coherent by a snooping Bus with the MSI or MESI protocol. Cores tell themselves apart by
+    their initial registers. Caches are blocking: a core does not step while it waits for the bus,
+    and those cycles are counted as memory stalls of the core.
+
+    Every core parses its own copy of the program, which is also written once into the shared memory.
+    """
+
+    def __init__(self, source, num_cores, registers_images=None, memory_size=2048,
+                 cpu_class=architectures.PipelinedCpu, protocol=Protocol.MESI, num_sets=64, ways=2, line_size=4,
+                 bus_cycles=1, memory_latency=10, cache_latency=3, num_registers=32, **cpu_kwargs):
+        """
+        source is the path of a program file or a list of source lines. registers_images, if given,
+        holds a dict {register id: value} per core.
+        """
+        if registers_images is not None and len(registers_images) != num_cores:
+            raise ValueError("There must be one registers image per core.")
+
+        self._memory = Memory(memory_size)
+        self._bus = Bus(self._memory, protocol, bus_cycles, memory_latency, cache_latency)
+        self._cores = []
+        self._caches = []
+        self._registers = []
+        self._cycle = 0
+
+        for core_id in range(num_cores):
+            registers = RegisterSet(num_registers=num_registers)
+            cache = Cache(core_id, self._bus, num_sets, ways, line_size)
+            parser = Parser(registers=registers, memory=cache)
+            program = parser.parse(source) if isinstance(source, str) else parser.parse_lines(source)
+            cache.write_program(program)
+            if core_id == 0:
+                self._memory.write_program(program)
+            for register_id, value in (registers_images[core_id] if registers_images else {}).items():
+                registers.get(register_id).set(value)
+
+            self._cores.append(cpu_class(registers=registers, memory=cache, **cpu_kwargs))
+            self._caches.append(cache)
+            self._registers.append(registers)
+
+    def get_memory(self):
+        return self._memory
+
+    def get_bus(self):
+        return self._bus
+
+    def get_cores(self):
+        return self._cores
+
+    def get_caches(self):
+        return self._caches
+
+    def get_registers(self, core_id):
+        return self._registers[core_id]
+
+    def get_cycles(self):
+        return self._cycle
+
+    def start(self):
+        for core in self._cores:
+            core.start()
+
+    def is_halted(self):
+        return all(core.is_halted() for core in self._cores)
+
+    def step(self):
+        """ Runs one cycle of every core that has not halted """
+        cycle = self._cycle
+        self._bus.cycle = cycle
+        for core, cache in zip(self._cores, self._caches):
+            if core.is_halted():
+                continue
+            if cache.is_stalled(cycle):
+                values = core.get_counters().values
+                values[Counter.CYCLES] += 1
+                values[Counter.MEMORY_STALLS] += 1
+                cache.counters.values[CacheEvent.STALL_CYCLES] += 1
+                continue
+            core.step()
+        self._cycle += 1
+
+    def run(self, max_cycles=None):
+        """ Runs until every core halts or for max_cycles cycles. Returns the number of cycles run. """
+        cycles = 0
+        step = self.step
+        while cycles != max_cycles and not self.is_halted():
+            step()
+            cycles += 1
+        logger.info("%d cores ran %d cycles." % (len(self._cores), cycles))
+        return cycles
+
+    def as_dict(self):
+        """ Per-core CPU and cache counters, and bus counters """
+        return {
+            'cycles': self._cycle,
+            'protocol': self._bus.get_protocol(),
+            'cores': [{'id': core_id, 'cpu': core.get_counters().as_dict(), 'cache': cache.counters.as_dict()}
+                      for core_id, (core, cache) in enumerate(zip(self._cores, self._caches))],
+            'bus': dict(self._bus.counters.as_dict(),
+                        utilization=self._bus.counters.get(BusEvent.BUSY_CYCLES) / self._cycle if self._cycle else 0.0),
+        }
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+        logger.info("Multicore counters written to '%s'." % path)
@@ -0,0 +1,152 @@
+import logging
+import time
+from . import architectures
+
+
+logger = logging.getLogger(__name__)
+
+# (probe name, class, method name) of the hot paths of every CPU
+DEFAULT_PROBES = (
+    ('PipelinedCpu.step', architectures.PipelinedCpu, 'step'),
+    ('Pipeline.fetch', architectures.Pipeline, 'fetch'),
+    ('Pipeline.decode', architectures.Pipeline, 'decode'),
+    ('Pipeline.execute', architectures.Pipeline, 'execute'),
+    ('Pipeline.memory', architectures.Pipeline, 'memory'),
+    ('Pipeline.writeback', architectures.Pipeline, 'writeback'),
+    ('Pipeline.is_empty', architectures.Pipeline, 'is_empty'),
+    ('Pipeline.update_chronogram', architectures.Pipeline, 'update_chronogram'),
+    ('CentralizedRSCpu.step', architectures.CentralizedRSCpu, 'step'),
+    ('CentralizedRSCpu.issue', architectures.CentralizedRSCpu, '_CentralizedRSCpu__issue'),
+    ('CentralizedRSCpu.execute', architectures.CentralizedRSCpu, '_CentralizedRSCpu__execute'),
+    ('ShelvingBuffer.add', architectures.ShelvingBuffer, 'add'),
+    ('ShelvingBuffer.dispatch', architectures.ShelvingBuffer, 'dispatch_next_instruction_to_eu'),
+    ('ShelvingBuffer.update_chronogram', architectures.ShelvingBuffer, 'update_chronogram'),
+    ('ExecutionUnit.execute', architectures.ExecutionUnit, 'execute'),
+    ('ScoreboardCpu.step', architectures.ScoreboardCpu, 'step'),
+    ('ScoreboardCpu.write_results', architectures.ScoreboardCpu, '_ScoreboardCpu__write_results'),
+    ('ScoreboardCpu.read_operands', architectures.ScoreboardCpu, '_ScoreboardCpu__read_operands'),
+    ('ScoreboardCpu.issue', architectures.ScoreboardCpu, '_ScoreboardCpu__issue'),
+    ('FunctionalCpu.run', architectures.FunctionalCpu, 'run'),
+    ('Chronogram.set_instruction_stage', architectures.Chronogram, 'set_instruction_stage'),
+    ('Chronogram.print', architectures.Chronogram, 'print'),
+    ('logging', logging.Logger, 'info'),
+)
+
+
+class Profiler:
+    """
+    Opt-in instrumentation of the simulator hot paths.
+
+    While enabled, every probed method is replaced on its class by a wrapper that counts its calls and
+    accumulates its inclusive and self wall-clock time, keyed by the stack of enclosing probes.
+    Disabling puts the original methods back, so a disabled profiler costs nothing.
+    Can be used as a context manager.
+    """
+
+    def __init__(self, probes=DEFAULT_PROBES):
+        self._probes = probes
+        self._originals = []  # (class, method name, attribute in the class __dict__ or None)
+        self._path = []  # Names of the active probes, outermost first
+        self._children = []  # Time spent in the nested probes of each active probe
+        self._stacks = {}  # {tuple of probe names: [calls, total ns, self ns]}
+
+    def enable(self):
+        if self._originals:
+            raise ProfilerError("The profiler is already enabled.")
+
+        for name, cls, method in self._probes:
+            self._originals.append((cls, method, cls.__dict__.get(method)))
+            setattr(cls, method, self.__wrap(name, getattr(cls, method)))
+        logger.info("Profiling %d probes." % len(self._probes))
+
+    def disable(self):
+        for cls, method, original in reversed(self._originals):
+            if original is None:  # The method was inherited
+                delattr(cls, method)
+            else:
+                setattr(cls, method, original)
+        self._originals = []
+
+    def is_enabled(self):
+        return bool(self._originals)
+
+    def reset(self):
+        self._stacks.clear()
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.disable()
+
+    def __wrap(self, name, function):
+        path = self._path
+        children = self._children
+        stacks = self._stacks
+        clock = time.perf_counter_ns
+
+        def probe(*args, **kwargs):
+            path.append(name)
+            children.append(0)
+            start = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = clock() - start
+                key = tuple(path)
+                path.pop()
+                nested = children.pop()
+                if children:
+                    children[-1] += elapsed
+
+                stack = stacks.get(key)
+                if stack is None:
+                    stack = stacks[key] = [0, 0, 0]
+                stack[0] += 1
+                stack[1] += elapsed
+                stack[2] += elapsed - nested
+
+        probe.__wrapped__ = function
+        probe.__name__ = function.__name__
+        return probe
+
+    def get_results(self):
+        """
+        Returns {probe name: (calls, total seconds, self seconds)} aggregated over every stack.
+        Total time of a recursive probe is only counted at its outermost call.
+        """
+        results = {}
+        for key, (calls, total, own) in self._stacks.items():
+            name = key[-1]
+            result = results.setdefault(name, [0, 0, 0])
+            result[0] += calls
+            if name not in key[:-1]:
+                result[1] += total
+            result[2] += own
+        return {name: (calls, total / 1e9, own / 1e9) for name, (calls, total, own) in results.items()}
+
+    def report(self, file=None):
+        """ Prints the probes sorted by self time """
+        lines = ["%-36s %10s %12s %12s %10s" % ('probe', 'calls', 'total (s)', 'self (s)', 'us/call')]
+        results = sorted(self.get_results().items(), key=lambda item: item[1][2], reverse=True)
+        for name, (calls, total, own) in results:
+            lines.append("%-36s %10d %12.4f %12.4f %10.2f" % (name, calls, total, own, total / calls * 1e6))
+        print("\n".join(lines), file=file)
+
+    def folded(self):
+        """
+        Lines in the folded stack format of flamegraph.pl and speedscope: probe names separated by ';'
+        followed by the self time of that stack in microseconds
+        """
+        return ["%s %d" % (';'.join(key), own // 1000)
+                for key, (calls, total, own) in sorted(self._stacks.items()) if own >= 1000]
+
+    def write_folded(self, path):
+        with open(path, 'w') as f:
+            for line in self.folded():
+                f.write(line + "\n")
+
+
+class ProfilerError(Exception):
+    pass
@@ -0,0 +1,226 @@
+import array
+import contextlib
+import hashlib
+import json
+import logging
+import os
+from .instructions import Instruction, AluInstruction, MemInstruction
+
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 4  # Part of every key, bumping it invalidates the entries of older versions
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+EVICTION_TARGET = 0.9  # Fraction of max_bytes left by an eviction, so the next one is not due at the next put
+RESCAN_INTERVAL = 1000  # Puts between full scans, which correct the size estimate for entries removed by hand
+
+
+def digest_memory(memory):
+    """
+    SHA-256 of the class, size and words of memory, program included. Only the allocated pages of a
+    PagedMemory are read, so its size tells apart the address spaces that fault from the ones that don't.
+    """
+    h = hashlib.sha256(repr((memory.__class__.__name__, memory.get_size())).encode())
+    for base, words in memory.get_pages():
+        data = array.array('q', (0 if isinstance(word, Instruction) else word for word in words))
+        code = [(base + offset, word.encode()) for offset, word in enumerate(words) if isinstance(word, Instruction)]
+        h.update(repr((base, len(words), code)).encode())
+        h.update(data.tobytes())
+    return h.hexdigest()
+
+
+def digest_registers(registers):
+    return hashlib.sha256(registers.get_values().tobytes()).hexdigest()
+
+
+def collect(cpu, watch=()):
+    """ Result of a run: final counters and registers, the words at the watch addresses and digests of the state """
+    registers = cpu._registers
+    memory = cpu._memory
+    return {
+        'halted': cpu.is_halted(),
+        'counters': cpu.get_counters().as_dict(),
+        'registers': list(registers.get_values()),
+        'memory': {str(addr): memory.get_data(addr) for addr in watch},
+        'registers_digest': digest_registers(registers),
+        'memory_digest': digest_memory(memory),
+    }
+
+
+class ResultCache:
+    """
+    Content-addressed on-disk cache of simulation results.
+
+    A run is keyed by a hash of the CPU model and its timing parameters (phase cycles, scalability, execution
+    units and the functional unit latencies), the initial PC, registers and memory, program included, and
+    the stop conditions. Entries are JSON files named after their key, written to a temporary file and
+    renamed, so several processes can share the directory. Reading an entry refreshes its modification
+    time, and once the directory grows past max_bytes the least recently used entries are evicted.
+
+    The processes keep a running estimate of the bytes in the directory in its 'size' file, so a put only
+    scans the entries when the estimate is past max_bytes or every RESCAN_INTERVAL puts.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._hits = 0
+        self._misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, cpu, max_cycles=None, watch=()):
+        """ Key of running cpu, which has not started yet, for up to max_cycles cycles """
+        if len(getattr(cpu, '_threads', ())) > 1:
+            raise ValueError("Multithreaded runs are not cached.")
+        if cpu._memory is None:
+            raise ValueError("Trace replays are not cached.")
+
+        config = {
+            'version': FORMAT_VERSION,
+            'cpu': cpu.__class__.__name__,
+            'pc': cpu._pc,
+            'phase_cycles': list(cpu._PHASE_CYCLES),
+            'scalability': cpu._scalability,
+            'execution_units': [unit.__class__.__name__ for unit in getattr(cpu, '_execution_units', ())],
+            'fu_cycles': sorted(list(AluInstruction.fu_cycles.items()) + list(MemInstruction.fu_cycles.items())),
+            'max_cycles': max_cycles,
+            'breakpoints': cpu.get_breakpoints(),
+            'memory_watchpoints': cpu._memory.get_watchpoints(),
+            'register_watchpoints': cpu._registers.get_watchpoints(),
+            'watch': list(watch),
+            'registers': digest_registers(cpu._registers),
+            'memory': digest_memory(cpu._memory),
+        }
+        return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key):
+        """ Cached result of key, None on a miss """
+        path = self.__path(key)
+        try:
+            with open(path) as f:
+                result = json.load(f)
+            os.utime(path)
+        except (FileNotFoundError, ValueError):  # Missing, evicted meanwhile or half written by a crashed writer
+            self._misses += 1
+            return None
+        self._hits += 1
+        return result
+
+    def put(self, key, result):
+        import tempfile
+        path = self.__path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(result, f)
+                size = f.tell()
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+        with self.__lock():
+            estimate, puts = self.__read_estimate()
+            if estimate is None or estimate + size > self._max_bytes or puts + 1 >= RESCAN_INTERVAL:
+                self.__evict()
+            else:
+                self.__write_estimate(estimate + size, puts + 1)
+
+    def run(self, cpu, max_cycles=None, watch=()):
+        """
+        Starts and runs cpu, unless the result of the same run is cached. Returns the result of collect(),
+        with 'cached' telling whether it comes from the cache; on a hit cpu is left untouched.
+        """
+        key = self.key(cpu, max_cycles, watch)
+        result = self.get(key)
+        if result is not None:
+            return dict(result, cached=True)
+
+        cpu.start()
+        cpu.run(max_cycles)
+        result = collect(cpu, watch)
+        self.put(key, result)
+        return dict(result, cached=False)
+
+    def evict(self):
+        """ Removes the least recently used entries if the cache does not fit in max_bytes """
+        with self.__lock():
+            self.__evict()
+
+    def __evict(self):
+        """ Scans the entries and evicts the least recently used ones down to EVICTION_TARGET. Holds the lock. """
+        entries = []
+        total = 0
+        for path in self.__entries():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, path, stat.st_size))
+            total += stat.st_size
+
+        if total > self._max_bytes:
+            entries.sort()
+            evicted = 0
+            for _, path, size in entries:
+                if total <= self._max_bytes * EVICTION_TARGET:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                evicted += 1
+            logger.info("%d results evicted from the cache." % evicted)
+        self.__write_estimate(total, 0)
+
+    def clear(self):
+        with self.__lock():
+            for path in self.__entries():
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            self.__write_estimate(0, 0)
+
+    def get_stats(self):
+        """ Hits and misses of this instance, and entries and bytes in the directory """
+        sizes = []
+        for path in self.__entries():
+            try:
+                sizes.append(os.path.getsize(path))
+            except FileNotFoundError:
+                pass
+        return {'hits': self._hits, 'misses': self._misses, 'entries': len(sizes), 'bytes': sum(sizes)}
+
+    @contextlib.contextmanager
+    def __lock(self):
+        """ Exclusive lock of the directory, one process evicts or updates the size estimate at a time """
+        import fcntl
+        with open(os.path.join(self._directory, 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def __read_estimate(self):
+        """ (bytes, puts since the last scan) of the size file, (None, 0) if it is missing or unreadable """
+        try:
+            with open(os.path.join(self._directory, 'size')) as f:
+                estimate, puts = map(int, f.read().split())
+        except (FileNotFoundError, ValueError):
+            return None, 0
+        return estimate, puts
+
+    def __write_estimate(self, estimate, puts):
+        with open(os.path.join(self._directory, 'size'), 'w') as f:
+            f.write("%d %d\n" % (estimate, puts))
+
+    def __path(self, key):
+        return os.path.join(self._directory, key[:2], key + '.json')
+
+    def __entries(self):
+        for bucket in os.scandir(self._directory):
+            if bucket.is_dir():
+                for entry in os.scandir(bucket.path):
+                    if entry.name.endswith('.json'):
+                        yield entry.path
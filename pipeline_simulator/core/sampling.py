@@ -0,0 +1,140 @@
+import logging
+import math
+import statistics
+import time
+from . import architectures
+from .memories import Memory, RegisterSet
+
+
+logger = logging.getLogger(__name__)
+
+
+class SampledSimulation:
+    """
+    SMARTS-style sampling. The program runs on a FunctionalCpu, and every `period` instructions
+    a detailed timing model is started at the current PC: it runs `warmup` instructions to fill
+    its pipeline and then `measure` instructions whose CPI is kept as a sample.
+
+    The detailed windows run on the real registers and memory, which are restored afterwards,
+    so the functional run is the only one that moves the architectural state forward.
+    """
+
+    def __init__(self, registers: RegisterSet, memory: Memory, cpu_class=architectures.PipelinedCpu,
+                 period=1000, warmup=100, measure=100, confidence=0.95, pc=0, **cpu_kwargs):
+        if warmup + measure > period:
+            raise ValueError("Warm-up and measurement windows must fit in the sampling period.")
+
+        self._registers = registers
+        self._memory = memory
+        self._cpu_class = cpu_class
+        self._period = period
+        self._warmup = warmup
+        self._measure = measure
+        self._confidence = confidence
+        self._pc = pc
+        self._cpu_kwargs = cpu_kwargs
+
+    def run(self):
+        functional = architectures.FunctionalCpu(registers=self._registers, memory=self._memory, pc=self._pc)
+        functional.start()
+
+        samples = []
+        detailed_instructions = 0
+        detailed_time = 0.0
+        start_time = time.perf_counter()
+
+        while not functional.is_halted():
+            functional.run(max_cycles=self._period - self._warmup - self._measure)
+            if functional.is_halted():
+                break
+
+            sample_start = time.perf_counter()
+            cpi, retired = self.__sample(functional.get_pc())
+            detailed_time += time.perf_counter() - sample_start
+            detailed_instructions += retired
+            if cpi is not None:
+                samples.append(cpi)
+
+            functional.run(max_cycles=self._warmup + self._measure)
+
+        wall_time = time.perf_counter() - start_time
+        return SamplingResult(
+            samples=samples,
+            instructions=functional.get_executed_instructions(),
+            confidence=self._confidence,
+            wall_time=wall_time,
+            detailed_rate=detailed_instructions / detailed_time if detailed_time else None)
+
+    def __sample(self, pc):
+        """
+        Runs a detailed warm-up and measurement window from pc. Returns the CPI measured, or None if the
+        program halted before the measurement window, and the number of instructions retired.
+        """
+        registers_snapshot = self._registers.snapshot()
+        memory_snapshot = self._memory.snapshot()
+        cpu = self._cpu_class(registers=self._registers, memory=self._memory, pc=pc, **self._cpu_kwargs)
+        counters = cpu.get_counters()
+
+        cpu.start()
+        if self._warmup:
+            cpu.run_until(predicate=lambda cpu: counters.get_instructions() >= self._warmup)
+
+        window_cycle = counters.get_cycles()
+        window_instruction = counters.get_instructions()
+        if not cpu.is_halted() and self._measure:
+            cpu.run_until(predicate=lambda cpu: counters.get_instructions() - window_instruction >= self._measure)
+
+        cycles = counters.get_cycles() - window_cycle
+        instructions = counters.get_instructions() - window_instruction
+        retired = counters.get_instructions()
+
+        self._registers.restore(registers_snapshot)
+        self._memory.restore(memory_snapshot)
+
+        if instructions == 0:
+            return None, retired
+
+        logger.info("Sample at PC %d: %d cycles, %d instructions." % (pc, cycles, instructions))
+        return cycles / instructions, retired
+
+
+class SamplingResult:
+
+    def __init__(self, samples, instructions, confidence, wall_time, detailed_rate):
+        self.samples = samples
+        self.instructions = instructions
+        self.confidence = confidence
+        self.wall_time = wall_time
+        self._detailed_rate = detailed_rate
+
+    @property
+    def cpi(self):
+        return statistics.mean(self.samples) if self.samples else None
+
+    @property
+    def confidence_interval(self):
+        """ Half width of the confidence interval of the CPI """
+        if len(self.samples) < 2:
+            return None
+        z = statistics.NormalDist().inv_cdf((1 + self.confidence) / 2)
+        return z * statistics.stdev(self.samples) / math.sqrt(len(self.samples))
+
+    @property
+    def estimated_cycles(self):
+        return self.cpi * self.instructions if self.samples else None
+
+    @property
+    def speedup(self):
+        """ Estimated time of a full detailed simulation divided by the time of the sampled one """
+        if not self._detailed_rate or not self.wall_time:
+            return None
+        return self.instructions / self._detailed_rate / self.wall_time
+
+    def __repr__(self):
+        if not self.samples:
+            return "No samples taken over %d instructions" % self.instructions
+
+        interval = self.confidence_interval
+        return "CPI %.3f +- %s (%d%% confidence, %d samples, %d instructions, speedup x%.1f)" % (
+            self.cpi, "%.3f" % interval if interval is not None else "?", round(self.confidence * 100),
+            len(self.samples), self.instructions, self.speedup or 0)
@@ -0,0 +1,317 @@
+import collections
+import logging
+import mmap
+import struct
+from .instructions import Instruction, Opcode, AluInstruction, MemInstruction, BranchInstruction, \
+    HaltSignal, JumpSignal, FunctionalUnitNotFinishedSignal
+from .memories import RegisterSet
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'PSTRACE\0'
+FORMAT_VERSION = 1
+TAKEN = 1  # Flag of the branches that jumped
+
+# Header: magic, format version, registers of the traced CPU
+_HEADER = struct.Struct('<8sHH4x')
+# Record: pc, opcode, a, b, flags, c, effective address (-1 if the instruction does not access memory).
+# a, b and c are the fields of Instruction.encode()
+_RECORD = struct.Struct('<IBBBBqq')
+
+
+class TraceWriter:
+    """
+    Writes the dynamic instruction stream of a CPU as fixed-size binary records, in program order.
+    """
+
+    def __init__(self, path, num_registers=32):
+        self._path = path
+        self._file = open(path, 'wb')
+        self._file.write(_HEADER.pack(MAGIC, FORMAT_VERSION, num_registers))
+        self._pack = _RECORD.pack
+        self._records = 0
+
+    def record(self, pc, opcode, a, b, c, addr=-1, taken=False):
+        self._file.write(self._pack(pc, opcode, a, b, TAKEN if taken else 0, c, addr))
+        self._records += 1
+
+    def record_uop(self, uop):
+        """ Records a retired MicroOp, which keeps its effective address and branch outcome """
+        opcode, a, b, c = uop.get_instruction().encode()
+        addr = uop._computed_mem_addr
+        taken = opcode in BranchInstruction.opcodes and uop._tmp
+        self.record(uop.get_pc(), opcode, a, b, c, -1 if addr is None else addr, taken)
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+            logger.info("%d trace records written to '%s'." % (self._records, self._path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ReorderingTracer:
+    """
+    Tracer of the CPUs whose execution units finish out of order. Instructions are announced with their
+    id when they issue, and the record of each one is held back until every instruction issued before
+    it has retired, so the trace is written in program order. Records still held back when the trace
+    is closed, after instructions that never retired, are dropped.
+    """
+
+    def __init__(self, tracer: TraceWriter):
+        self._tracer = tracer
+        self._issued = collections.deque()  # Ids of the instructions not written yet, in issue order
+        self._retired = {}  # {id: record} of the retired instructions not written yet
+
+    def issue(self, instruction_id):
+        self._issued.append(instruction_id)
+
+    def record(self, pc, opcode, a, b, c, addr=-1, taken=False):
+        self._tracer.record(pc, opcode, a, b, c, addr, taken)
+
+    def record_uop(self, uop, instruction_id):
+        opcode, a, b, c = uop.get_instruction().encode()
+        addr = uop._computed_mem_addr
+        taken = opcode in BranchInstruction.opcodes and uop._tmp
+        self._retired[instruction_id] = (uop.get_pc(), opcode, a, b, c, -1 if addr is None else addr, taken)
+
+        issued = self._issued
+        retired = self._retired
+        while issued and issued[0] in retired:
+            self._tracer.record(*retired.pop(issued.popleft()))
+
+    def close(self):
+        if self._retired:
+            logger.warning("%d trace records dropped, older instructions did not retire." % len(self._retired))
+        self._tracer.close()
+
+
+class TraceReader:
+    """
+    Memory-mapped trace file. Records are unpacked straight from the mapping, so iterating over
+    a trace streams it from the page cache without reading it into memory first.
+    Iterating yields (pc, opcode, a, b, flags, c, addr) tuples.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # Empty file
+            self._file.close()
+            raise TraceError("'%s' is not a trace file." % path)
+
+        magic, version, self.num_registers = _HEADER.unpack_from(self._map) \
+            if len(self._map) >= _HEADER.size else (None, None, None)
+        if magic != MAGIC:
+            self.close()
+            raise TraceError("'%s' is not a trace file." % path)
+        if version != FORMAT_VERSION:
+            self.close()
+            raise TraceError("Trace format version %d is not supported." % version)
+        if (len(self._map) - _HEADER.size) % _RECORD.size:
+            logger.warning("Trace '%s' ends with a truncated record." % path)
+
+    def __len__(self):
+        return (len(self._map) - _HEADER.size) // _RECORD.size
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return _RECORD.unpack_from(self._map, _HEADER.size + index * _RECORD.size)
+
+    def __iter__(self):
+        end = _HEADER.size + len(self) * _RECORD.size
+        return _RECORD.iter_unpack(memoryview(self._map)[_HEADER.size:end])
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class TraceReplay:
+    """
+    Feeds a timing CPU with the instructions of a trace instead of the ones in Memory: pass it as the
+    `trace` argument of the CPU. Instructions only lock and unlock registers to model dependencies,
+    branches follow the recorded outcomes and memory instructions carry the recorded addresses, so
+    neither the memory nor the register values are touched.
+
+    Fetches that do not match the next record are wrong-path fetches past a taken branch or the HALT,
+    which are flushed before they are decoded. A trace that does not end with a HALT gets one.
+    """
+
+    def __init__(self, trace, registers: RegisterSet):
+        """ trace is a TraceReader, the path of a trace file or an iterator of records like the ones of a TraceReader """
+        if isinstance(trace, str):
+            trace = TraceReader(trace)
+        self._reader = trace if isinstance(trace, TraceReader) else None
+        self._records = iter(trace)
+        self._registers = registers
+        self._next = next(self._records, None)
+        self._instructions = {}  # {pc: TraceInstruction}
+        self._branches = collections.deque()  # Outcomes of the fetched branches, in program order
+        self._addresses = collections.deque()  # Addresses of the fetched memory instructions
+        self._fetched = 0
+        self._last_opcode = None
+
+    def fetch(self, pc):
+        record = self._next
+        if record is None and self._last_opcode != Opcode.HALT:
+            # The traced run was stopped before its HALT, the replay halts where the trace ends
+            record = (pc, Opcode.HALT, 0, 0, 0, 0, -1)
+        elif record is None or record[0] != pc:
+            return self._instructions.get(pc, 0)
+        else:
+            self._next = next(self._records, None)
+        self._fetched += 1
+
+        pc, opcode, a, b, flags, c, addr = record
+        self._last_opcode = opcode
+        instruction = self._instructions.get(pc)
+        if instruction is None or instruction.encode() != (opcode, a, b, c):  # Code can be overwritten
+            instruction = self._instructions[pc] = TraceInstruction(self, opcode, a, b, c)
+        if opcode in BranchInstruction.opcodes:
+            self._branches.append(bool(flags & TAKEN))
+        elif opcode in MemInstruction.opcodes:
+            self._addresses.append(addr)
+        return instruction
+
+    def get_fetched(self):
+        """ Instructions fetched from the trace so far """
+        return self._fetched
+
+    def is_exhausted(self):
+        return self._next is None
+
+    def close(self):
+        self._records = iter(())  # Releases the mapping so it can be closed
+        self._next = None
+        if self._reader is not None:
+            self._reader.close()
+
+
+class TraceInstruction(Instruction):
+    """
+    Timing-only instruction rebuilt from a trace record
+    """
+    __slots__ = ('_replay', '_fields', '_kind')
+
+    _ALU, _MEMORY, _BRANCH, _JUMP, _HALT = range(5)
+
+    def __init__(self, replay: TraceReplay, opcode, a, b, c):
+        get = replay._registers.get
+        self._opcode = opcode
+        self._replay = replay
+        self._fields = (a, b, c)
+        if opcode in AluInstruction.opcodes:
+            self._kind = self._ALU
+            self._read_registers = (get(b), get(c))
+            self._written_registers = (get(a),)
+        elif opcode == Opcode.LOAD:
+            self._kind = self._MEMORY
+            self._read_registers = (get(b),)
+            self._written_registers = (get(a),)
+        elif opcode == Opcode.STORE:
+            self._kind = self._MEMORY
+            self._read_registers = (get(a), get(b))
+            self._written_registers = ()
+        elif opcode in BranchInstruction.opcodes:
+            self._kind = self._BRANCH
+            self._read_registers = (get(a), get(b))
+            self._written_registers = ()
+        elif opcode == Opcode.JMP:
+            self._kind = self._JUMP
+            self._read_registers = self._written_registers = ()
+        else:
+            self._kind = self._HALT
+            self._read_registers = self._written_registers = ()
+
+    def decode(self, uop):
+        kind = self._kind
+        if kind == self._HALT:
+            raise HaltSignal(uop.get_pc())
+        if kind == self._JUMP:
+            raise JumpSignal(self._fields[2])
+
+        self._reserve_registers()
+        if kind == self._BRANCH:
+            uop._tmp = self._replay._branches.popleft()
+            if uop._tmp:
+                raise JumpSignal(self._fields[2])
+
+    def execute(self, uop):
+        if self._kind == self._ALU or self._kind == self._MEMORY:
+            if uop._remaining_cycles > 0:
+                uop._remaining_cycles -= 1
+                raise FunctionalUnitNotFinishedSignal
+            if self._kind == self._MEMORY:
+                uop._computed_mem_addr = self._replay._addresses.popleft()
+
+    def writeback(self, uop):
+        for register in self._written_registers:
+            register.unlock()
+
+    def get_read_registers(self):
+        return self._read_registers
+
+    def get_written_registers(self):
+        return self._written_registers
+
+    def get_fu_cycles(self):
+        if self._kind == self._ALU:
+            return AluInstruction.fu_cycles[self._opcode]
+        elif self._kind == self._MEMORY:
+            return MemInstruction.fu_cycles[self._opcode]
+        return 1
+
+    def encode(self):
+        return (self._opcode,) + self._fields
+
+    def __repr__(self):
+        # Same text as the instruction the record comes from, so chronograms look the same
+        a, b, c = self._fields
+        name = Opcode.to_str(self._opcode)
+        if self._kind == self._ALU:
+            return "%s R%d, R%d, R%d" % (name, a, b, c)
+        elif self._opcode == Opcode.LOAD:
+            return "%s R%d, %d(R%d)" % (name, a, c, b)
+        elif self._opcode == Opcode.STORE:
+            return "%s R%d, %d(R%d)" % (name, b, c, a)
+        elif self._kind == self._BRANCH:
+            return "%s R%d, R%d, 0x%x" % (name, a, b, c)
+        elif self._kind == self._JUMP:
+            return "%s 0x%x" % (name, c)
+        return name
+
+
+def replay(path, cpu_class=None, max_cycles=None, **cpu_kwargs):
+    """
+    Runs a trace through a timing CPU (PipelinedCpu by default) and returns the CPU
+    """
+    from . import architectures
+
+    reader = TraceReader(path)
+    registers = RegisterSet(num_registers=reader.num_registers)
+    trace = TraceReplay(reader, registers)
+    try:
+        cpu = (cpu_class or architectures.PipelinedCpu)(registers=registers, memory=None, trace=trace, **cpu_kwargs)
+        cpu.start()
+        cpu.run(max_cycles)
+    finally:
+        trace.close()
+    return cpu
+
+
+class TraceError(Exception):
+    pass
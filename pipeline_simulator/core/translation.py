@@ -0,0 +1,215 @@
+import logging
+import operator
+from .instructions import Instruction, Opcode, AluInstruction, BranchInstruction
+from .memories import Memory, wrap_word
+
+
+logger = logging.getLogger(__name__)
+
+MAX_BLOCK_LENGTH = 256
+_MIN_WORD = -(1 << 63)
+_MAX_WORD = (1 << 63) - 1
+_OPERATORS = {operator.add: '+', operator.sub: '-', operator.mul: '*', operator.eq: '==', operator.ne: '!='}
+
+
+class BasicBlock:
+    """
+    Straight-line run of instructions from `start` up to `end` (excluded), translated into a Python function.
+
+    run(values, iterations) executes the block on the register array values and returns a
+    (pc, executed instructions, halted, error) tuple. Registers live in local variables while the block
+    runs and are written back when it returns. A block whose last branch or jump goes back to its start
+    loops inside the function, for up to `iterations` iterations, or until it exits if iterations is 0.
+    error is the exception raised by an instruction, in which case pc is the faulting instruction, which
+    has not been executed, and the registers hold the values from before it.
+    """
+    __slots__ = ('start', 'end', 'length', 'halts', 'loops', 'run', 'source')
+
+    def __init__(self, start, end, halts, loops, run, source):
+        self.start = start
+        self.end = end
+        self.length = end - start
+        self.halts = halts
+        self.loops = loops
+        self.run = run
+        self.source = source
+
+    def __repr__(self):
+        return "BasicBlock(0x%x-0x%x%s)" % (self.start, self.end - 1, ", loop" if self.loops else "")
+
+
+class BlockCache:
+    """
+    Translated basic blocks of the program in a memory, by start address.
+
+    Blocks end at the first branch, jump or HALT, or before a breakpoint or a word that is not an
+    instruction. Stores of the translated code to a translated address drop every block that holds it,
+    along with the instruction decoded at that address in `decoded` (the per-instruction cache of
+    FunctionalCpu), and return from the block so the rest of the program is translated again.
+    Stores to the words of a plain Memory are done on its list directly, so blocks cannot be used while
+    memory watchpoints are set.
+    """
+
+    def __init__(self, memory, decoded):
+        self._memory = memory
+        self._decoded = decoded
+        self._blocks = {}
+        self._owners = {}  # {address: start addresses of the blocks that hold it}
+        self._translated = 0
+        self._invalidated = 0
+
+    def get(self, pc, breakpoints=()):
+        """ Block starting at pc, translated on first use. None if the word at pc is a breakpoint or not an instruction. """
+        block = self._blocks.get(pc)
+        if block is None and pc not in breakpoints:
+            block = self.__translate(pc, breakpoints)
+            if block is not None:
+                self._blocks[pc] = block
+                for addr in range(block.start, block.end):
+                    self._owners.setdefault(addr, []).append(pc)
+        return block
+
+    def invalidate(self, addr):
+        """ Drops the blocks holding addr and the instruction decoded at addr """
+        self._decoded.pop(addr, None)
+        for start in self._owners.pop(addr, ()):
+            block = self._blocks.pop(start, None)
+            if block is None:
+                continue
+            self._invalidated += 1
+            for owned in range(block.start, block.end):
+                starts = self._owners.get(owned)
+                if starts is not None and start in starts:
+                    starts.remove(start)
+                    if not starts:
+                        del self._owners[owned]
+
+    def clear(self):
+        self._blocks.clear()
+        self._owners.clear()
+
+    def get_stats(self):
+        return {'blocks': len(self._blocks), 'translated': self._translated, 'invalidated': self._invalidated}
+
+    def __getstate__(self):
+        # Translated functions cannot be pickled, checkpoints translate the blocks again
+        state = self.__dict__.copy()
+        state['_blocks'] = {}
+        state['_owners'] = {}
+        return state
+
+    def __translate(self, start, breakpoints):
+        memory = self._memory
+        size = memory.get_size()
+        instructions = []
+        pc = start
+        while pc < size and len(instructions) < MAX_BLOCK_LENGTH and pc not in breakpoints:
+            instruction = memory.get_data(pc)
+            if not isinstance(instruction, Instruction):
+                break
+            encoded = instruction.encode()
+            instructions.append(encoded)
+            opcode = encoded[0]
+            pc += 1
+            if opcode in BranchInstruction.opcodes or opcode == Opcode.JMP or opcode == Opcode.HALT:
+                break
+        if not instructions:
+            return None
+
+        source, namespace, halts, loops = self.__generate(start, instructions)
+        namespace.update(words=memory._memory if memory.__class__ is Memory else None, load=memory.get_data,
+                         store=memory.set, code=self._owners, decoded=self._decoded,
+                         invalidate=self.invalidate, wrap_word=wrap_word)
+        exec(compile(source, '<block 0x%x>' % start, 'exec'), namespace)
+        self._translated += 1
+        logger.debug("Translated block of %d instructions at 0x%x.", len(instructions), start)
+        return BasicBlock(start, start + len(instructions), halts, loops, namespace['block'], source)
+
+    def __generate(self, start, instructions):
+        """ Source of the block function, the functions it calls, and whether it halts and loops """
+        direct = self._memory.__class__ is Memory
+        length = len(instructions)
+        namespace = {}
+        used = set()
+        written = set()
+        body = []
+        halts = loops = False
+
+        def operation(function, index, x, y):
+            symbol = _OPERATORS.get(function)
+            if symbol is not None:
+                return "r%d %s r%d" % (x, symbol, y)
+            namespace['f%d' % index] = function
+            return "f%d(r%d, r%d)" % (index, x, y)
+
+        def exit_to(pc, count):
+            return ["pc = %s" % pc, "count = %s" % count, "break"]
+
+        for index, (opcode, a, b, c) in enumerate(instructions):
+            pc = start + index
+            if opcode in AluInstruction.opcodes:
+                used.update((a, b, c))
+                written.add(a)
+                if opcode == Opcode.DIV:
+                    body.append("i = %d" % index)
+                body.append("x = %s" % operation(AluInstruction.operations[opcode], index, b, c))
+                body.append("r%d = x if %d <= x <= %d else wrap_word(x)" % (a, _MIN_WORD, _MAX_WORD))
+
+            elif opcode == Opcode.LOAD:
+                used.update((a, b))
+                written.add(a)
+                body.append("i = %d" % index)
+                body.append(("x = words[r%d + %d]" if direct else "x = load(r%d + %d)") % (b, c))
+                body.append("r%d = x if %d <= x <= %d else wrap_word(x)" % (a, _MIN_WORD, _MAX_WORD))
+
+            elif opcode == Opcode.STORE:
+                used.update((a, b))
+                body.append("i = %d" % index)
+                body.append("addr = r%d + %d" % (b, c))
+                body.append(("words[addr] = r%d" if direct else "store(addr, r%d)") % a)
+                body.append("if addr in code or addr in decoded:  # Self-modifying code")
+                body.append("    invalidate(addr)")
+                body.extend("    " + line for line in exit_to(pc + 1, "n * %d + %d" % (length, index + 1)))
+
+            elif opcode in BranchInstruction.opcodes:
+                used.update((a, b))
+                condition = operation(BranchInstruction.conditions[opcode], index, a, b)
+                loops = c == start
+                body.append("n += 1")
+                body.append("if %s:" % condition)
+                if loops:
+                    body.append("    if n != iterations:")
+                    body.append("        continue")
+                body.append("    pc = %d" % c)
+                body.append("else:")
+                body.append("    pc = %d" % (pc + 1))
+                body.extend(["count = n * %d" % length, "break"])
+
+            elif opcode == Opcode.JMP:
+                loops = c == start
+                body.append("n += 1")
+                if loops:
+                    body.append("if n != iterations:")
+                    body.append("    continue")
+                body.extend(exit_to(c, "n * %d" % length))
+
+            else:  # HALT, which stays at the PC of the halted CPU
+                halts = True
+                body.append("halted = True")
+                body.extend(exit_to(pc, length))
+
+        if body[-1] != "break":  # Falls through to the next block
+            body.extend(exit_to(start + length, length))
+
+        lines = ["def block(values, iterations, words=words, load=load, store=store, code=code, decoded=decoded,",
+                 "          invalidate=invalidate, wrap_word=wrap_word):"]
+        lines.extend("    r%d = values[%d]" % (register, register) for register in sorted(used))
+        lines.extend(["    n = i = 0", "    halted = False", "    error = None", "    try:", "        while True:"])
+        lines.extend("            " + line for line in body)
+        lines.extend(["    except Exception as e:",
+                      "        pc = %d + i" % start,
+                      "        count = n * %d + i" % length,
+                      "        error = e"])
+        lines.extend("    values[%d] = r%d" % (register, register) for register in sorted(written))
+        lines.append("    return pc, count, halted, error")
+        return "\n".join(lines) + "\n", namespace, halts, loops
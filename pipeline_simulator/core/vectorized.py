@@ -0,0 +1,198 @@
+import logging
+from .architectures import InvalidInstructionError
+from .instructions import Instruction, Opcode, AluInstruction, BranchInstruction, _divide
+from .memories import InvalidAddressError, wrap_word
+
+
+logger = logging.getLogger(__name__)
+
+_ALU, _LOAD, _STORE, _BRANCH, _JUMP, _HALT = range(6)
+_MAX_EXACT_FLOAT = 2 ** 53
+
+
+class LockstepCpu:
+    """
+    Functional execution of one program over many independent instances with NumPy.
+
+    Registers and data memory are int64 arrays with one column per instance, so the operands of an
+    instruction are contiguous rows when all instances run together. Every step executes one instruction, with vectorized operations,
+    for every running instance whose PC is the lowest one: instances that took a different branch
+    wait until the others reach their PC, which makes them converge again at the end of loops and
+    conditionals. Words of the program are read from the decoded program, not from the data memory,
+    so programs that store over their own code are not supported. Loading a word of the program raises
+    the TypeError of the scalar CPUs, which cannot put an instruction in a register, unless the instance
+    has stored data over it. Arithmetic wraps to 64-bit words like AluInstruction.
+
+    Needs NumPy.
+    """
+
+    def __init__(self, program, registers, memory, pc=0):
+        """
+        program is the list of Instructions as loaded from address 0, registers and memory are
+        2D arrays with one row per instance
+        """
+        import numpy
+        self._np = numpy
+        registers = numpy.asarray(registers, dtype=numpy.int64)
+        memory = numpy.asarray(memory, dtype=numpy.int64)
+        if registers.ndim != 2 or memory.ndim != 2 or registers.shape[0] != memory.shape[0]:
+            raise ValueError("Registers and memory must be 2D arrays with one row per instance.")
+        self._registers = numpy.ascontiguousarray(registers.T)
+        self._memory = numpy.ascontiguousarray(memory.T)
+
+        num_instances = registers.shape[0]
+        self._program = program
+        self._code_size = len(program)
+        self._decoded = [self.__decode(word) for word in program]
+        self._code = numpy.zeros(self._memory.shape, dtype=bool)  # Words that hold an instruction, by instance
+        self._code[[addr for addr, word in enumerate(program[:self._memory.shape[0]])
+                    if isinstance(word, Instruction)]] = True
+        self._pcs = numpy.full(num_instances, pc, dtype=numpy.int64)
+        self._running = numpy.ones(num_instances, dtype=bool)
+        self._instructions = numpy.zeros(num_instances, dtype=numpy.int64)
+        self._steps = 0
+
+    def run(self, max_steps=None):
+        """
+        Runs until every instance halts or max_steps vector steps have been done.
+        Returns the number of steps done.
+        """
+        np = self._np
+        registers = self._registers
+        memory = self._memory
+        code = self._code
+        pcs = self._pcs
+        running = self._running
+        instructions = self._instructions
+        decoded = self._decoded
+        num_instances = len(pcs)
+        memory_size = memory.shape[0]
+        halted_pc = np.iinfo(np.int64).max
+        every_lane = np.arange(num_instances)
+        steps = 0
+
+        while steps != max_steps:
+            waiting = np.where(running, pcs, halted_pc)
+            pc = int(waiting.min())
+            if pc == halted_pc:
+                break
+
+            lanes = np.flatnonzero(waiting == pc)
+            if len(lanes) == num_instances:  # Every instance at the same PC, registers are plain rows
+                lanes = every_lane
+                rows = slice(None)
+            else:
+                rows = lanes
+            if not 0 <= pc < self._code_size or decoded[pc] is None:
+                raise InvalidInstructionError(pc)
+
+            kind, function, a, b, c = decoded[pc]
+            instructions[rows] += 1
+            steps += 1
+
+            if kind == _ALU:
+                operand_c = registers[c, rows]
+                if function is None:  # DIV
+                    if not operand_c.all():
+                        raise ZeroDivisionError("division by zero")
+                    registers[a, rows] = self.__divide(registers[b, rows], operand_c)
+                else:
+                    registers[a, rows] = function(registers[b, rows], operand_c)
+                pcs[rows] = pc + 1
+
+            elif kind == _LOAD:
+                addrs = registers[b, rows] + c
+                self.__check_addresses(addrs, memory_size)
+                self.__check_data(addrs, lanes)
+                registers[a, rows] = memory[addrs, lanes]
+                pcs[rows] = pc + 1
+
+            elif kind == _STORE:
+                addrs = registers[b, rows] + c
+                self.__check_addresses(addrs, memory_size)
+                memory[addrs, lanes] = registers[a, rows]
+                code[addrs, lanes] = False
+                pcs[rows] = pc + 1
+
+            elif kind == _BRANCH:
+                taken = function(registers[a, rows], registers[b, rows])
+                pcs[rows] = np.where(taken, c, pc + 1)
+
+            elif kind == _JUMP:
+                pcs[rows] = c
+
+            else:  # kind == halt
+                running[rows] = False
+
+        self._steps += steps
+        logger.info("%d lock-step steps, %d instances still running." % (steps, int(running.sum())))
+        return steps
+
+    def is_halted(self):
+        return not self._running.any()
+
+    def get_registers(self):
+        """ (instances x registers) view of the registers """
+        return self._registers.T
+
+    def get_memory(self):
+        """ (instances x words) view of the data memory """
+        return self._memory.T
+
+    def get_pcs(self):
+        return self._pcs
+
+    def get_halted(self):
+        return ~self._running
+
+    def get_executed_instructions(self):
+        """ Instructions executed by each instance """
+        return self._instructions
+
+    def get_steps(self):
+        return self._steps
+
+    def __divide(self, dividends, divisors):
+        """
+        Same result as AluInstruction: the float quotient truncated and wrapped to a word. It is computed in
+        float64, except for operands too large to be converted exactly, which are divided one by one as
+        Python ints.
+        """
+        np = self._np
+        inexact = (dividends > _MAX_EXACT_FLOAT) | (dividends < -_MAX_EXACT_FLOAT) | \
+            (divisors > _MAX_EXACT_FLOAT) | (divisors < -_MAX_EXACT_FLOAT)
+        quotients = np.trunc(np.where(inexact, 0, dividends) / divisors).astype(np.int64)
+        inexact = np.flatnonzero(inexact)
+        for i in inexact:
+            quotients[i] = wrap_word(_divide(int(dividends[i]), int(divisors[i])))
+        return quotients
+
+    def __check_addresses(self, addrs, memory_size):
+        if len(addrs) and (addrs.min() < 0 or addrs.max() >= memory_size):
+            bad = addrs[(addrs < 0) | (addrs >= memory_size)]
+            raise InvalidAddressError(int(bad[0]))
+
+    def __check_data(self, addrs, lanes):
+        loaded = self._code[addrs, lanes]
+        if loaded.any():
+            word = self._program[int(addrs[loaded.argmax()])]
+            raise TypeError("'%s' object cannot be interpreted as an integer" % word.__class__.__name__)
+
+    def __decode(self, word):
+        if not isinstance(word, Instruction):
+            return None  # Raises InvalidInstructionError if it is ever executed
+
+        opcode, a, b, c = word.encode()
+        if opcode in AluInstruction.opcodes:
+            # DIV is done apart, with the truncation of AluInstruction; the other operators work on arrays
+            return _ALU, None if opcode == Opcode.DIV else AluInstruction.operations[opcode], a, b, c
+        elif opcode == Opcode.LOAD:
+            return _LOAD, None, a, b, c
+        elif opcode == Opcode.STORE:
+            return _STORE, None, a, b, c
+        elif opcode in BranchInstruction.opcodes:
+            return _BRANCH, BranchInstruction.conditions[opcode], a, b, c
+        elif opcode == Opcode.JMP:
+            return _JUMP, None, a, b, c
+        else:
+            return _HALT, None, a, b, c
@@ -0,0 +1,197 @@
+import logging
+import random
+from .compilers import Parser
+from .memories import Memory, RegisterSet
+
+
+logger = logging.getLogger(__name__)
+
+# Register conventions of the generated programs
+ZERO_REGISTER = 0  # Always 0, base register of every memory access
+ONE_REGISTER = 1  # Always 1, decrements the loop counters
+DIVISOR_REGISTER = 2  # Never 0, divisor of every DIV
+COUNTER_REGISTER = 3  # Loop counter
+FIRST_TRIP_REGISTER = 4  # Trip count of each loop, one register per loop
+
+DEFAULT_DEPENDENCY_DISTANCE = {
+    0: 2,  # Distance 0 means the operand does not depend on a previous instruction
+    1: 4,
+    2: 3,
+    3: 2,
+    5: 1,
+    8: 1,
+}
+
+
+class WorkloadGenerator:
+    """
+    Generates synthetic programs for the Parser.
+
+    The load mix is given by the weights of `cpu` (ALU), `mem` (LOAD/STORE) and `branches`
+    (forward conditional branches) instructions. Source operands are taken from the destination of the
+    instruction `d` positions before, where `d` is drawn from `dependency_distance` ({distance: weight}).
+    The program is a sequence of loops, one per entry in `trip_counts`, each with a body of `body_size`
+    instructions, or a single straight-line block of `body_size` instructions if `trip_counts` is empty.
+    Memory accesses touch `footprint` words placed after the code. The same seed always gives the same
+    workload.
+    """
+
+    alu_opcodes = ('ADD', 'SUB', 'MULT', 'DIV')
+    branch_opcodes = ('BEQ', 'BNE')
+
+    def __init__(self, seed=None, cpu=0.6, mem=0.3, branches=0.1, dependency_distance=None, body_size=20,
+                 trip_counts=(10,), footprint=256, num_registers=32, max_skip=3):
+        if cpu < 0 or mem < 0 or branches < 0 or cpu + mem + branches <= 0:
+            raise ValueError("The instruction mix needs at least one positive weight.")
+        if FIRST_TRIP_REGISTER + len(trip_counts) + 2 > num_registers:
+            raise ValueError("Too many loops for %d registers." % num_registers)
+        if any(trip_count < 1 for trip_count in trip_counts):
+            raise ValueError("Trip counts must be positive.")
+
+        self._seed = seed
+        self._mix = (cpu, mem, branches)
+        self._dependency_distance = dependency_distance or DEFAULT_DEPENDENCY_DISTANCE
+        self._body_size = body_size
+        self._trip_counts = tuple(trip_counts)
+        self._footprint = footprint
+        self._num_registers = num_registers
+        self._max_skip = max_skip
+
+    def generate(self):
+        rng = random.Random(self._seed)
+        first_data_register = FIRST_TRIP_REGISTER + len(self._trip_counts)
+        data_registers = list(range(first_data_register, self._num_registers))
+
+        static_size = (self._body_size + 3) * len(self._trip_counts) if self._trip_counts else self._body_size
+        data_base = _align(static_size + 1, 16)
+
+        # [label, text] pairs, the text of a forward branch is (opcode, rs, rt, target line) until its label is known
+        lines = []
+        if self._trip_counts:
+            for loop, trip_count in enumerate(self._trip_counts):
+                lines.append([None, "ADD R%d, R%d, R%d" % (COUNTER_REGISTER, ZERO_REGISTER, FIRST_TRIP_REGISTER + loop)])
+                loop_start = len(lines)
+                self.__generate_block(rng, lines, data_registers, data_base)
+                lines[loop_start][0] = "LOOP%d" % loop
+                lines.append([None, "SUB R%d, R%d, R%d" % (COUNTER_REGISTER, COUNTER_REGISTER, ONE_REGISTER)])
+                lines.append([None, "BNE R%d, R%d, LOOP%d" % (COUNTER_REGISTER, ZERO_REGISTER, loop)])
+        else:
+            self.__generate_block(rng, lines, data_registers, data_base)
+        lines.append([None, "HALT"])
+
+        for line in lines:
+            if isinstance(line[1], tuple):
+                opcode, rs, rt, target = line[1]
+                if lines[target][0] is None:
+                    lines[target][0] = "SKIP%d" % target
+                line[1] = "%s R%d, R%d, %s" % (opcode, rs, rt, lines[target][0])
+
+        source = ["%s: %s\n" % (label, text) if label else text + "\n" for label, text in lines]
+
+        registers = {
+            ZERO_REGISTER: 0,
+            ONE_REGISTER: 1,
+            DIVISOR_REGISTER: rng.randint(2, 9),
+            COUNTER_REGISTER: 0,
+        }
+        for loop, trip_count in enumerate(self._trip_counts):
+            registers[FIRST_TRIP_REGISTER + loop] = trip_count
+        for register in data_registers:
+            registers[register] = rng.randint(-100, 100)
+
+        memory = {addr: rng.randint(-100, 100) for addr in range(data_base, data_base + self._footprint)}
+
+        body_instructions = self._body_size + 2
+        dynamic_instructions = sum(1 + trip_count * body_instructions for trip_count in self._trip_counts) + 1 \
+            if self._trip_counts else self._body_size + 1
+
+        logger.info("Generated %d static instructions, about %d dynamic." % (len(source), dynamic_instructions))
+        return Workload(source, registers, memory, data_base + self._footprint, dynamic_instructions)
+
+    def __generate_block(self, rng, lines, data_registers, data_base):
+        written = []  # Destination register of every instruction in the block, None if it writes none
+        cpu, mem, branches = self._mix
+        distances = list(self._dependency_distance.keys())
+        weights = list(self._dependency_distance.values())
+
+        def source():
+            distance = rng.choices(distances, weights)[0]
+            if 0 < distance <= len(written) and written[-distance] is not None:
+                return written[-distance]
+            return rng.choice(data_registers)
+
+        block_end = len(lines) + self._body_size
+        for _ in range(self._body_size):
+            kind = rng.choices(('cpu', 'mem', 'branch'), (cpu, mem, branches))[0]
+            if kind == 'branch' and len(lines) + 1 >= block_end:
+                kind = 'cpu'  # No room left to skip forward inside the block
+
+            if kind == 'cpu':
+                opcode = rng.choice(self.alu_opcodes)
+                rd = rng.choice(data_registers)
+                rs = source()
+                rt = DIVISOR_REGISTER if opcode == 'DIV' else source()
+                lines.append([None, "%s R%d, R%d, R%d" % (opcode, rd, rs, rt)])
+                written.append(rd)
+
+            elif kind == 'mem':
+                offset = data_base + rng.randrange(self._footprint)
+                if rng.random() < 0.5:
+                    rd = rng.choice(data_registers)
+                    lines.append([None, "LOAD R%d, %d(R%d)" % (rd, offset, ZERO_REGISTER)])
+                    written.append(rd)
+                else:
+                    lines.append([None, "STORE R%d, %d(R%d)" % (source(), offset, ZERO_REGISTER)])
+                    written.append(None)
+
+            else:
+                target = min(len(lines) + 1 + rng.randint(1, self._max_skip), block_end)
+                opcode = rng.choice(self.branch_opcodes)
+                lines.append([None, (opcode, source(), rng.choice(data_registers), target)])
+                written.append(None)
+
+
+class Workload:
+    """
+    Source lines, initial registers ({register id: value}) and initial memory ({address: value})
+    of a generated program.
+    """
+
+    def __init__(self, source, registers, memory, memory_size, dynamic_instructions):
+        self.source = source
+        self.registers = registers
+        self.memory = memory
+        self.memory_size = memory_size
+        self.dynamic_instructions = dynamic_instructions  # Upper bound, skipped instructions are not subtracted
+
+    def write(self, program_file, registers_file=None):
+        with open(program_file, 'w') as f:
+            f.writelines(self.source)
+
+        if registers_file:
+            with open(registers_file, 'w') as f:
+                for register, value in sorted(self.registers.items()):
+                    f.write("r%d=%d\n" % (register, value))
+
+    def load(self, registers: RegisterSet, memory: Memory):
+        """
+        Parses the program into memory and writes the initial registers and data. Returns the program.
+        """
+        program = Parser(registers=registers, memory=memory).parse_lines(self.source)
+        memory.write_program(program)
+        for register, value in self.registers.items():
+            registers.get(register).set(value)
+        for addr, value in self.memory.items():
+            memory.set(addr, value)
+        return program
+
+    def build(self, memory_class=Memory):
+        """ Returns a new RegisterSet and Memory with the workload loaded, memory_class can be PagedMemory """
+        registers = RegisterSet()
+        memory = memory_class(self.memory_size)
+        self.load(registers, memory)
+        return registers, memory
+
+
+def _align(value, alignment):
+    return (value + alignment - 1) // alignment * alignment
@@ -0,0 +1,329 @@
+"""
+Local simulation service.
+
+Jobs are sent as JSON lines over a Unix socket, queued, and run on a pool of worker processes, while the
+progress and the final counters of each job are streamed back over the same connection. Requests:
+
+    {"op": "submit", "job": {...}}   Queues a job, answers {"event": "queued", "job": id} and then streams
+                                     "started", "progress" and "done" (or "error") events for it
+    {"op": "status"}                 Answers {"event": "status", "queued": n, "running": n, "workers": n}
+
+A job is a dict with:
+    program             Source of the program, a string or a list of lines (required)
+    cpu                 'pipelined' (default), 'centralized', 'scoreboard' or 'functional'
+    memory_size         Words of memory, 2048 by default
+    num_registers       32 by default
+    registers           {register id: value} initial registers
+    memory              {address: value} initial data
+    phase_cycles        Cycles of each of the five pipeline phases
+    fu_cycles           {mnemonic: cycles} latencies of the functional units
+    scalability         Instructions issued per cycle by the reservation stations CPU
+    max_cycles          Stops the run after that many cycles
+    watch               Addresses whose final value is returned
+    progress_interval   Cycles between progress events, 1000 by default
+
+Given a cache directory, the service answers the jobs it has already run from a ResultCache, without
+progress events, and flags those results with "cached": true.
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import sys
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = 'pipeline-simulator.sock'
+DEFAULT_PROGRESS_INTERVAL = 1000
+
+
+def run_job(job, progress=None, job_id=None, cache=None):
+    """
+    Runs a job and returns its result dict. progress, if given, is a queue that receives
+    (job_id, event) tuples every progress_interval cycles. cache is a ResultCache.
+    """
+    from pipeline_simulator.core import architectures, compilers, instructions, memories, results
+
+    cpu_classes = {
+        'pipelined': architectures.PipelinedCpu,
+        'centralized': architectures.CentralizedRSCpu,
+        'scoreboard': architectures.ScoreboardCpu,
+        'functional': architectures.FunctionalCpu,
+    }
+    try:
+        cpu_class = cpu_classes[job.get('cpu', 'pipelined')]
+    except KeyError:
+        raise JobError("Unknown cpu '%s'." % job['cpu'])
+    if 'program' not in job:
+        raise JobError("The job has no program.")
+
+    registers = memories.RegisterSet(num_registers=job.get('num_registers', 32))
+    memory = memories.Memory(job.get('memory_size', 2048))
+    source = job['program']
+    if isinstance(source, str):
+        source = source.splitlines(keepends=True)
+    program = compilers.Parser(registers=registers, memory=memory).parse_lines(source)
+    memory.write_program(program)
+    for register_id, value in job.get('registers', {}).items():
+        registers.get(int(register_id)).set(value)
+    for addr, value in job.get('memory', {}).items():
+        memory.set(int(addr), value)
+
+    cpu_kwargs = {}
+    if 'phase_cycles' in job:
+        cpu_kwargs['phase_cycles'] = tuple(job['phase_cycles'])
+    if 'scalability' in job:
+        cpu_kwargs['scalability'] = job['scalability']
+
+    # Latencies are class attributes, they are restored after the run because the worker is reused
+    latencies = [instructions.AluInstruction.fu_cycles, instructions.MemInstruction.fu_cycles]
+    saved_latencies = [dict(table) for table in latencies]
+    try:
+        for mnemonic, cycles in job.get('fu_cycles', {}).items():
+            opcode = instructions.Opcode.from_str(mnemonic)
+            table = next((table for table in latencies if opcode in table), None)
+            if table is None:
+                raise JobError("'%s' has no functional unit latency." % mnemonic)
+            table[opcode] = cycles
+
+        cpu = cpu_class(registers=registers, memory=memory, **cpu_kwargs)
+        max_cycles = job.get('max_cycles')
+        watch = job.get('watch', ())
+        if cache is not None:
+            key = cache.key(cpu, max_cycles, watch)
+            result = cache.get(key)
+            if result is not None:
+                return dict(result, cached=True)
+        interval = job.get('progress_interval', DEFAULT_PROGRESS_INTERVAL)
+        counters = cpu.get_counters()
+
+        cpu.start()
+        while not cpu.is_halted():
+            cycles = counters.get_cycles()
+            if max_cycles is not None and cycles >= max_cycles:
+                break
+            cpu.run(interval if max_cycles is None else min(interval, max_cycles - cycles))
+            if progress is not None and not cpu.is_halted():
+                progress.put((job_id, {'event': 'progress', 'cycles': counters.get_cycles(),
+                                       'instructions': counters.get_instructions()}))
+    finally:
+        for table, saved in zip(latencies, saved_latencies):
+            table.clear()
+            table.update(saved)
+
+    result = results.collect(cpu, watch)
+    if cache is not None:
+        cache.put(key, result)
+        return dict(result, cached=False)
+    return result
+
+
+def _run_job_in_worker(job, progress, job_id, cache_dir=None, cache_size=None):
+    """
+    Returns the result event of the job. Errors are returned as messages because the exceptions of the
+    simulator do not all survive pickling, and one that fails to unpickle would break the whole pool.
+    """
+    try:
+        cache = None
+        if cache_dir is not None:
+            from pipeline_simulator.core import results
+            cache = results.ResultCache(cache_dir, cache_size or results.DEFAULT_MAX_BYTES)
+        return dict(run_job(job, progress, job_id, cache), event='done')
+    except Exception as e:
+        logger.info("Job %s failed: %r" % (job_id, e))
+        return {'event': 'error', 'message': "%s: %s" % (e.__class__.__name__, e)}
+
+
+class SimulationService:
+    """
+    Asyncio server of the simulation jobs. The queue is served in order by one dispatcher task per
+    worker process, so at most `workers` jobs run at the same time and the others wait queued.
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, workers=None, cache_dir=None, cache_size=None):
+        """ cache_dir, shared by the workers, caches the results of the jobs up to cache_size bytes """
+        self._socket_path = socket_path
+        self._workers = workers or os.cpu_count() or 1
+        self._cache_dir = cache_dir
+        self._cache_size = cache_size
+        self._queue = None
+        self._running = 0
+        self._job_ids = itertools.count(1)
+        self._listeners = {}  # {job id: asyncio.Queue of the events of the job}
+        self._server = None
+        self._pool = None
+        self._manager = None
+        self._progress = None
+        self._tasks = []
+        self._clients = set()
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        # Workers are spawned, forking the event loop process along with its threads is not safe
+        self._pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self._workers, mp_context=multiprocessing.get_context('spawn'))
+        self._manager = multiprocessing.Manager()
+        self._progress = self._manager.Queue()
+
+        if os.path.exists(self._socket_path):
+            os.unlink(self._socket_path)
+        self._server = await asyncio.start_unix_server(self.__handle_client, path=self._socket_path)
+        self._tasks = [loop.create_task(self.__dispatch()) for _ in range(self._workers)]
+        self._tasks.append(loop.create_task(self.__forward_progress()))
+        logger.info("Listening on '%s' with %d workers." % (self._socket_path, self._workers))
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.stop()
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        tasks = self._tasks + list(self._clients)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+        if self._progress is not None:
+            self._progress.put(None)  # Unblocks the progress forwarder thread
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+        if os.path.exists(self._socket_path):
+            os.unlink(self._socket_path)
+
+    async def __handle_client(self, reader, writer):
+        task = asyncio.current_task()
+        self._clients.add(task)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    op = request['op']
+                except (ValueError, KeyError, TypeError):
+                    await self.__send(writer, {'event': 'error', 'message': "Malformed request."})
+                    continue
+
+                if op == 'submit':
+                    await self.__submit(request.get('job', {}), writer)
+                elif op == 'status':
+                    await self.__send(writer, {'event': 'status', 'queued': self._queue.qsize(),
+                                               'running': self._running, 'workers': self._workers})
+                else:
+                    await self.__send(writer, {'event': 'error', 'message': "Unknown op '%s'." % op})
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._clients.discard(task)
+            writer.close()
+
+    async def __submit(self, job, writer):
+        job_id = next(self._job_ids)
+        events = asyncio.Queue()
+        self._listeners[job_id] = events
+        await self._queue.put((job_id, job))
+        await self.__send(writer, {'event': 'queued', 'job': job_id})
+
+        try:
+            while True:
+                event = await events.get()
+                await self.__send(writer, dict(event, job=job_id))
+                if event['event'] in ('done', 'error'):
+                    break
+        finally:
+            del self._listeners[job_id]
+
+    async def __dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job_id, job = await self._queue.get()
+            self.__publish(job_id, {'event': 'started'})
+            self._running += 1
+            try:
+                result = await loop.run_in_executor(self._pool, _run_job_in_worker, job, self._progress, job_id,
+                                                    self._cache_dir, self._cache_size)
+                self.__publish(job_id, result)
+            except Exception as e:  # The worker died
+                self.__publish(job_id, {'event': 'error', 'message': str(e) or e.__class__.__name__})
+            finally:
+                self._running -= 1
+
+    async def __forward_progress(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await loop.run_in_executor(None, self._progress.get)
+            if item is None:
+                break
+            self.__publish(*item)
+
+    def __publish(self, job_id, event):
+        events = self._listeners.get(job_id)
+        if events is not None:
+            events.put_nowait(event)
+
+    @staticmethod
+    async def __send(writer, message):
+        writer.write(json.dumps(message).encode() + b"\n")
+        await writer.drain()
+
+
+async def submit(job, socket_path=DEFAULT_SOCKET):
+    """
+    Sends a job to a running service and yields its events, the last one is 'done' or 'error'
+    """
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    try:
+        writer.write(json.dumps({'op': 'submit', 'job': job}).encode() + b"\n")
+        await writer.drain()
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise ConnectionError("The service closed the connection.")
+            event = json.loads(line)
+            yield event
+            if event['event'] in ('done', 'error'):
+                break
+    finally:
+        writer.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m pipeline_simulator.service',
+                                     description="Serves simulation jobs over a Unix socket.")
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help="Path of the Unix socket")
+    parser.add_argument('--workers', type=int, help="Worker processes (default: one per CPU)")
+    parser.add_argument('--cache', metavar='DIR', help="Directory of the result cache")
+    parser.add_argument('--cache-size', type=int, default=256, metavar='MB', help="Bound of the result cache")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stderr, level='WARNING')
+    try:
+        service = SimulationService(args.socket, args.workers, args.cache, args.cache_size * 1024 * 1024)
+        asyncio.run(service.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+class JobError(Exception):
+    pass
+
+
+if __name__ == '__main__':
+    main()